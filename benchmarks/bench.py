@@ -0,0 +1,701 @@
+################################################################################
+# Benchmarks for the streaming hot paths, run against the fake libtorrent so
+# that results only depend on cherrytorrent itself.
+#
+#   python benchmarks/bench.py --output results.json
+#   python benchmarks/bench.py --compare baseline.json
+################################################################################
+import argparse
+import httplib
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_libtorrent
+
+sys.modules['libtorrent'] = fake_libtorrent
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cherrypy
+
+from cherrytorrent import downloader
+from cherrytorrent import server
+from cherrytorrent import store
+
+################################################################################
+READ_CHUNK_SIZE = 64 * 1024
+CUES_SIZE       = 64 * 1024
+PROBE_DELAY     = 0.25
+BANDWIDTH_LIMIT = 8 * 1024
+BANDWIDTH_TIME  = 4.0
+IDLE_TIMEOUT    = 5.0
+READY_TIMEOUT   = 60.0
+PREFETCH_RATE   = 10.0
+PREFETCH_LEAD   = 2.0
+
+################################################################################
+def percentile(values, ratio):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(ratio * (len(values) - 1))))]
+
+################################################################################
+def summarize(prefix, values):
+    return { prefix + '_p50_seconds': percentile(values, 0.50),
+             prefix + '_p95_seconds': percentile(values, 0.95),
+             prefix + '_max_seconds': max(values) if values else 0.0 }
+
+################################################################################
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+################################################################################
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+################################################################################
+class Harness:
+    ############################################################################
+    def __init__(self, args):
+        self.args          = args
+        self.directory     = tempfile.mkdtemp(prefix='cherrytorrent-bench-')
+        self.http_port     = get_free_port()
+        self.torrent_count = 0
+
+        http_config    = { 'port': self.http_port }
+        torrent_config = { 'port': 0, 'max_download_rate': 0, 'max_upload_rate': 0, 'keep_files': False, 'state_dir': os.path.join(self.directory, 'state'), 'cache_size': 0, 'cache_policy': 'lru', 'piece_cache_size': args.piece_cache_size }
+
+        cherrypy.config.update({ 'server.socket_host':     '127.0.0.1',
+                                 'server.socket_port':     self.http_port,
+                                 'server.thread_pool':     max(10, max(args.clients) * 2),
+                                 'engine.autoreload.on':   False,
+                                 'checker.on':             False,
+                                 'log.screen':             args.verbose })
+
+        cherrypy.engine.connection_monitor = server.ConnectionMonitor(cherrypy.engine, http_config)
+        cherrypy.engine.connection_monitor.subscribe()
+        cherrypy.engine.downloader_monitor = downloader.DownloaderMonitor(cherrypy.engine, http_config, torrent_config)
+        cherrypy.engine.downloader_monitor.subscribe()
+
+        self.async_server = None
+        self.async_thread = None
+        if args.http_mode == 'asyncio':
+            from cherrytorrent import aioserver
+            cherrypy.server.unsubscribe()
+            self.async_server = aioserver.AsyncHttpServer(cherrypy.engine, http_config, '127.0.0.1')
+        else:
+            cherrypy.tree.mount(server.ServerRoot(), '/')
+
+        self.downloader_monitor = cherrypy.engine.downloader_monitor
+
+    ############################################################################
+    def start(self):
+        cherrypy.engine.start()
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+
+        if self.async_server:
+            self.async_thread = threading.Thread(target=self.async_server.serve_forever)
+            self.async_thread.start()
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', self.http_port), 1.0).close()
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+
+        # The monitor only considers itself running, and stoppable, once its first tick started
+        while not self.downloader_monitor.monitor_running:
+            time.sleep(0.05)
+
+    ############################################################################
+    def stop(self):
+        # The monitor thread is a daemon that is not joined, let it leave its loop before the interpreter exits
+        monitor_thread = self.downloader_monitor.thread
+        cherrypy.engine.exit()
+        if monitor_thread:
+            monitor_thread.join(READY_TIMEOUT)
+        if self.async_thread:
+            self.async_thread.join(READY_TIMEOUT)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    ############################################################################
+    def restart_session(self, forget_state=False):
+        # What a process restart does to the torrent session, the HTTP server keeps running
+        monitor_thread = self.downloader_monitor.thread
+        self.downloader_monitor.stop()
+        if monitor_thread:
+            monitor_thread.join(READY_TIMEOUT)
+        if forget_state:
+            os.remove(os.path.join(self.directory, 'state', store.SESSION_STATE_FILE_NAME))
+
+        start_time = time.time()
+        self.downloader_monitor.start()
+        while not self.downloader_monitor.monitor_running:
+            time.sleep(0.05)
+        return start_time
+
+    ############################################################################
+    def add_torrent(self, piece_count, piece_rate, order='sequential', metadata_delay=0.0, piece_length=None, episodes=1, file_selector=None):
+        self.torrent_count = self.torrent_count + 1
+        piece_length       = piece_length or self.args.piece_length
+        name               = 'torrent-{0}'.format(self.torrent_count)
+
+        # Season packs split the video data between several episodes
+        video_size = piece_count * piece_length - 1024
+        if episodes == 1:
+            files = [('sample.txt', 1024), ('video.mkv', video_size)]
+        else:
+            video_size = video_size / episodes
+            files      = [('sample.txt', 1024)] + [('episode-{0}.mkv'.format(episode + 1), video_size) for episode in range(episodes)]
+        contents = [(1024 + episode * video_size, mkv_header(self.args.video_duration, video_size - CUES_SIZE)) for episode in range(episodes)]
+
+        ti = fake_libtorrent.make_torrent_info(name, files, piece_length)
+        fake_libtorrent.register_swarm(ti, piece_rate, order, metadata_delay, self.args.seed + self.torrent_count, contents)
+
+        uri = 'magnet:?xt=urn:btih:{0}&dn={1}'.format(ti.info_hash(), name)
+        return self.downloader_monitor.add_torrent(uri, os.path.join(self.directory, 'downloads'), file_selector)['info_hash']
+
+    ############################################################################
+    def get_torrent_handle(self, info_hash):
+        entry = self.downloader_monitor.torrents.get(info_hash)
+        return entry.torrent_handle if entry else None
+
+    ############################################################################
+    def wait_until_seeding(self, info_hash):
+        torrent_handle = self.get_torrent_handle(info_hash)
+        while torrent_handle.status().state != fake_libtorrent.torrent_status_states.seeding:
+            time.sleep(0.05)
+
+    ############################################################################
+    def open_video_file(self, info_hash):
+        if not self.downloader_monitor.wait_for_video_file_ready(info_hash, True, READY_TIMEOUT):
+            raise RuntimeError('Torrent {0} never became ready'.format(info_hash))
+        return self.downloader_monitor.get_video_file(info_hash)
+
+    ############################################################################
+    def remove_torrent(self, info_hash):
+        torrent_handle = self.get_torrent_handle(info_hash)
+        if torrent_handle:
+            self.downloader_monitor.remove_torrent(torrent_handle)
+
+################################################################################
+def ebml_element(element_id, data):
+    # 8 byte sizes are valid for any element and keep this simple
+    return element_id + '\x01' + struct.pack('>Q', len(data))[1:] + data
+
+################################################################################
+def mkv_header(duration, cues_offset):
+    # EBML header, then a segment of unknown size holding a seek head pointing at the cues, the info and the first cluster
+    ebml           = ebml_element('\x1a\x45\xdf\xa3', ebml_element('\x42\x82', 'matroska'))
+    segment_offset = len(ebml) + 12
+    seek_head      = ebml_element('\x11\x4d\x9b\x74', ebml_element('\x4d\xbb', ebml_element('\x53\xab', '\x1c\x53\xbb\x6b') + ebml_element('\x53\xac', struct.pack('>Q', cues_offset - segment_offset))))
+    info           = ebml_element('\x15\x49\xa9\x66', ebml_element('\x2a\xd7\xb1', struct.pack('>I', 1000000)) + ebml_element('\x44\x89', struct.pack('>d', duration * 1000.0)))
+    return ebml + '\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff' + seek_head + info + '\x1f\x43\xb6\x75\x01\xff\xff\xff\xff\xff\xff\xff'
+
+################################################################################
+def read_all(video_file):
+    # Reads wait for their pieces, a file still downloading is read at the pace of the swarm
+    while video_file.tell() < video_file.size:
+        video_file.read(READ_CHUNK_SIZE)
+
+################################################################################
+def bench_read_throughput(harness):
+    results = {}
+
+    for mode, piece_rate in (('complete', 10000.0), ('streaming', harness.args.piece_rate)):
+        info_hash = harness.add_torrent(harness.args.pieces, piece_rate)
+        if mode == 'complete':
+            harness.wait_until_seeding(info_hash)
+
+        video_file = harness.open_video_file(info_hash)
+        try:
+            start_time = time.time()
+            read_all(video_file)
+            duration = time.time() - start_time
+        finally:
+            video_file.close()
+            harness.remove_torrent(info_hash)
+
+        results['read_{0}_mb_s'.format(mode)] = video_file.size / duration / (1024.0 * 1024.0)
+        results['read_{0}_seconds'.format(mode)] = duration
+
+    return results
+
+################################################################################
+def bench_shared_read(harness):
+    results = {}
+
+    info_hash = harness.add_torrent(harness.args.pieces, 10000.0)
+    harness.wait_until_seeding(info_hash)
+
+    try:
+        for reader_count in harness.args.shared_readers:
+            # Every reader goes through the same pieces at the same time, as viewers of a popular stream would
+            video_files = [harness.open_video_file(info_hash) for reader_index in range(reader_count)]
+            threads     = [threading.Thread(target=read_all, args=(video_file,)) for video_file in video_files]
+            try:
+                start_time = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                duration = time.time() - start_time
+            finally:
+                for video_file in video_files:
+                    video_file.close()
+
+            results['shared_read_{0}_readers_mb_s'.format(reader_count)] = sum(video_file.size for video_file in video_files) / duration / (1024.0 * 1024.0)
+    finally:
+        harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def bench_buffered_ready(harness):
+    results = {}
+
+    # The preload buffer depends on how the swarm keeps up with the bitrate of the video
+    for mode, piece_rate in (('fast', harness.args.piece_rate), ('slow', harness.args.piece_rate / 20.0)):
+        start_time = time.time()
+        info_hash  = harness.add_torrent(harness.args.pieces, piece_rate)
+        try:
+            if not harness.downloader_monitor.wait_for_video_file_ready(info_hash, False, READY_TIMEOUT):
+                raise RuntimeError('Torrent {0} never became ready'.format(info_hash))
+            results['buffered_ready_{0}_seconds'.format(mode)] = time.time() - start_time
+        finally:
+            harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def bench_season_pack(harness):
+    results = {}
+
+    # Watching the third episode of four, then switching to the last one, other episodes should not compete
+    start_time = time.time()
+    info_hash  = harness.add_torrent(harness.args.pieces, harness.args.piece_rate, episodes=4, file_selector='2')
+    try:
+        if not harness.downloader_monitor.wait_for_video_file_ready(info_hash, False, READY_TIMEOUT):
+            raise RuntimeError('Torrent {0} never became ready'.format(info_hash))
+        results['season_pack_ready_seconds'] = time.time() - start_time
+
+        start_time = time.time()
+        harness.downloader_monitor.select_file(info_hash, 'episode-4.mkv')
+        if not harness.downloader_monitor.wait_for_video_file_ready(info_hash, False, READY_TIMEOUT):
+            raise RuntimeError('Torrent {0} never became ready after switching'.format(info_hash))
+        results['season_pack_switch_ready_seconds'] = time.time() - start_time
+    finally:
+        harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def bench_index_fetch(harness):
+    results = {}
+
+    # Players read the cues at the end of the file shortly after parsing its head, on a swarm slow enough for the wait to show
+    info_hash = harness.add_torrent(harness.args.pieces, harness.args.piece_rate / 20.0)
+    try:
+        video_file = harness.open_video_file(info_hash)
+        try:
+            video_file.read(READ_CHUNK_SIZE)
+            time.sleep(PROBE_DELAY)
+
+            start_time = time.time()
+            video_file.seek(video_file.size - CUES_SIZE)
+            if len(video_file.read(CUES_SIZE)) != CUES_SIZE:
+                raise RuntimeError('Short read of the cues of torrent {0}'.format(info_hash))
+            results['index_fetch_seconds'] = time.time() - start_time
+        finally:
+            video_file.close()
+    finally:
+        harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def bench_bandwidth(harness):
+    results = {}
+
+    # One viewer shares a limited link with torrents nobody watches, with and without the bandwidth scheduler
+    try:
+        for mode in ('shared', 'scheduled'):
+            harness.downloader_monitor.configure_bandwidth({ 'enabled': mode == 'scheduled', 'max_download_rate': BANDWIDTH_LIMIT })
+            info_hashes = [harness.add_torrent(harness.args.pieces, harness.args.piece_rate) for torrent_index in range(harness.args.bandwidth_torrents)]
+            try:
+                # Ready but left unwatched, they keep downloading in the background
+                for info_hash in info_hashes:
+                    harness.downloader_monitor.wait_for_video_file_ready(info_hash, False, READY_TIMEOUT)
+
+                info_hash = harness.add_torrent(harness.args.pieces, harness.args.piece_rate)
+                info_hashes.append(info_hash)
+                video_file = harness.open_video_file(info_hash)
+                try:
+                    read_size  = 0
+                    start_time = time.time()
+                    while time.time() - start_time < BANDWIDTH_TIME and video_file.tell() < video_file.size:
+                        read_size = read_size + len(video_file.read(READ_CHUNK_SIZE))
+                    results['bandwidth_{0}_viewer_mb_s'.format(mode)] = read_size / (time.time() - start_time) / (1024.0 * 1024.0)
+                finally:
+                    video_file.close()
+            finally:
+                for info_hash in info_hashes:
+                    harness.remove_torrent(info_hash)
+    finally:
+        harness.downloader_monitor.configure_bandwidth({ 'enabled': True, 'max_download_rate': 0 })
+
+    return results
+
+################################################################################
+def bench_seek_latency(harness):
+    generator = random.Random(harness.args.seed)
+    info_hash = harness.add_torrent(harness.args.pieces, harness.args.piece_rate, 'random')
+
+    video_file = harness.open_video_file(info_hash)
+    latencies  = []
+    try:
+        for seek_index in range(harness.args.seeks):
+            offset     = generator.randrange(0, video_file.size - READ_CHUNK_SIZE)
+            start_time = time.time()
+            video_file.seek(offset)
+            video_file.read(READ_CHUNK_SIZE)
+            latencies.append(time.time() - start_time)
+    finally:
+        video_file.close()
+        harness.remove_torrent(info_hash)
+
+    return summarize('seek_first_byte', latencies)
+
+################################################################################
+def bench_prefetch(harness):
+    results = {}
+
+    # Chapter seeks on a slow swarm, announced through /prefetch ahead of time or not at all
+    for mode in ('unhinted', 'hinted'):
+        generator = random.Random(harness.args.seed)
+        info_hash = harness.add_torrent(harness.args.pieces, PREFETCH_RATE)
+
+        video_file = harness.open_video_file(info_hash)
+        latencies  = []
+        try:
+            offsets     = [generator.randrange(video_file.size / 4, video_file.size - READ_CHUNK_SIZE) for seek_index in range(harness.args.prefetch_seeks)]
+            hint_status = harness.downloader_monitor.streaming_scheduler.get_hint_status()
+            if mode == 'hinted':
+                connection = httplib.HTTPConnection('127.0.0.1', harness.http_port, timeout=READY_TIMEOUT)
+                connection.request('GET', '/prefetch?info_hash={0}&ranges={1}'.format(info_hash, ','.join('{0}:{1}'.format(offset, READ_CHUNK_SIZE) for offset in offsets)))
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise RuntimeError('Unexpected /prefetch response {0}: {1}'.format(response.status, response.read()))
+                connection.close()
+            time.sleep(PREFETCH_LEAD)
+
+            for offset in offsets:
+                start_time = time.time()
+                video_file.seek(offset)
+                video_file.read(READ_CHUNK_SIZE)
+                latencies.append(time.time() - start_time)
+        finally:
+            video_file.close()
+            harness.remove_torrent(info_hash)
+
+        results.update(summarize('prefetch_{0}_seek'.format(mode), latencies))
+        if mode == 'hinted':
+            new_hint_status = harness.downloader_monitor.streaming_scheduler.get_hint_status()
+            hints           = new_hint_status['added'] - hint_status['added']
+            results['prefetch_hint_ready_ratio'] = float(new_hint_status['ready_hits'] - hint_status['ready_hits']) / hints if hints else 0.0
+
+    return results
+
+################################################################################
+def time_status(harness, info_hashes):
+    downloader_monitor = harness.downloader_monitor
+    entries            = [downloader_monitor.torrents.get(info_hash) for info_hash in info_hashes]
+
+    rebuild_durations = []
+    get_durations     = []
+    for iteration in range(harness.args.iterations):
+        # Force a fresh snapshot, as if every torrent had changed since the last tick
+        for entry in entries:
+            downloader_monitor.status_cache.torrents.pop(entry.info_hash, None)
+
+        start_time = time.time()
+        for entry in entries:
+            downloader_monitor._update_torrent_status(entry, entry.torrent_handle.status())
+        downloader_monitor._publish_status()
+        rebuild_durations.append(time.time() - start_time)
+
+        start_time = time.time()
+        downloader_monitor.get_status_json()
+        get_durations.append(time.time() - start_time)
+
+    return percentile(rebuild_durations, 0.5), percentile(get_durations, 0.5)
+
+################################################################################
+def bench_status_latency(harness):
+    results = {}
+
+    for piece_count in harness.args.status_pieces:
+        info_hash = harness.add_torrent(piece_count, 0.001, piece_length=16 * 1024)
+        harness.open_video_file(info_hash).close()
+
+        rebuild_duration, get_duration = time_status(harness, [info_hash])
+        results['status_rebuild_{0}_pieces_seconds'.format(piece_count)] = rebuild_duration
+        results['status_get_{0}_pieces_seconds'.format(piece_count)]     = get_duration
+        harness.remove_torrent(info_hash)
+
+    for torrent_count in harness.args.status_torrents:
+        info_hashes = [harness.add_torrent(1024, 0.001, piece_length=16 * 1024) for torrent_index in range(torrent_count)]
+
+        rebuild_duration, get_duration = time_status(harness, info_hashes)
+        results['status_rebuild_{0}_torrents_seconds'.format(torrent_count)] = rebuild_duration
+        results['status_get_{0}_torrents_seconds'.format(torrent_count)]     = get_duration
+        for info_hash in info_hashes:
+            harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def fetch_first_byte(port, info_hash, offset, latencies, errors):
+    start_time = time.time()
+    try:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=READY_TIMEOUT)
+        connection.request('GET', '/video?info_hash={0}'.format(info_hash), headers={ 'Range': 'bytes={0}-'.format(offset) })
+        response = connection.getresponse()
+        if response.status not in (200, 206) or not response.read(1):
+            raise IOError('Unexpected response {0}'.format(response.status))
+        latencies.append(time.time() - start_time)
+        connection.close()
+    except (EnvironmentError, httplib.HTTPException) as error:
+        errors.append(str(error))
+
+################################################################################
+def bench_video_ttfb(harness):
+    results   = {}
+    generator = random.Random(harness.args.seed)
+
+    for client_count in harness.args.clients:
+        info_hash = harness.add_torrent(harness.args.pieces, harness.args.piece_rate, metadata_delay=harness.args.metadata_delay)
+        file_size = (harness.args.pieces * harness.args.piece_length) - 1024
+
+        latencies = []
+        errors    = []
+        threads   = []
+        for client_index in range(client_count):
+            # The first client plays from the start, the others scrub around the file
+            offset = 0 if client_index == 0 else generator.randrange(0, file_size)
+            thread = threading.Thread(target=fetch_first_byte, args=(harness.http_port, info_hash, offset, latencies, errors))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        results.update(summarize('video_ttfb_{0}_clients'.format(client_count), latencies))
+        results['video_errors_{0}_clients'.format(client_count)] = len(errors)
+        harness.remove_torrent(info_hash)
+
+    return results
+
+################################################################################
+def bench_idle_viewers(harness):
+    results = {}
+
+    # Viewers parked on pieces that take ages to arrive, each holding a connection open
+    slow_info_hash = harness.add_torrent(harness.args.pieces, 0.2)
+    fast_info_hash = harness.add_torrent(harness.args.pieces, 10000.0)
+    harness.wait_until_seeding(fast_info_hash)
+    harness.open_video_file(slow_info_hash).close()
+
+    generator = random.Random(harness.args.seed)
+    file_size = (harness.args.pieces * harness.args.piece_length) - 1024
+    viewers   = []
+    errors    = []
+    try:
+        for viewer_index in range(harness.args.idle_viewers):
+            sock = socket.create_connection(('127.0.0.1', harness.http_port), READY_TIMEOUT)
+            sock.sendall('GET /video?info_hash={0} HTTP/1.1\r\nHost: 127.0.0.1\r\nRange: bytes={1}-\r\n\r\n'.format(slow_info_hash, generator.randrange(file_size / 2, file_size)))
+            viewers.append(sock)
+        time.sleep(1.0)
+
+        status_durations = []
+        for iteration in range(harness.args.iterations):
+            start_time = time.time()
+            try:
+                connection = httplib.HTTPConnection('127.0.0.1', harness.http_port, timeout=IDLE_TIMEOUT)
+                connection.request('GET', '/')
+                connection.getresponse().read()
+                connection.close()
+                status_durations.append(time.time() - start_time)
+            except (EnvironmentError, httplib.HTTPException) as error:
+                # Every worker thread is taken, no point queueing more
+                errors.append(str(error))
+                status_durations.append(IDLE_TIMEOUT)
+                break
+
+        latencies = []
+        fetch_first_byte(harness.http_port, fast_info_hash, 0, latencies, errors)
+    finally:
+        for sock in viewers:
+            sock.close()
+        harness.remove_torrent(slow_info_hash)
+        harness.remove_torrent(fast_info_hash)
+
+    results.update(summarize('idle_viewers_status', status_durations))
+    results['idle_viewers_ttfb_seconds']  = latencies[0] if latencies else IDLE_TIMEOUT
+    results['video_errors_idle_viewers'] = len(errors)
+    return results
+
+################################################################################
+def bench_removal(harness):
+    results = {}
+
+    for torrent_count in harness.args.removal_torrents:
+        info_hashes = [harness.add_torrent(64, 1000.0, piece_length=16 * 1024) for torrent_index in range(torrent_count)]
+        for info_hash in info_hashes:
+            harness.downloader_monitor.wait_for_video_file_ready(info_hash, True, READY_TIMEOUT)
+
+        # Covers removal from the session and deletion of the downloaded files
+        start_time = time.time()
+        for info_hash in info_hashes:
+            harness.remove_torrent(info_hash)
+        harness.downloader_monitor.removal_queue.wait(READY_TIMEOUT)
+        results['removal_{0}_torrents_seconds'.format(torrent_count)] = time.time() - start_time
+
+    return results
+
+################################################################################
+def bench_cold_start(harness):
+    results = {}
+
+    # A magnet added right after a restart, with the DHT bootstrapping from scratch or from the state saved on stop
+    fake_libtorrent.DHT_BOOTSTRAP_DELAY = harness.args.dht_bootstrap_delay
+    try:
+        for mode in ('cold', 'warm'):
+            start_time = harness.restart_session(mode == 'cold')
+            info_hash  = harness.add_torrent(harness.args.pieces, harness.args.piece_rate, metadata_delay=harness.args.metadata_delay)
+            try:
+                if not harness.downloader_monitor.wait_for_video_file_ready(info_hash, True, READY_TIMEOUT):
+                    raise RuntimeError('Torrent {0} never became ready'.format(info_hash))
+                results['cold_start_{0}_ready_seconds'.format(mode)]   = time.time() - start_time
+                results['cold_start_{0}_session_seconds'.format(mode)] = harness.downloader_monitor.startup['seconds']
+            finally:
+                harness.remove_torrent(info_hash)
+    finally:
+        fake_libtorrent.DHT_BOOTSTRAP_DELAY = 0.0
+
+    return results
+
+################################################################################
+BENCHMARKS = [ ('read_throughput', bench_read_throughput),
+               ('shared_read',     bench_shared_read),
+               ('buffered_ready',  bench_buffered_ready),
+               ('season_pack',     bench_season_pack),
+               ('index_fetch',     bench_index_fetch),
+               ('bandwidth',       bench_bandwidth),
+               ('seek_latency',    bench_seek_latency),
+               ('prefetch',        bench_prefetch),
+               ('status_latency',  bench_status_latency),
+               ('video_ttfb',      bench_video_ttfb),
+               ('idle_viewers',    bench_idle_viewers),
+               ('removal',         bench_removal),
+               ('cold_start',      bench_cold_start) ]
+
+################################################################################
+def compare(baseline, results, threshold):
+    regressions = []
+    for name, value in sorted(results['results'].iteritems()):
+        baseline_value = baseline['results'].get(name)
+        if baseline_value is None:
+            continue
+
+        if name.startswith('video_errors'):
+            # Any failed request is a regression, whatever the threshold
+            regressed = value > baseline_value
+            print('{0:<45} {1:>12d} {2:>12d} {3:>+8d}{4}'.format(name, baseline_value, value, value - baseline_value, '  REGRESSION' if regressed else ''))
+        elif baseline_value:
+            change = (value - baseline_value) / float(baseline_value)
+            if name.endswith('_seconds'):
+                regressed = change > threshold
+            else:
+                regressed = change < -threshold
+            print('{0:<45} {1:>12.6f} {2:>12.6f} {3:>+8.1%}{4}'.format(name, baseline_value, value, change, '  REGRESSION' if regressed else ''))
+        else:
+            continue
+
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+################################################################################
+def main():
+    arg_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('-o',  '--output', help='Write the JSON results to this file instead of stdout')
+    arg_parser.add_argument('-c',  '--compare', help='Compare against a previous JSON result file, exit with 1 on regressions')
+    arg_parser.add_argument('-t',  '--threshold', type=float, default=0.25, help='Relative change considered a regression when comparing')
+    arg_parser.add_argument('-b',  '--benchmark', action='append', choices=[name for name, function in BENCHMARKS], help='Benchmark to run, may be repeated, all by default')
+    arg_parser.add_argument('-s',  '--seed', type=int, default=0, help='Seed used for piece orders and seek offsets')
+    arg_parser.add_argument('-pl', '--piece-length', type=int, default=256 * 1024, help='Piece length in bytes')
+    arg_parser.add_argument('-p',  '--pieces', type=int, default=256, help='Pieces in the video file of the read, seek and /video benchmarks')
+    arg_parser.add_argument('-pr', '--piece-rate', type=float, default=200.0, help='Pieces per second delivered by the simulated swarm')
+    arg_parser.add_argument('-md', '--metadata-delay', type=float, default=0.5, help='Seconds before the simulated swarm delivers the metadata')
+    arg_parser.add_argument('-db', '--dht-bootstrap-delay', type=float, default=3.0, help='Seconds the simulated DHT needs to find its first nodes when started without saved state')
+    arg_parser.add_argument('-vd', '--video-duration', type=float, default=120.0, help='Duration in seconds written in the header of the simulated video files')
+    arg_parser.add_argument('-sk', '--seeks', type=int, default=50, help='Random seeks performed by the seek benchmark')
+    arg_parser.add_argument('-ps', '--prefetch-seeks', type=int, default=8, help='Seeks announced through /prefetch by the prefetch benchmark')
+    arg_parser.add_argument('-i',  '--iterations', type=int, default=20, help='Iterations of each status measurement')
+    arg_parser.add_argument('-sp', '--status-pieces', type=int, nargs='+', default=[256, 1024, 4096, 16384], help='Piece counts of the status benchmark')
+    arg_parser.add_argument('-st', '--status-torrents', type=int, nargs='+', default=[1, 10, 50], help='Torrent counts of the status benchmark')
+    arg_parser.add_argument('-rt', '--removal-torrents', type=int, nargs='+', default=[1, 10, 50], help='Torrent counts of the removal benchmark')
+    arg_parser.add_argument('-sr', '--shared-readers', type=int, nargs='+', default=[1, 4, 16], help='Concurrent reader counts of the shared read benchmark')
+    arg_parser.add_argument('-pc', '--piece-cache-size', type=int, default=64, help='Memory in MB of the shared piece cache, 0 = Disabled')
+    arg_parser.add_argument('-bt', '--bandwidth-torrents', type=int, default=4, help='Unwatched torrents competing with the viewer of the bandwidth benchmark')
+    arg_parser.add_argument('-n',  '--clients', type=int, nargs='+', default=[1, 4, 16], help='Concurrent client counts of the /video benchmark')
+    arg_parser.add_argument('-iv', '--idle-viewers', type=int, default=200, help='Viewers waiting on slow pieces during the idle viewers benchmark')
+    arg_parser.add_argument('-hm', '--http-mode', choices=['threaded', 'asyncio'], default='threaded', help='HTTP server the /video benchmarks go through')
+    arg_parser.add_argument('-v',  '--verbose', action='store_true', help='Show the cherrytorrent log')
+    args = arg_parser.parse_args()
+
+    harness = Harness(args)
+    harness.start()
+
+    results = {}
+    try:
+        for name, function in BENCHMARKS:
+            if not args.benchmark or name in args.benchmark:
+                sys.stderr.write('Running {0}...\n'.format(name))
+                results.update(function(harness))
+    finally:
+        harness.stop()
+
+    output = { 'revision': get_revision(), 'python': platform.python_version(), 'timestamp': time.time(), 'config': vars(args), 'results': results }
+    output_json = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output_json + '\n')
+    else:
+        print(output_json)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), output, args.threshold):
+                sys.exit(1)
+
+################################################################################
+if __name__ == '__main__':
+    main()
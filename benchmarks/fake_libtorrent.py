@@ -0,0 +1,741 @@
+################################################################################
+# Deterministic stand-in for the parts of the libtorrent python bindings used by
+# cherrytorrent. Pieces "arrive" from a simulated swarm at a configurable rate
+# and in a configurable order, and are written to sparse files on disk.
+################################################################################
+import hashlib
+import os
+import random
+import threading
+import time
+
+################################################################################
+SWARMS = {}
+
+# Seconds a DHT started without saved state needs to find its first nodes, magnets get no metadata before
+DHT_BOOTSTRAP_DELAY = 0.0
+DHT_BOOTSTRAP_NODES = 100
+
+################################################################################
+def register_swarm(ti, piece_rate=100.0, order='sequential', metadata_delay=0.0, seed=0, contents=()):
+    # contents lists (offset, data) written over the generated torrent data, e.g. container headers
+    SWARMS[str(ti.info_hash())] = { 'ti': ti, 'piece_rate': piece_rate, 'order': order, 'metadata_delay': metadata_delay, 'seed': seed, 'contents': contents }
+
+################################################################################
+def make_torrent_info(name, file_sizes, piece_length):
+    files = [{ 'path': [file_name], 'length': size } for file_name, size in file_sizes]
+    info  = { 'name': name, 'piece length': piece_length, 'files': files }
+    return torrent_info({ 'info': info })
+
+################################################################################
+def piece_data(info_hash, piece_index, size):
+    pattern = hashlib.sha1('{0}:{1}'.format(info_hash, piece_index).encode('ascii')).digest()
+    data    = (pattern * (size // len(pattern) + 1))[:size]
+
+    swarm = SWARMS.get(info_hash)
+    if swarm:
+        piece_offset = piece_index * swarm['ti'].piece_length()
+        for offset, content in swarm['contents']:
+            start = max(offset, piece_offset)
+            end   = min(offset + len(content), piece_offset + size)
+            if start < end:
+                data = data[:start - piece_offset] + content[start - offset:end - offset] + data[end - piece_offset:]
+    return data
+
+################################################################################
+# Bencoding
+################################################################################
+def bencode(value):
+    if isinstance(value, bool) or isinstance(value, int) or isinstance(value, long):
+        return b'i' + str(int(value)).encode('ascii') + b'e'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return str(len(value)).encode('ascii') + b':' + value
+    if isinstance(value, (list, tuple)):
+        return b'l' + b''.join(bencode(item) for item in value) + b'e'
+    if isinstance(value, dict):
+        return b'd' + b''.join(bencode(key) + bencode(value[key]) for key in sorted(value)) + b'e'
+    raise TypeError('Cannot bencode {0!r}'.format(value))
+
+################################################################################
+def bdecode(data):
+    try:
+        value, offset = _bdecode(data, 0)
+        return value
+    except (IndexError, ValueError):
+        return None
+
+################################################################################
+def _bdecode(data, offset):
+    token = data[offset:offset + 1]
+    if token == b'i':
+        end = data.index(b'e', offset)
+        return int(data[offset + 1:end]), end + 1
+    if token == b'l':
+        result, offset = [], offset + 1
+        while data[offset:offset + 1] != b'e':
+            item, offset = _bdecode(data, offset)
+            result.append(item)
+        return result, offset + 1
+    if token == b'd':
+        result, offset = {}, offset + 1
+        while data[offset:offset + 1] != b'e':
+            key, offset   = _bdecode(data, offset)
+            item, offset  = _bdecode(data, offset)
+            result[key]   = item
+        return result, offset + 1
+    colon  = data.index(b':', offset)
+    length = int(data[offset:colon])
+    return data[colon + 1:colon + 1 + length], colon + 1 + length
+
+################################################################################
+# Enumerations
+################################################################################
+class _Enum(int):
+    def __new__(cls, value, name):
+        result      = int.__new__(cls, value)
+        result.name = name
+        return result
+
+    def __str__(self):
+        return self.name
+
+################################################################################
+class alert_category_t:
+    error_notification    = 0x1
+    peer_notification     = 0x2
+    port_mapping_notification = 0x4
+    storage_notification  = 0x8
+    tracker_notification  = 0x10
+    debug_notification    = 0x20
+    status_notification   = 0x40
+    progress_notification = 0x80
+    all_categories        = 0xffffffff
+
+class storage_mode_t:
+    storage_mode_allocate = 0
+    storage_mode_sparse   = 1
+
+class options_t:
+    none         = 0
+    delete_files = 1
+
+class enc_policy(int):
+    forced   = 0
+    enabled  = 1
+    disabled = 2
+
+class enc_level:
+    plaintext = 1
+    rc4       = 2
+    both      = 3
+
+class pe_settings:
+    pass
+
+class session_settings:
+    pass
+
+################################################################################
+class torrent_status_states:
+    queued_for_checking  = _Enum(0, 'queued_for_checking')
+    checking_files       = _Enum(1, 'checking_files')
+    downloading_metadata = _Enum(2, 'downloading_metadata')
+    downloading          = _Enum(3, 'downloading')
+    finished             = _Enum(4, 'finished')
+    seeding              = _Enum(5, 'seeding')
+
+################################################################################
+# Metadata
+################################################################################
+class sha1_hash:
+    def __init__(self, hex_digest):
+        self.hex_digest = hex_digest
+
+    def __str__(self):
+        return self.hex_digest
+
+    def __eq__(self, other):
+        return isinstance(other, sha1_hash) and self.hex_digest == other.hex_digest
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.hex_digest)
+
+class file_entry:
+    def __init__(self, path, size, offset):
+        self.path   = path
+        self.size   = size
+        self.offset = offset
+
+class torrent_info:
+    def __init__(self, metadata):
+        if metadata is None or b'info' not in metadata and 'info' not in metadata:
+            raise RuntimeError('invalid torrent file')
+
+        self.info       = metadata.get('info', metadata.get(b'info'))
+        self.hash       = sha1_hash(hashlib.sha1(bencode(self.info)).hexdigest())
+        self.trackers_  = []
+        self.files_     = []
+
+        offset = 0
+        for file_dict in self.info['files']:
+            path = os.path.join(self.info['name'], *file_dict['path'])
+            self.files_.append(file_entry(path, file_dict['length'], offset))
+            offset = offset + file_dict['length']
+        self.total_size_ = offset
+
+    def info_hash(self):
+        return self.hash
+
+    def name(self):
+        return self.info['name']
+
+    def piece_length(self):
+        return self.info['piece length']
+
+    def num_pieces(self):
+        return (self.total_size_ + self.piece_length() - 1) // self.piece_length()
+
+    def piece_size(self, piece_index):
+        return min(self.piece_length(), self.total_size_ - piece_index * self.piece_length())
+
+    def total_size(self):
+        return self.total_size_
+
+    def files(self):
+        return list(self.files_)
+
+    def trackers(self):
+        return list(self.trackers_)
+
+class create_torrent:
+    def __init__(self, ti):
+        self.ti = ti
+
+    def generate(self):
+        return { 'info': self.ti.info }
+
+################################################################################
+# Alerts
+################################################################################
+class alert:
+    category_t = alert_category_t
+
+    def what(self):
+        return self.__class__.__name__
+
+    def message(self):
+        return self.what()
+
+    def category(self):
+        return alert_category_t.status_notification
+
+class torrent_alert(alert):
+    def __init__(self, handle):
+        self.handle = handle
+
+class piece_finished_alert(torrent_alert):
+    def __init__(self, handle, piece_index):
+        torrent_alert.__init__(self, handle)
+        self.piece_index = piece_index
+
+    def category(self):
+        return alert_category_t.progress_notification
+
+class metadata_received_alert(torrent_alert): pass
+class metadata_failed_alert(torrent_alert): pass
+class torrent_checked_alert(torrent_alert): pass
+class torrent_finished_alert(torrent_alert): pass
+class torrent_removed_alert(torrent_alert):
+    def __init__(self, handle):
+        torrent_alert.__init__(self, handle)
+        self.info_hash = handle.info_hash()
+
+class torrent_deleted_alert(torrent_alert):
+    def __init__(self, handle):
+        torrent_alert.__init__(self, handle)
+        self.info_hash = handle.info_hash()
+
+class torrent_delete_failed_alert(torrent_alert):
+    def __init__(self, handle):
+        torrent_alert.__init__(self, handle)
+        self.info_hash = handle.info_hash()
+class save_resume_data_failed_alert(torrent_alert): pass
+
+class state_changed_alert(torrent_alert):
+    def __init__(self, handle, state, prev_state):
+        torrent_alert.__init__(self, handle)
+        self.state      = state
+        self.prev_state = prev_state
+
+class save_resume_data_alert(torrent_alert):
+    def __init__(self, handle, resume_data):
+        torrent_alert.__init__(self, handle)
+        self.resume_data = resume_data
+
+class state_update_alert(alert):
+    def __init__(self, status):
+        self.status = status
+
+class read_piece_alert(torrent_alert):
+    def __init__(self, handle, piece, buffer, size):
+        torrent_alert.__init__(self, handle)
+        self.piece  = piece
+        self.buffer = buffer
+        self.size   = size
+
+class cache_flushed_alert(torrent_alert): pass
+class external_ip_alert(alert): pass
+class hash_failed_alert(torrent_alert): pass
+class tracker_error_alert(torrent_alert): pass
+
+################################################################################
+# Torrents
+################################################################################
+class torrent_status:
+    states = torrent_status_states
+
+class torrent_handle:
+    ############################################################################
+    def __init__(self, session, info_hash, save_path, ti, swarm):
+        self.session_     = session
+        self.hash         = sha1_hash(info_hash)
+        self.save_path_   = save_path
+        self.ti           = ti
+        self.swarm        = swarm
+        self.lock         = threading.Lock()
+        self.valid        = True
+        self.removed      = threading.Event()
+        self.paused       = False
+        self.sequential   = False
+        self.state        = torrent_status_states.downloading_metadata if ti is None else torrent_status_states.downloading
+        self.pieces       = []
+        self.priorities   = []
+        self.deadlines    = {}
+        self.downloaded   = 0
+        self.rate_samples = []
+        self.download_limit_   = 0
+        self.max_connections_  = -1
+        self.file_priorities_  = []
+        self.thread       = threading.Thread(target=self._download)
+        self.thread.daemon = True
+        self.random       = random.Random(swarm['seed'] if swarm else 0)
+        if ti is not None:
+            self._init_pieces()
+
+    ############################################################################
+    def __eq__(self, other):
+        return isinstance(other, torrent_handle) and self.hash == other.hash
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    ############################################################################
+    def _check_valid(self):
+        if not self.valid:
+            raise RuntimeError('invalid torrent handle used')
+
+    def _init_pieces(self):
+        self.pieces          = [False] * self.ti.num_pieces()
+        self.priorities      = [1] * self.ti.num_pieces()
+        self.file_priorities_ = [1] * len(self.ti.files())
+
+    ############################################################################
+    def info_hash(self):
+        return self.hash
+
+    def name(self):
+        return self.ti.name() if self.ti else str(self.hash)
+
+    def save_path(self):
+        return self.save_path_
+
+    def has_metadata(self):
+        self._check_valid()
+        return self.ti is not None
+
+    def get_torrent_info(self):
+        self._check_valid()
+        if self.ti is None:
+            raise RuntimeError('torrent has no metadata')
+        return self.ti
+
+    def is_valid(self):
+        return self.valid
+
+    ############################################################################
+    def status(self):
+        self._check_valid()
+        with self.lock:
+            result                = torrent_status()
+            result.handle         = self
+            result.paused         = self.paused
+            result.state          = self.state
+            result.has_metadata   = self.ti is not None
+            result.pieces         = list(self.pieces)
+            result.progress       = float(sum(self.pieces)) / len(self.pieces) if self.pieces else 0.0
+            result.download_rate  = self._download_rate()
+            result.upload_rate    = 0
+            result.num_seeds      = 10
+            result.num_complete   = 100
+            result.num_peers      = 20
+            result.num_incomplete = 200
+            result.total_wanted   = self.ti.total_size() if self.ti else 0
+            result.total_done     = self.downloaded
+            return result
+
+    def _download_rate(self):
+        now = time.time()
+        self.rate_samples = [(timestamp, size) for timestamp, size in self.rate_samples if now - timestamp < 5.0]
+        return int(sum(size for timestamp, size in self.rate_samples) / 5.0)
+
+    ############################################################################
+    def have_piece(self, piece_index):
+        self._check_valid()
+        return 0 <= piece_index < len(self.pieces) and self.pieces[piece_index]
+
+    def piece_priority(self, piece_index, priority=None):
+        self._check_valid()
+        with self.lock:
+            if priority is None:
+                return self.priorities[piece_index]
+            self.priorities[piece_index] = priority
+
+    def piece_priorities(self):
+        self._check_valid()
+        with self.lock:
+            return list(self.priorities)
+
+    def prioritize_pieces(self, priorities):
+        with self.lock:
+            self.priorities = list(priorities)
+
+    def file_priorities(self):
+        with self.lock:
+            return list(self.file_priorities_)
+
+    def prioritize_files(self, priorities):
+        with self.lock:
+            self.file_priorities_ = list(priorities)
+            for file_index, file in enumerate(self.ti.files()):
+                first_piece = file.offset // self.ti.piece_length()
+                last_piece  = (file.offset + max(file.size, 1) - 1) // self.ti.piece_length()
+                for piece_index in range(first_piece, last_piece + 1):
+                    self.priorities[piece_index] = priorities[file_index]
+            # Pieces shared with a wanted file stay wanted
+            for file_index, file in enumerate(self.ti.files()):
+                if priorities[file_index] > 0:
+                    first_piece = file.offset // self.ti.piece_length()
+                    last_piece  = (file.offset + max(file.size, 1) - 1) // self.ti.piece_length()
+                    for piece_index in range(first_piece, last_piece + 1):
+                        self.priorities[piece_index] = max(self.priorities[piece_index], priorities[file_index])
+
+    def set_piece_deadline(self, piece_index, deadline, flags=0):
+        with self.lock:
+            self.deadlines[piece_index] = time.time() + deadline / 1000.0
+            self.priorities[piece_index] = 7
+
+    def reset_piece_deadline(self, piece_index):
+        with self.lock:
+            self.deadlines.pop(piece_index, None)
+
+    def set_sequential_download(self, sequential):
+        self.sequential = sequential
+
+    def set_download_limit(self, limit):
+        self.download_limit_ = limit
+
+    def download_limit(self):
+        return self.download_limit_
+
+    def set_max_connections(self, max_connections):
+        self.max_connections_ = max_connections
+
+    def max_connections(self):
+        return self.max_connections_
+
+    def add_tracker(self, tracker):
+        pass
+
+    def flush_cache(self):
+        pass
+
+    def read_piece(self, piece_index):
+        data = piece_data(str(self.hash), piece_index, self.ti.piece_size(piece_index))
+        self.session_._post(read_piece_alert(self, piece_index, data, len(data)))
+
+    ############################################################################
+    def resume(self):
+        self._check_valid()
+        self.paused = False
+        if not self.thread.is_alive() and self.valid:
+            try:
+                self.thread.start()
+            except RuntimeError:
+                pass
+
+    def pause(self):
+        self._check_valid()
+        self.paused = True
+
+    def need_save_resume_data(self):
+        return True
+
+    def save_resume_data(self, flags=0):
+        resume_data = { 'save_path': self.save_path_, 'pieces': ''.join('\x01' if have else '\x00' for have in self.pieces) }
+        self.session_._post(save_resume_data_alert(self, resume_data))
+
+    ############################################################################
+    def _set_state(self, state):
+        previous_state, self.state = self.state, state
+        self.session_._post(state_changed_alert(self, state, previous_state))
+
+    def _download(self):
+        swarm = self.swarm
+        if swarm is None:
+            return
+
+        if self.ti is None:
+            while not self.session_._dht_ready() and self.valid:
+                time.sleep(0.01)
+            time.sleep(swarm['metadata_delay'])
+            if not self.valid:
+                return
+            with self.lock:
+                self.ti = swarm['ti']
+                self._init_pieces()
+            self.session_._post(metadata_received_alert(self))
+            self._set_state(torrent_status_states.downloading)
+
+        interval = 1.0 / swarm['piece_rate']
+        while self.valid:
+            if self.paused:
+                time.sleep(0.01)
+                continue
+            if self.state == torrent_status_states.seeding:
+                # Finished torrents start again once more pieces are wanted, e.g. another file got selected
+                if self._pick_piece() is None:
+                    time.sleep(0.01)
+                    continue
+                self._set_state(torrent_status_states.downloading)
+
+            piece_index = self._pick_piece()
+            if piece_index is None:
+                self._set_state(torrent_status_states.seeding)
+                self.session_._post(torrent_finished_alert(self))
+                continue
+
+            # Removal cuts the transfer short, only pieces received in full reach the disk
+            if self.removed.wait(interval):
+                return
+            if self.download_limit_ > 0 and self.removed.wait(float(self.ti.piece_size(piece_index)) / self.download_limit_):
+                return
+            self.session_._transfer(self.ti.piece_size(piece_index))
+
+            # A received piece is queued for the disk, it is written even if the torrent got removed meanwhile
+            self._write_piece(piece_index)
+            if not self.valid:
+                return
+            with self.lock:
+                self.pieces[piece_index] = True
+                self.deadlines.pop(piece_index, None)
+                self.downloaded = self.downloaded + self.ti.piece_size(piece_index)
+                self.rate_samples.append((time.time(), self.ti.piece_size(piece_index)))
+            self.session_._post(piece_finished_alert(self, piece_index))
+
+    def _pick_piece(self):
+        with self.lock:
+            if self.deadlines:
+                return min(self.deadlines, key=self.deadlines.get)
+
+            wanted = [piece_index for piece_index, have in enumerate(self.pieces) if not have and self.priorities[piece_index] > 0]
+            if not wanted:
+                return None
+            if self.swarm['order'] == 'random' and not self.sequential:
+                return self.random.choice(wanted)
+            if self.swarm['order'] == 'reverse':
+                return wanted[-1]
+            return max(wanted, key=lambda piece_index: (self.priorities[piece_index], -piece_index))
+
+    def _write_piece(self, piece_index):
+        piece_length = self.ti.piece_length()
+        data         = piece_data(str(self.hash), piece_index, self.ti.piece_size(piece_index))
+        piece_start  = piece_index * piece_length
+        piece_end    = piece_start + len(data)
+
+        for file in self.ti.files():
+            start = max(piece_start, file.offset)
+            end   = min(piece_end, file.offset + file.size)
+            if start >= end:
+                continue
+
+            path = os.path.join(self.save_path_, file.path)
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            with open(path, 'r+b' if os.path.isfile(path) else 'wb') as f:
+                f.truncate(file.size)
+                f.seek(start - file.offset)
+                f.write(data[start - piece_start:end - piece_start])
+
+################################################################################
+# Session
+################################################################################
+class session:
+    ############################################################################
+    def __init__(self, *args):
+        self.handles   = {}
+        self.alerts    = []
+        self.condition = threading.Condition()
+        self.settings_ = session_settings()
+        self.dht_nodes = []
+        self.dht_ready = None
+        self.link_lock = threading.Lock()
+        self.link_free = 0.0
+
+    ############################################################################
+    def _transfer(self, size):
+        # All torrents share one link when the session download rate is limited
+        download_rate_limit = getattr(self.settings_, 'download_rate_limit', 0)
+        if download_rate_limit <= 0:
+            return
+
+        with self.link_lock:
+            start          = max(time.time(), self.link_free)
+            self.link_free = start + float(size) / download_rate_limit
+            end            = self.link_free
+        time.sleep(max(0.0, end - time.time()))
+
+    ############################################################################
+    def _post(self, alert):
+        with self.condition:
+            self.alerts.append(alert)
+            self.condition.notify_all()
+
+    def wait_for_alert(self, milliseconds):
+        with self.condition:
+            if not self.alerts:
+                self.condition.wait(milliseconds / 1000.0)
+            return self.alerts[0] if self.alerts else None
+
+    def pop_alert(self):
+        with self.condition:
+            return self.alerts.pop(0) if self.alerts else None
+
+    def pop_alerts(self):
+        with self.condition:
+            alerts, self.alerts = self.alerts, []
+            return alerts
+
+    def set_alert_mask(self, mask):
+        pass
+
+    ############################################################################
+    def add_torrent(self, params):
+        ti = params.get('ti')
+        if ti is not None:
+            info_hash = str(ti.info_hash())
+        else:
+            uri       = params['url']
+            info_hash = uri.split('xt=urn:btih:')[1][:40].lower()
+
+        if info_hash in self.handles:
+            return self.handles[info_hash]
+
+        swarm  = SWARMS.get(info_hash)
+        handle = torrent_handle(self, info_hash, params['save_path'], ti, swarm)
+
+        resume_data = bdecode(params['resume_data']) if params.get('resume_data') else None
+        if resume_data and ti is not None:
+            handle.pieces = [piece == '\x01' for piece in resume_data['pieces']]
+
+        self.handles[info_hash] = handle
+        if ti is not None:
+            self._post(torrent_checked_alert(handle))
+        return handle
+
+    def remove_torrent(self, handle, flags=0):
+        handle.valid = False
+        handle.removed.set()
+        self.handles.pop(str(handle.info_hash()), None)
+        self._post(torrent_removed_alert(handle))
+        if flags & options_t.delete_files:
+            threading.Thread(target=self._delete_files, args=(handle,)).start()
+
+    def _delete_files(self, handle):
+        # Like the disk thread, files go once the writes queued before the removal are done
+        if handle.thread.ident is not None:
+            handle.thread.join()
+        if handle.ti is not None:
+            for file in handle.ti.files():
+                try:
+                    os.remove(os.path.join(handle.save_path_, file.path))
+                except OSError:
+                    pass
+        self._post(torrent_deleted_alert(handle))
+
+    def find_torrent(self, info_hash):
+        return self.handles.get(str(info_hash))
+
+    def get_torrents(self):
+        return list(self.handles.values())
+
+    def post_torrent_updates(self):
+        self._post(state_update_alert([handle.status() for handle in list(self.handles.values()) if handle.valid]))
+
+    ############################################################################
+    def settings(self):
+        return self.settings_
+
+    def set_settings(self, settings):
+        self.settings_ = settings
+
+    def set_pe_settings(self, settings):
+        pass
+
+    def listen_on(self, start_port, end_port):
+        pass
+
+    def listen_port(self):
+        return 0
+
+    def save_state(self, flags=0xffffffff):
+        return { 'dht state': { 'nodes': list(self.dht_nodes) } }
+
+    def load_state(self, state):
+        self.dht_nodes = list(state.get('dht state', {}).get('nodes', []))
+
+    def status(self):
+        result           = session_settings()
+        result.dht_nodes = len(self.dht_nodes) if self._dht_ready() else 0
+        return result
+
+    def start_dht(self, *args):
+        # Known nodes answer right away, otherwise the routing table fills up after the bootstrap delay
+        self.dht_ready = time.time() + (0.0 if self.dht_nodes else DHT_BOOTSTRAP_DELAY)
+
+    def stop_dht(self):
+        self.dht_ready = None
+
+    def _dht_ready(self):
+        if self.dht_ready is None or time.time() < self.dht_ready:
+            return False
+        if not self.dht_nodes:
+            self.dht_nodes = ['10.0.{0}.{1}:6881'.format(index / 256, index % 256) for index in range(DHT_BOOTSTRAP_NODES)]
+        return True
+
+    def start_lsd(self): pass
+    def stop_lsd(self): pass
+    def start_upnp(self): pass
+    def stop_upnp(self): pass
+    def start_natpmp(self): pass
+    def stop_natpmp(self): pass
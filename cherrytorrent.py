@@ -7,24 +7,38 @@ import logging
 def main():
     arg_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     arg_parser.add_argument('-hp',  '--http-port', type=int, default=8080, help='Port used for HTTP server')
+    arg_parser.add_argument('-hm',  '--http-mode', choices=['threaded', 'asyncio'], default='threaded', help='Serve HTTP from a thread pool or from an asyncio event loop, asyncio needs trollius on Python 2')
     arg_parser.add_argument('-tp',  '--torrent-port', type=int, default=6900, help='Port used for BitTorrent incoming connections')
     arg_parser.add_argument('-tdl', '--torrent-download-rate', type=int, default=0, help='Maximum download rate in kB/s, 0 = Unlimited')
     arg_parser.add_argument('-tul', '--torrent-upload-rate', type=int, default=0, help='Maximum upload rate in kB/s, 0 = Unlimited')
     arg_parser.add_argument('-tk',  '--torrent-keep-files', dest='torrent_keep_files', action='store_true', help='Keep downloaded files upon stopping')
+    arg_parser.add_argument('-ts',  '--torrent-state-dir', default='.cherrytorrent', help='Directory used to store torrent metadata and resume data')
+    arg_parser.add_argument('-tc',  '--torrent-cache-size', type=int, default=0, help='Disk quota in MB for torrents kept after their last viewer left, 0 = Disabled')
+    arg_parser.add_argument('-tcp', '--torrent-cache-policy', choices=['lru', 'lfu'], default='lru', help='Order in which cached torrents are evicted')
+    arg_parser.add_argument('-pc',  '--piece-cache-size', type=int, default=64, help='Memory in MB used to cache the pieces being streamed, 0 = Disabled')
+    arg_parser.add_argument('-sh',  '--shards', type=int, default=0, help='Number of worker processes torrents are spread over, each listening on the following HTTP and BitTorrent ports, 0 = Single process')
     args = arg_parser.parse_args()
 
     http_config    = {
                         'port':     args.http_port,
+                        'mode':     args.http_mode,
                      }
 
     torrent_config = {
                         'port':                 args.torrent_port,
                         'max_download_rate':    args.torrent_download_rate,
                         'max_upload_rate':      args.torrent_upload_rate,
-                        'keep_files':           args.torrent_keep_files
+                        'keep_files':           args.torrent_keep_files,
+                        'state_dir':            args.torrent_state_dir,
+                        'cache_size':           args.torrent_cache_size,
+                        'cache_policy':         args.torrent_cache_policy,
+                        'piece_cache_size':     args.piece_cache_size
                      }
     
-    server = cherrytorrent.Server(http_config, torrent_config)
+    if args.shards > 0:
+        server = cherrytorrent.ShardServer(http_config, torrent_config, args.shards)
+    else:
+        server = cherrytorrent.Server(http_config, torrent_config)
     server.run()
 
 ################################################################################
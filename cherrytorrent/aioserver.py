@@ -0,0 +1,674 @@
+################################################################################
+import downloader
+import json
+import metrics
+import os
+import time
+import urlparse
+import utils
+
+from cherrypy.lib import httputil
+from filewrapper import READAHEAD_PIECES
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2 backport
+    import trollius as asyncio
+
+################################################################################
+VIDEO_READY_TIMEOUT = 20.0
+READY_MAX_TIMEOUT   = 60.0
+READY_POLL_INTERVAL = 0.25
+PIECE_WAIT_TIMEOUT  = 120.0
+FILE_POLL_INTERVAL  = 0.1
+IDLE_TIMEOUT        = 60.0
+MAX_HEADER_SIZE     = 64 * 1024
+CHUNK_SIZE          = 256 * 1024
+READ_BUDGET         = 1024 * 1024
+
+STATUS_REASONS = { 200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 307: 'Temporary Redirect', 400: 'Bad Request', 404: 'Not Found',
+                   405: 'Method Not Allowed', 416: 'Requested Range Not Satisfiable', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error' }
+
+################################################################################
+class AsyncHttpServer:
+    ############################################################################
+    def __init__(self, bus, http_config, host='0.0.0.0'):
+        self.bus         = bus
+        self.http_config = http_config
+        self.host        = host
+        self.loop        = None
+        self.stopping    = False
+        self.connections = set()
+        self.handlers    = { '/':          self._index,
+                             '/status':    self._status,
+                             '/add':       self._add,
+                             '/video':     self._video,
+                             '/ready':     self._ready,
+                             '/prefetch':  self._prefetch,
+                             '/bandwidth': self._bandwidth,
+                             '/metrics':   self._metrics,
+                             '/shutdown':  self._shutdown }
+
+        self.bus.subscribe('stop', self.stop)
+
+    ############################################################################
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        server = self.loop.run_until_complete(self.loop.create_server(lambda: HttpConnection(self), self.host, self.http_config['port']))
+        self.bus.log('[AsyncHttpServer] Serving on {0}:{1}'.format(self.host, self.http_config['port']))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            for connection in list(self.connections):
+                connection.abort()
+
+            # One more round so that aborted connections close their streams
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+            self.loop.close()
+            self.bus.log('[AsyncHttpServer] Stopped')
+
+    ############################################################################
+    def stop(self):
+        if self.loop and not self.stopping:
+            self.stopping = True
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    ############################################################################
+    def handle(self, connection, request):
+        handler = self.handlers.get(request.path)
+        if not handler:
+            connection.send_response(request, 404, body='Nothing matches the given URI')
+            return
+
+        try:
+            handler(connection, request)
+        except KeyError as error:
+            connection.send_response(request, 400, body='Missing parameter {0}'.format(error))
+        except ValueError as error:
+            connection.send_response(request, 400, body=str(error))
+        except RuntimeError:
+            connection.send_response(request, 404, body='Unknown torrent')
+        except Exception:
+            self.bus.log('[AsyncHttpServer] Request to {0} failed'.format(request.path), traceback=True)
+            connection.send_server_error(request)
+
+    ############################################################################
+    def _index(self, connection, request):
+        status_json, etag = self.bus.downloader_monitor.get_status_json()
+
+        if request.headers.get('if-none-match') == etag:
+            connection.send_response(request, 304, { 'ETag': etag })
+        else:
+            connection.send_response(request, 200, { 'ETag': etag, 'Content-Type': 'application/json' }, status_json)
+
+    ############################################################################
+    def _status(self, connection, request):
+        status_delta = self.bus.downloader_monitor.get_status_delta(int(request.parameters.get('since', 0)))
+        connection.send_response(request, 200, { 'Content-Type': 'application/json' }, json.dumps(status_delta))
+
+    ############################################################################
+    def _add(self, connection, request):
+        # Adding touches the disk and the session, kept off the event loop
+        future = self.loop.run_in_executor(None, self.bus.downloader_monitor.add_torrent, request.parameters['uri'], request.parameters.get('download_dir', '.'), request.parameters.get('file'))
+
+        def on_added(future):
+            if isinstance(future.exception(), ValueError):
+                connection.send_response(request, 400, body=str(future.exception()))
+            elif future.exception():
+                self.bus.log('[AsyncHttpServer] Failed to add torrent: {0}'.format(future.exception()))
+                connection.send_response(request, 500, body='Failed to add torrent')
+            else:
+                connection.send_response(request, 200, { 'Content-Type': 'application/json' }, json.dumps(future.result()))
+        future.add_done_callback(on_added)
+
+    ############################################################################
+    def _video(self, connection, request):
+        if 'file' in request.parameters:
+            self.bus.downloader_monitor.select_file(request.parameters['info_hash'], request.parameters['file'])
+        connection.start_stream(VideoStream(self, connection, request, request.parameters['info_hash']))
+
+    ############################################################################
+    def _ready(self, connection, request):
+        info_hash = request.parameters['info_hash']
+        is_fast   = request.parameters.get('fast') in ('1', 'true')
+        deadline  = time.time() + min(float(request.parameters.get('timeout', READY_MAX_TIMEOUT)), READY_MAX_TIMEOUT)
+
+        def check_ready():
+            if connection.closed:
+                return
+
+            # Polls the readiness event instead of blocking on it, like streams waiting for their file
+            try:
+                is_ready = self.bus.downloader_monitor.wait_for_video_file_ready(info_hash, is_fast, 0)
+            except RuntimeError:
+                connection.send_response(request, 404, body='Unknown torrent')
+                return
+
+            if is_ready or time.time() >= deadline:
+                connection.send_response(request, 200, { 'Content-Type': 'application/json' }, json.dumps({ 'info_hash': info_hash, 'ready': is_ready }))
+            else:
+                self.loop.call_later(min(READY_POLL_INTERVAL, deadline - time.time()), check_ready)
+        check_ready()
+
+    ############################################################################
+    def _prefetch(self, connection, request):
+        parameters  = request.parameters
+        byte_ranges = utils.parse_byte_ranges(parameters.get('offset'), parameters.get('length'), parameters.get('ranges'))
+        hints       = self.bus.downloader_monitor.add_prefetch_hints(parameters['info_hash'], byte_ranges, parameters.get('ttl', downloader.PREFETCH_TTL))
+        connection.send_response(request, 200, { 'Content-Type': 'application/json' }, json.dumps(hints))
+
+    ############################################################################
+    def _bandwidth(self, connection, request):
+        config = self.bus.downloader_monitor.configure_bandwidth(request.parameters)
+        connection.send_response(request, 200, { 'Content-Type': 'application/json' }, json.dumps(config))
+
+    ############################################################################
+    def _metrics(self, connection, request):
+        connection.send_response(request, 200, { 'Content-Type': 'text/plain; version=0.0.4' }, metrics.REGISTRY.render())
+
+    ############################################################################
+    def _shutdown(self, connection, request):
+        connection.send_response(request, 200, body='cherrytorrent stopped')
+        # The engine is stopped once the loop is left
+        self.loop.call_soon(self.stop)
+
+################################################################################
+class HttpRequest:
+    ############################################################################
+    def __init__(self, method, target, version, headers):
+        url = urlparse.urlsplit(target)
+
+        self.method     = method
+        self.target     = target
+        self.path       = url.path
+        self.parameters = dict((name, values[-1]) for name, values in urlparse.parse_qs(url.query).iteritems())
+        self.version    = version
+        self.headers    = headers
+
+        connection_header = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection_header != 'close'
+        else:
+            self.keep_alive = connection_header == 'keep-alive'
+
+################################################################################
+class HttpConnection(asyncio.Protocol):
+    ############################################################################
+    def __init__(self, server):
+        self.server     = server
+        self.transport  = None
+        self.remote     = None
+        self.buffer     = b''
+        self.stream     = None
+        self.busy       = False
+        self.paused     = False
+        self.reading    = True
+        self.closed     = False
+        self.responding = False
+        self.idle_timer = None
+
+    ############################################################################
+    def connection_made(self, transport):
+        self.transport = transport
+        self.remote    = transport.get_extra_info('peername')
+        self.server.connections.add(self)
+        self._set_idle_timer()
+
+    ############################################################################
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.connections.discard(self)
+        self._cancel_idle_timer()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+    ############################################################################
+    def data_received(self, data):
+        self.buffer = self.buffer + data
+        if self.busy and len(self.buffer) > MAX_HEADER_SIZE:
+            # Pipelined requests piling up behind a stream
+            self.transport.pause_reading()
+            self.reading = False
+        self._process()
+
+    ############################################################################
+    def pause_writing(self):
+        self.paused = True
+
+    ############################################################################
+    def resume_writing(self):
+        self.paused = False
+        if self.stream:
+            self.stream.resume()
+
+    ############################################################################
+    def write(self, data):
+        self.transport.write(data)
+
+    ############################################################################
+    def abort(self):
+        if not self.closed:
+            self.transport.abort()
+
+    ############################################################################
+    def send_response(self, request, status, headers={}, body=''):
+        if self.closed:
+            return
+
+        self.send_headers(request, status, dict(headers, **{ 'Content-Length': str(len(body)) }))
+        if request.method != 'HEAD':
+            self.write(body)
+        self.finish_response(request)
+
+    ############################################################################
+    def send_server_error(self, request):
+        if self.responding:
+            # Headers are already out, the client only learns through the connection closing early
+            self.abort()
+        else:
+            request.keep_alive = False
+            self.send_response(request, 500, body='Internal error')
+
+    ############################################################################
+    def send_headers(self, request, status, headers):
+        self.responding = True
+        lines = ['HTTP/1.1 {0} {1}'.format(status, STATUS_REASONS.get(status, ''))]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.iteritems())
+        if not request.keep_alive:
+            lines.append('Connection: close')
+        self.write('\r\n'.join(lines) + '\r\n\r\n')
+
+    ############################################################################
+    def start_stream(self, stream):
+        self.stream = stream
+        stream.start()
+
+    ############################################################################
+    def finish_response(self, request):
+        self.stream     = None
+        self.busy       = False
+        self.responding = False
+        if self.closed:
+            return
+
+        if not request.keep_alive:
+            self.transport.close()
+            return
+
+        if not self.reading:
+            self.transport.resume_reading()
+            self.reading = True
+        self._set_idle_timer()
+        self._process()
+
+    ############################################################################
+    def _process(self):
+        # One request at a time, pipelined ones wait in the buffer
+        if self.busy or self.closed:
+            return
+
+        try:
+            self._process_request()
+        except Exception:
+            self.server.bus.log('[AsyncHttpServer] Failed to process request from {0}'.format(self.remote), traceback=True)
+            if self.busy:
+                self.abort()
+            else:
+                self._send_error(500)
+
+    ############################################################################
+    def _process_request(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                self._send_error(431)
+            return
+
+        head        = self.buffer[:end]
+        self.buffer = self.buffer[end + 4:]
+        lines       = head.split('\r\n')
+
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self._send_error(400)
+            return
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            self._send_error(400)
+            return
+
+        self.busy = True
+        self._cancel_idle_timer()
+        request = HttpRequest(method, target, version, headers)
+        if method not in ('GET', 'HEAD') or content_length > 0:
+            request.keep_alive = False
+            self.send_response(request, 405, { 'Allow': 'GET, HEAD' })
+            return
+
+        self.server.handle(self, request)
+
+    ############################################################################
+    def _send_error(self, status):
+        self.busy = True
+        self.send_response(HttpRequest('GET', '/', 'HTTP/1.0', {}), status)
+
+    ############################################################################
+    def _set_idle_timer(self):
+        self._cancel_idle_timer()
+        self.idle_timer = self.server.loop.call_later(IDLE_TIMEOUT, self.transport.close)
+
+    ############################################################################
+    def _cancel_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+################################################################################
+class PieceEvent:
+    ############################################################################
+    def __init__(self, loop, callback):
+        self.loop     = loop
+        self.callback = callback
+
+    ############################################################################
+    def set(self):
+        # Stands in for the threading.Event set by the piece notifier, from the alert thread
+        try:
+            self.loop.call_soon_threadsafe(self.callback, self)
+        except RuntimeError:
+            # Loop closed while shutting down
+            pass
+
+################################################################################
+class VideoStream:
+    ############################################################################
+    def __init__(self, server, connection, request, info_hash):
+        self.server       = server
+        self.connection   = connection
+        self.request      = request
+        self.info_hash    = info_hash
+        self.monitor      = server.bus.downloader_monitor
+        self.loop         = server.loop
+        self.file_wrapper = None
+        self.remaining    = 0
+        self.advised      = -1
+        self.timer        = None
+        self.job          = None
+        self.piece_event  = None
+        self.piece_index  = None
+        self.wait_start   = None
+        self.closed       = False
+
+        self.deadline        = time.time() + VIDEO_READY_TIMEOUT
+        self.connection_name = '{0}:{1}'.format(*connection.remote[:2]) if connection.remote else 'unknown'
+        server.bus.connection_monitor.add_connection(info_hash, self.connection_name)
+
+    ############################################################################
+    def start(self):
+        self._check_ready()
+
+    ############################################################################
+    def resume(self):
+        if self.file_wrapper and not self.piece_event:
+            self._send()
+
+    ############################################################################
+    def _run(self, callback, function, *args):
+        # libtorrent calls and file reads may block, they run in the executor and the loop picks up the result
+        self.job = self.loop.run_in_executor(None, function, *args)
+        self.job.add_done_callback(callback)
+
+    ############################################################################
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self._cancel_timer()
+        self._cancel_piece_wait()
+        if self.file_wrapper and not self.job:
+            # Otherwise closed once the executor is done with it
+            self.file_wrapper.close()
+        self.server.bus.connection_monitor.remove_video_connection(self.info_hash, self.connection_name)
+
+    ############################################################################
+    def _check_ready(self):
+        self.timer = None
+        if self.closed:
+            return
+
+        try:
+            is_ready = self.monitor.wait_for_video_file_ready(self.info_hash, True, 0)
+        except RuntimeError:
+            self._fail(404, 'Unknown torrent')
+            return
+
+        if is_ready:
+            self._run(self._on_file_opened, self.monitor.get_video_file, self.info_hash, False)
+        else:
+            self._retry_or_redirect()
+
+    ############################################################################
+    def _on_file_opened(self, job):
+        self.job = None
+        try:
+            file_wrapper = job.result()
+        except RuntimeError:
+            if not self.closed:
+                self._fail(404, 'Unknown torrent')
+            return
+        except Exception:
+            self.server.bus.log('[AsyncHttpServer] Opening the video file of {0} failed'.format(self.info_hash), traceback=True)
+            if not self.closed:
+                self._fail(500, 'Internal error')
+            return
+
+        if self.closed:
+            if file_wrapper:
+                file_wrapper.close()
+        elif file_wrapper:
+            self.file_wrapper = file_wrapper
+            self._start_response()
+        else:
+            self._retry_or_redirect()
+
+    ############################################################################
+    def _retry_or_redirect(self):
+        if time.time() < self.deadline:
+            self.timer = self.loop.call_later(READY_POLL_INTERVAL, self._check_ready)
+        else:
+            # Same as the threaded server, the player comes back for another round, the check only logs why
+            self.loop.run_in_executor(None, self._log_not_ready)
+            self._fail(307, headers={ 'Location': '/video?info_hash={0}'.format(self.info_hash) })
+
+    ############################################################################
+    def _log_not_ready(self):
+        try:
+            self.monitor.is_video_file_ready_from_info_hash(self.info_hash, True)
+        except RuntimeError:
+            pass
+
+    ############################################################################
+    def _start_response(self):
+        size    = self.file_wrapper.size
+        headers = { 'Accept-Ranges': 'bytes' }
+
+        content_type = utils.get_video_content_type(self.file_wrapper.path)
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        ranges = httputil.get_ranges(self.request.headers.get('range'), size)
+        if ranges == []:
+            self._fail(416, headers={ 'Content-Range': 'bytes */{0}'.format(size) })
+            return
+
+        if ranges and len(ranges) == 1:
+            # Several ranges are answered with the whole file, players only ask for one
+            start, stop = ranges[0]
+            status      = 206
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)
+        else:
+            start, stop = 0, size
+            status      = 200
+        headers['Content-Length'] = str(stop - start)
+
+        self.connection.send_headers(self.request, status, headers)
+        if self.request.method == 'HEAD':
+            self._finish()
+            return
+
+        self.file_wrapper.seek(start, wait=False)
+        self.remaining = stop - start
+        self._send()
+
+    ############################################################################
+    def _send(self):
+        self.timer = None
+        if self.closed or self.job or self.connection.paused:
+            return
+
+        if self.remaining == 0:
+            self._finish()
+        else:
+            self._run(self._on_chunks, self._read_chunks, min(READ_BUDGET, self.remaining))
+
+    ############################################################################
+    def _read_chunks(self, budget):
+        # Runs in the executor, None while the file is not on disk yet and nothing while the next piece is missing
+        file_wrapper = self.file_wrapper
+        if not file_wrapper.file and not os.path.isfile(file_wrapper.path):
+            return None
+
+        chunks = []
+        while budget > 0:
+            size = file_wrapper.completed_bytes(min(CHUNK_SIZE, budget))
+            if size == 0:
+                break
+
+            # Copied here so that the mapped pages are faulted in off the loop
+            view = file_wrapper.read_completed(size)
+            chunks.append(view.tobytes() if isinstance(view, memoryview) else bytes(view))
+            budget = budget - len(view)
+
+        if chunks:
+            self._advise()
+        return chunks
+
+    ############################################################################
+    def _on_chunks(self, job):
+        self.job = None
+        if self.closed:
+            self.file_wrapper.close()
+            return
+
+        try:
+            chunks = job.result()
+        except (EnvironmentError, RuntimeError, ValueError) as error:
+            self.server.bus.log('[AsyncHttpServer] Stream of {0} aborted: {1}'.format(self.info_hash, error))
+            self._abort()
+            return
+        except Exception:
+            self.server.bus.log('[AsyncHttpServer] Stream of {0} failed'.format(self.info_hash), traceback=True)
+            self._abort()
+            return
+
+        if chunks is None:
+            # libtorrent may still hold the first piece in its write cache
+            self.timer = self.loop.call_later(FILE_POLL_INTERVAL, self._send)
+        elif not chunks:
+            self._wait_for_piece()
+        else:
+            for chunk in chunks:
+                self.connection.write(chunk)
+                self.remaining = self.remaining - len(chunk)
+            self._send()
+
+    ############################################################################
+    def _advise(self):
+        # Readahead without a thread per viewer, only pieces already on disk are worth it
+        file_wrapper = self.file_wrapper
+        piece_index  = file_wrapper.piece_from_offset(file_wrapper.torrent_file.offset + file_wrapper.position)
+        end_index    = min(piece_index + READAHEAD_PIECES, file_wrapper.piece_from_offset(file_wrapper.torrent_file.offset + file_wrapper.size - 1))
+
+        next_index = max(self.advised + 1, piece_index)
+        while next_index <= end_index and file_wrapper.torrent_handle.have_piece(next_index):
+            file_wrapper.advise(next_index)
+            self.advised = next_index
+            next_index   = next_index + 1
+
+    ############################################################################
+    def _wait_for_piece(self):
+        file_wrapper     = self.file_wrapper
+        self.piece_index = file_wrapper.piece_from_offset(file_wrapper.torrent_file.offset + file_wrapper.position)
+        self.piece_event = PieceEvent(self.loop, self._on_piece)
+        self.wait_start  = time.time()
+        self.server.bus.log('[AsyncHttpServer] Waiting for piece {0}'.format(self.piece_index))
+
+        # Register before checking again so that a notification sent in between is not lost
+        self.monitor.piece_notifier.register(self.info_hash, self.piece_index, self.piece_event)
+        self.timer = self.loop.call_later(PIECE_WAIT_TIMEOUT, self._on_piece_timeout)
+        if file_wrapper.completed_bytes(1) > 0 or not file_wrapper.torrent_handle.is_valid():
+            self.piece_event.set()
+
+    ############################################################################
+    def _on_piece(self, piece_event):
+        if piece_event is not self.piece_event or self.closed:
+            return
+
+        self._cancel_timer()
+        self._cancel_piece_wait()
+        if not self.file_wrapper.torrent_handle.is_valid():
+            self.server.bus.log('[AsyncHttpServer] Torrent {0} removed while streaming'.format(self.info_hash))
+            self._abort()
+            return
+
+        metrics.PIECE_WAIT.observe(time.time() - self.wait_start)
+        self._send()
+
+    ############################################################################
+    def _on_piece_timeout(self):
+        self.timer = None
+        self.server.bus.log('[AsyncHttpServer] Timed out waiting for piece {0}'.format(self.piece_index))
+        self._abort()
+
+    ############################################################################
+    def _cancel_piece_wait(self):
+        if self.piece_event:
+            self.monitor.piece_notifier.unregister(self.info_hash, self.piece_index, self.piece_event)
+            self.piece_event = None
+
+    ############################################################################
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    ############################################################################
+    def _fail(self, status, body='', headers={}):
+        self.close()
+        self.connection.send_response(self.request, status, headers, body)
+
+    ############################################################################
+    def _finish(self):
+        self.close()
+        self.connection.finish_response(self.request)
+
+    ############################################################################
+    def _abort(self):
+        # Headers are already out, the client only learns through the connection closing early
+        self.close()
+        self.connection.abort()
@@ -0,0 +1,100 @@
+################################################################################
+import inspect
+import metrics
+import threading
+import time
+
+################################################################################
+ALERT_WAIT_TIMEOUT = 1000
+
+################################################################################
+class AlertDispatcher:
+    ############################################################################
+    def __init__(self, bus):
+        self.bus           = bus
+        self.session       = None
+        self.handlers      = {}
+        self.quiet_types   = set()
+        self.type_handlers = {}
+        self.thread        = None
+        self.running       = False
+
+    ############################################################################
+    def register(self, alert_type, handler, quiet=False):
+        self.handlers.setdefault(alert_type, []).append(handler)
+        if quiet:
+            self.quiet_types.add(alert_type)
+        self.type_handlers = {}
+
+    ############################################################################
+    def ignore(self, alert_type):
+        self.quiet_types.add(alert_type)
+        self.type_handlers = {}
+
+    ############################################################################
+    def start(self, session):
+        self.session = session
+        self.running = True
+        self.thread  = threading.Thread(target=self._dispatch_alerts, name='AlertDispatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    ############################################################################
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    ############################################################################
+    def _dispatch_alerts(self):
+        timestamp = None
+
+        while self.running:
+            self.session.wait_for_alert(ALERT_WAIT_TIMEOUT)
+            alerts = self._pop_alerts()
+
+            if timestamp is not None:
+                metrics.ALERT_PUMP_LAG.observe(time.time() - timestamp)
+            timestamp = time.time()
+            metrics.ALERT_QUEUE.set(len(alerts))
+
+            for alert in alerts:
+                handlers, quiet = self._get_handlers(alert.__class__)
+                if not quiet:
+                    self.bus.log('[Downloader][{0}] {1}'.format(alert.what(), alert.message()))
+
+                for handler in handlers:
+                    try:
+                        handler(alert)
+                    except RuntimeError:
+                        # Torrent removed since the alert was posted, its handle is no longer valid
+                        pass
+                    except Exception:
+                        # Waiters and readiness events depend on this thread, it must outlive a failing handler
+                        self.bus.log('[Downloader] Handling {0} failed'.format(alert.what()), traceback=True)
+
+    ############################################################################
+    def _pop_alerts(self):
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+
+        # Older bindings only hand alerts over one at a time
+        alerts = []
+        alert  = self.session.pop_alert()
+        while alert:
+            alerts.append(alert)
+            alert = self.session.pop_alert()
+        return alerts
+
+    ############################################################################
+    def _get_handlers(self, alert_type):
+        # Resolved once per alert type, handlers registered for a base type also get its subtypes
+        type_handlers = self.type_handlers.get(alert_type)
+        if type_handlers is None:
+            base_types    = inspect.getmro(alert_type)
+            handlers      = [handler for base_type in reversed(base_types) for handler in self.handlers.get(base_type, [])]
+            quiet         = any(base_type in self.quiet_types for base_type in base_types)
+            type_handlers = (handlers, quiet)
+            self.type_handlers[alert_type] = type_handlers
+        return type_handlers
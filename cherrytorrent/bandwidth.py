@@ -0,0 +1,167 @@
+################################################################################
+import scheduler
+import threading
+
+################################################################################
+TARGET_BUFFER     = 30.0
+IDLE_RATE         = 16
+IDLE_WEIGHT       = 0.1
+URGENCY_WEIGHT    = 3.0
+CONNECTIONS_LIMIT = 200
+MIN_CONNECTIONS   = 4
+UNLIMITED         = -1
+
+################################################################################
+def _parse_bool(value):
+    return value in (True, '1', 'true')
+
+################################################################################
+PARAMETERS = { 'enabled':           _parse_bool,
+               'max_download_rate': int,
+               'idle_rate':         int,
+               'target_buffer':     float,
+               'connections_limit': int }
+
+################################################################################
+def parse_parameters(parameters):
+    changes = {}
+    for name, value in parameters.iteritems():
+        if name not in PARAMETERS:
+            raise ValueError('Unknown bandwidth parameter {0}'.format(name))
+        try:
+            changes[name] = PARAMETERS[name](value)
+        except ValueError:
+            raise ValueError('Invalid value for bandwidth parameter {0}: {1}'.format(name, value))
+        if changes[name] < 0 or (name == 'target_buffer' and changes[name] == 0):
+            raise ValueError('Invalid value for bandwidth parameter {0}: {1}'.format(name, value))
+    return changes
+
+################################################################################
+class BandwidthScheduler:
+    ############################################################################
+    def __init__(self, bus, max_download_rate):
+        self.bus         = bus
+        self.lock        = threading.Lock()
+        self.allocations = {}
+
+        # Rates in kB/s like the command line, durations in seconds
+        self.config = { 'enabled':           True,
+                        'max_download_rate': max_download_rate,
+                        'idle_rate':         IDLE_RATE,
+                        'target_buffer':     TARGET_BUFFER,
+                        'connections_limit': CONNECTIONS_LIMIT }
+
+    ############################################################################
+    def configure(self, parameters):
+        changes = parse_parameters(parameters)
+
+        with self.lock:
+            self.config.update(changes)
+            return dict(self.config)
+
+    ############################################################################
+    def get_status(self):
+        with self.lock:
+            return { 'config': dict(self.config), 'torrents': dict((info_hash, dict(allocation)) for info_hash, allocation in self.allocations.iteritems()) }
+
+    ############################################################################
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            self.allocations.pop(info_hash, None)
+
+    ############################################################################
+    def update(self, entries):
+        with self.lock:
+            config               = dict(self.config)
+            previous_allocations = self.allocations
+
+        demands = {}
+        for entry in entries:
+            try:
+                demands[entry.info_hash] = self._get_demand(entry, config)
+            except RuntimeError:
+                # Torrent removed in the meantime
+                pass
+
+        allocations = self._allocate(demands, config)
+        for entry in entries:
+            allocation = allocations.get(entry.info_hash)
+            previous   = previous_allocations.get(entry.info_hash, {})
+            if not allocation:
+                continue
+
+            try:
+                if allocation['download_limit'] != previous.get('download_limit'):
+                    entry.torrent_handle.set_download_limit(allocation['download_limit'])
+                if allocation['max_connections'] != previous.get('max_connections'):
+                    entry.torrent_handle.set_max_connections(allocation['max_connections'])
+            except RuntimeError:
+                # Torrent removed in the meantime
+                allocations.pop(entry.info_hash, None)
+
+        with self.lock:
+            self.allocations = allocations
+
+    ############################################################################
+    def _get_demand(self, entry, config):
+        streaming_scheduler = self.bus.downloader_monitor.streaming_scheduler
+        playheads           = streaming_scheduler.get_playheads(entry.info_hash)
+        bitrate             = entry.preload_model.get_bitrate() if entry.preload_model else None
+        bitrate             = bitrate or scheduler.DEFAULT_BITRATE
+        finished            = False
+
+        if not entry.has_metadata or not entry.video_file:
+            # Still starting, someone is waiting for it to become ready
+            viewers = 1
+            buffer  = 0.0
+        elif entry.get_complete_pieces() >= entry.get_total_pieces():
+            viewers  = 0
+            buffer   = None
+            finished = True
+        elif playheads:
+            # Seconds of playback downloaded ahead of the furthest behind playhead
+            viewers = len(playheads)
+            buffer  = min(entry.piece_bitmap.contiguous_pieces(playhead, entry.end_piece_index) for playhead in playheads) * entry.piece_length / float(bitrate)
+        elif not entry.ready_events[False].is_set():
+            viewers = 1
+            buffer  = entry.get_complete_pieces() * entry.piece_length / float(bitrate)
+        else:
+            viewers = 0
+            buffer  = None
+
+        if viewers:
+            deficit = max(0.0, 1.0 - buffer / config['target_buffer'])
+            weight  = viewers * (float(bitrate) / scheduler.DEFAULT_BITRATE) * (1.0 + URGENCY_WEIGHT * deficit)
+        else:
+            deficit = 0.0
+            weight  = 0.0 if finished else IDLE_WEIGHT
+
+        return { 'viewers': viewers, 'buffer': buffer, 'bitrate': bitrate, 'deficit': deficit, 'weight': weight }
+
+    ############################################################################
+    def _allocate(self, demands, config):
+        total_weight = sum(demand['weight'] for demand in demands.itervalues())
+        starving     = any(demand['viewers'] and demand['deficit'] > 0 for demand in demands.itervalues())
+        contended    = len([demand for demand in demands.itervalues() if demand['weight'] > 0]) > 1
+
+        allocations = {}
+        for info_hash, demand in demands.iteritems():
+            download_limit  = UNLIMITED
+            max_connections = UNLIMITED
+
+            if config['enabled'] and total_weight > 0 and demand['weight'] > 0:
+                share = demand['weight'] / total_weight
+                if config['max_download_rate'] > 0:
+                    download_limit = max(1024, int(config['max_download_rate'] * 1024 * share))
+                elif starving and not demand['viewers']:
+                    # Without a global limit, only hold back torrents nobody watches while a viewer is short of data
+                    download_limit = config['idle_rate'] * 1024 if config['idle_rate'] > 0 else UNLIMITED
+                if contended:
+                    max_connections = max(MIN_CONNECTIONS, int(config['connections_limit'] * share))
+
+            allocation = dict(demand)
+            allocation['download_limit']  = download_limit
+            allocation['max_connections'] = max_connections
+            allocations[info_hash] = allocation
+
+        return allocations
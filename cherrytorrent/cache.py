@@ -0,0 +1,98 @@
+################################################################################
+import json
+import threading
+import time
+
+################################################################################
+POLICIES = ('lru', 'lfu')
+
+################################################################################
+class ContentCache:
+    ############################################################################
+    def __init__(self, torrent_store, quota, policy='lru'):
+        self.lock          = threading.Lock()
+        self.torrent_store = torrent_store
+        self.quota         = quota
+        self.policy        = policy
+        self.entries       = {}
+
+        cache_index = self.torrent_store.load_cache_index()
+        if cache_index:
+            try:
+                self.entries = json.loads(cache_index)
+            except ValueError:
+                self.entries = {}
+
+    ############################################################################
+    def touch(self, info_hash):
+        with self.lock:
+            entry = self.entries.setdefault(info_hash, { 'access_count': 0, 'cached': False, 'save_path': None, 'file_paths': [], 'size': 0 })
+            entry['access_count'] = entry['access_count'] + 1
+            entry['last_access']  = time.time()
+            entry['cached']       = False
+            self._save()
+
+    ############################################################################
+    def store(self, info_hash, save_path, file_paths, size):
+        with self.lock:
+            entry = self.entries.setdefault(info_hash, { 'access_count': 1 })
+            entry['cached']      = True
+            entry['save_path']   = save_path
+            entry['file_paths']  = file_paths
+            entry['size']        = size
+            entry['last_access'] = time.time()
+            self._save()
+
+    ############################################################################
+    def discard(self, info_hash):
+        with self.lock:
+            if self.entries.pop(info_hash, None):
+                self._save()
+
+    ############################################################################
+    def get_cached(self, info_hash):
+        with self.lock:
+            entry = self.entries.get(info_hash)
+            return dict(entry) if entry and entry['cached'] else None
+
+    ############################################################################
+    def get_cached_info_hashes(self):
+        with self.lock:
+            return [info_hash for info_hash, entry in self.entries.iteritems() if entry['cached']]
+
+    ############################################################################
+    def evict(self, active_size):
+        with self.lock:
+            cached_entries = [(info_hash, entry) for info_hash, entry in self.entries.iteritems() if entry['cached']]
+            used_size      = active_size + sum(entry['size'] for info_hash, entry in cached_entries)
+            if used_size <= self.quota:
+                return []
+
+            if self.policy == 'lfu':
+                cached_entries.sort(key=lambda cached_entry: (cached_entry[1]['access_count'], cached_entry[1]['last_access']))
+            else:
+                cached_entries.sort(key=lambda cached_entry: cached_entry[1]['last_access'])
+
+            evicted_entries = []
+            for info_hash, entry in cached_entries:
+                if used_size <= self.quota:
+                    break
+                used_size = used_size - entry['size']
+                del self.entries[info_hash]
+                evicted_entries.append((info_hash, entry))
+
+            self._save()
+            return evicted_entries
+
+    ############################################################################
+    def get_status(self, active_size):
+        with self.lock:
+            cached_entries = [entry for entry in self.entries.itervalues() if entry['cached']]
+            return { 'quota':    self.quota,
+                     'policy':   self.policy,
+                     'used':     active_size + sum(entry['size'] for entry in cached_entries),
+                     'torrents': len(cached_entries) }
+
+    ############################################################################
+    def _save(self):
+        self.torrent_store.save_cache_index(json.dumps(self.entries))
@@ -0,0 +1,345 @@
+################################################################################
+import struct
+
+################################################################################
+EBML_MAGIC   = '\x1a\x45\xdf\xa3'
+MP4_BOXES    = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pdin')
+RIFF_MAGIC   = 'RIFF'
+AVI_MAGIC    = 'AVI '
+
+MAX_INDEX_SIZE = 16 * 1024 * 1024
+
+# Longest element header, 4 bytes of ID and 8 of size, and longest MP4 box header
+MAX_MKV_HEADER = 12
+MAX_MP4_HEADER = 16
+AVI_HEADER     = 56
+
+MKV_SEGMENT_ID        = 0x18538067
+MKV_SEEK_HEAD_ID      = 0x114D9B74
+MKV_SEEK_ID           = 0x4DBB
+MKV_SEEK_ID_ID        = 0x53AB
+MKV_SEEK_POSITION_ID  = 0x53AC
+MKV_INFO_ID           = 0x1549A966
+MKV_CUES_ID           = 0x1C53BB6B
+MKV_CLUSTER_ID        = 0x1F43B675
+MKV_TIMECODE_SCALE_ID = 0x2AD7B1
+MKV_DURATION_ID       = 0x4489
+MKV_TIMECODE_SCALE    = 1000000
+
+################################################################################
+def parse_duration(data):
+    # Duration in seconds read from the header at the start of a video file, None when not found in data
+    try:
+        if data.startswith(EBML_MAGIC):
+            return _parse_mkv_duration(data)
+        if data[4:8] in MP4_BOXES:
+            return _parse_mp4_duration(data)
+        if data.startswith(RIFF_MAGIC) and data[8:12] == AVI_MAGIC:
+            return _parse_avi_duration(data)
+    except (IndexError, TypeError, ValueError, struct.error):
+        pass
+    return None
+
+################################################################################
+def get_header_size(data):
+    # Bytes at the start of a video file the duration is read from, at most len(data) once there is nothing more to find
+    try:
+        if data.startswith(EBML_MAGIC):
+            return _get_mkv_header_size(data)
+        if data[4:8] in MP4_BOXES:
+            return _get_mp4_header_size(data)
+        if data.startswith(RIFF_MAGIC) and data[8:12] == AVI_MAGIC:
+            return AVI_HEADER
+    except (IndexError, TypeError, ValueError, struct.error):
+        pass
+    return 0
+
+################################################################################
+def find_index_ranges(data, file_size):
+    # (offset, size) byte ranges of the indexes players read before playing, found from the header at the start of a video file
+    try:
+        if data.startswith(EBML_MAGIC):
+            ranges = _find_mkv_index_ranges(data, file_size)
+        elif data[4:8] in MP4_BOXES:
+            ranges = _find_mp4_index_ranges(data, file_size)
+        elif data.startswith(RIFF_MAGIC) and data[8:12] == AVI_MAGIC:
+            ranges = _find_avi_index_ranges(data, file_size)
+        else:
+            ranges = []
+    except (IndexError, TypeError, ValueError, struct.error):
+        ranges = []
+
+    return [(offset, min(size, file_size - offset, MAX_INDEX_SIZE)) for offset, size in ranges if 0 <= offset < file_size and size > 0]
+
+################################################################################
+def _read_ebml_id(data, offset):
+    first  = ord(data[offset])
+    length = 1
+    while length <= 4 and not first & (0x80 >> (length - 1)):
+        length = length + 1
+    if length > 4 or offset + length > len(data):
+        raise ValueError('Invalid EBML element ID')
+    return _read_uint(data[offset:offset + length]), offset + length
+
+################################################################################
+def _read_ebml_size(data, offset):
+    first  = ord(data[offset])
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length = length + 1
+    if length > 8 or offset + length > len(data):
+        raise ValueError('Invalid EBML element size')
+
+    size = _read_uint(chr(first & (0xff >> length)) + data[offset + 1:offset + length])
+    if size == (1 << (7 * length)) - 1:
+        # Unknown size, used by live streams for the segment
+        size = None
+    return size, offset + length
+
+################################################################################
+def _read_uint(data):
+    value = 0
+    for byte in data:
+        value = (value << 8) | ord(byte)
+    return value
+
+################################################################################
+def _parse_mkv_duration(data):
+    element_id, offset = _read_ebml_id(data, 0)
+    size, offset       = _read_ebml_size(data, offset)
+    offset             = offset + size
+
+    element_id, offset = _read_ebml_id(data, offset)
+    size, offset       = _read_ebml_size(data, offset)
+    if element_id != MKV_SEGMENT_ID:
+        return None
+
+    # Info comes before the first cluster, usually right after the seek head
+    while offset < len(data):
+        element_id, offset = _read_ebml_id(data, offset)
+        size, offset       = _read_ebml_size(data, offset)
+        if element_id == MKV_CLUSTER_ID or size is None:
+            return None
+        if element_id == MKV_INFO_ID:
+            return _parse_mkv_info(data[offset:offset + size])
+        offset = offset + size
+
+    return None
+
+################################################################################
+def _get_mkv_header_size(data):
+    if len(data) < MAX_MKV_HEADER:
+        return MAX_MKV_HEADER
+    element_id, offset = _read_ebml_id(data, 0)
+    size, offset       = _read_ebml_size(data, offset)
+    offset             = offset + size
+
+    if offset + MAX_MKV_HEADER > len(data):
+        return offset + MAX_MKV_HEADER
+    element_id, offset = _read_ebml_id(data, offset)
+    size, offset       = _read_ebml_size(data, offset)
+    if element_id != MKV_SEGMENT_ID:
+        return 0
+
+    # The info comes before the first cluster, or not at all
+    while True:
+        if offset + MAX_MKV_HEADER > len(data):
+            return offset + MAX_MKV_HEADER
+        element_offset     = offset
+        element_id, offset = _read_ebml_id(data, offset)
+        size, offset       = _read_ebml_size(data, offset)
+        if element_id == MKV_CLUSTER_ID or size is None:
+            return element_offset
+        if element_id == MKV_INFO_ID:
+            return offset + size
+        offset = offset + size
+
+################################################################################
+def _find_mkv_index_ranges(data, file_size):
+    element_id, offset = _read_ebml_id(data, 0)
+    size, offset       = _read_ebml_size(data, offset)
+    offset             = offset + size
+
+    element_id, offset = _read_ebml_id(data, offset)
+    size, offset       = _read_ebml_size(data, offset)
+    if element_id != MKV_SEGMENT_ID:
+        return []
+    segment_offset = offset
+
+    # Positions of the top level elements listed by the seek head, relative to the segment data
+    positions = []
+    while offset < len(data):
+        element_offset = offset
+        try:
+            element_id, offset = _read_ebml_id(data, offset)
+            size, offset       = _read_ebml_size(data, offset)
+        except (IndexError, ValueError):
+            # Element header cut by the end of the data
+            break
+        if element_id == MKV_CLUSTER_ID or size is None:
+            positions.append((element_id, element_offset))
+            break
+        if element_id == MKV_SEEK_HEAD_ID:
+            positions.extend((seek_id, segment_offset + seek_position) for seek_id, seek_position in _parse_mkv_seek_head(data[offset:offset + size]))
+        offset = offset + size
+
+    # Cues and any further seek head run until the next known element
+    ranges     = []
+    boundaries = sorted(set(position for element_id, position in positions))
+    for element_id, position in positions:
+        if element_id in (MKV_CUES_ID, MKV_SEEK_HEAD_ID) and position >= len(data):
+            end = next((boundary for boundary in boundaries if boundary > position), file_size)
+            ranges.append((position, end - position))
+    return ranges
+
+################################################################################
+def _parse_mkv_seek_head(data):
+    entries = []
+
+    offset = 0
+    while offset < len(data):
+        element_id, offset = _read_ebml_id(data, offset)
+        size, offset       = _read_ebml_size(data, offset)
+        if size is None:
+            break
+
+        if element_id == MKV_SEEK_ID:
+            seek_id       = None
+            seek_position = None
+
+            seek_offset = offset
+            while seek_offset < offset + size:
+                child_id, seek_offset   = _read_ebml_id(data, seek_offset)
+                child_size, seek_offset = _read_ebml_size(data, seek_offset)
+                if child_size is None:
+                    break
+                if child_id == MKV_SEEK_ID_ID:
+                    seek_id = _read_uint(data[seek_offset:seek_offset + child_size])
+                elif child_id == MKV_SEEK_POSITION_ID:
+                    seek_position = _read_uint(data[seek_offset:seek_offset + child_size])
+                seek_offset = seek_offset + child_size
+
+            if seek_id is not None and seek_position is not None:
+                entries.append((seek_id, seek_position))
+        offset = offset + size
+
+    return entries
+
+################################################################################
+def _parse_mkv_info(data):
+    timecode_scale = MKV_TIMECODE_SCALE
+    duration       = None
+
+    offset = 0
+    while offset < len(data):
+        element_id, offset = _read_ebml_id(data, offset)
+        size, offset       = _read_ebml_size(data, offset)
+        if size is None or offset + size > len(data):
+            break
+        value = data[offset:offset + size]
+
+        if element_id == MKV_TIMECODE_SCALE_ID:
+            timecode_scale = _read_uint(value)
+        elif element_id == MKV_DURATION_ID:
+            duration = struct.unpack('>f' if size == 4 else '>d', value)[0]
+        offset = offset + size
+
+    return duration * timecode_scale / 1000000000.0 if duration else None
+
+################################################################################
+def _parse_mp4_duration(data):
+    for box_type, start, end in _iterate_mp4_boxes(data, 0, len(data)):
+        if box_type == 'moov':
+            for child_type, child_start, child_end in _iterate_mp4_boxes(data, start, end):
+                if child_type == 'mvhd':
+                    return _parse_mvhd(data, child_start)
+            return None
+    return None
+
+################################################################################
+def _get_mp4_header_size(data):
+    offset = 0
+    while True:
+        if offset + MAX_MP4_HEADER > len(data):
+            return offset + MAX_MP4_HEADER
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        if box_type == 'mdat' or size == 0:
+            # The moov box follows the media data, there is no duration to find at the start
+            return offset
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+        if size < 8:
+            raise ValueError('Invalid MP4 box size')
+        if box_type == 'moov':
+            return offset + size
+        offset = offset + size
+
+################################################################################
+def _find_mp4_index_ranges(data, file_size):
+    # Walks the top level boxes as far as their headers are known, the moov box follows the media data when not found first
+    offset    = 0
+    seen_mdat = False
+    while offset + 16 <= len(data):
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        if box_type == 'moov':
+            return []
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+        elif size == 0:
+            return []
+        if size < 8:
+            raise ValueError('Invalid MP4 box size')
+
+        seen_mdat = seen_mdat or box_type == 'mdat'
+        offset    = offset + size
+
+    return [(offset, file_size - offset)] if seen_mdat and offset >= len(data) else []
+
+################################################################################
+def _iterate_mp4_boxes(data, offset, end):
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size    = 8
+        if size == 1:
+            size        = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            # Box extending to the end of the file
+            size = end - offset
+        if size < header_size:
+            raise ValueError('Invalid MP4 box size')
+
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset = offset + size
+
+################################################################################
+def _parse_mvhd(data, offset):
+    version = ord(data[offset])
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', data, offset + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', data, offset + 12)
+    return float(duration) / timescale if timescale and duration else None
+
+################################################################################
+def _find_avi_index_ranges(data, file_size):
+    # The idx1 chunk follows the movi list, which is usually all that is left after the headers
+    offset    = 12
+    seen_movi = False
+    while offset + 12 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        if chunk_id == 'idx1':
+            return []
+
+        seen_movi = seen_movi or (chunk_id == 'LIST' and data[offset + 8:offset + 12] == 'movi')
+        offset    = offset + 8 + size + (size & 1)
+
+    return [(offset, file_size - offset)] if seen_movi and offset >= len(data) else []
+
+################################################################################
+def _parse_avi_duration(data):
+    if data[12:16] != 'LIST' or data[20:24] != 'hdrl' or data[24:28] != 'avih':
+        return None
+
+    micro_sec_per_frame, max_bytes_per_sec, padding_granularity, flags, total_frames = struct.unpack_from('<5I', data, 32)
+    return micro_sec_per_frame * total_frames / 1000000.0 if micro_sec_per_frame and total_frames else None
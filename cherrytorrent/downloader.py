@@ -1,11 +1,36 @@
 ################################################################################
+import alerts
+import bandwidth
+import cache
 import cherrypy
+import container
 import filewrapper
 import libtorrent
 import math
+import metrics
+import pieces
+import registry
+import removal
+import scheduler
+import status
+import store
+import string
+import threading
 import time
 import utils
 
+################################################################################
+RESUME_DATA_INTERVAL   = 60.0
+RESUME_DATA_TIMEOUT    = 10.0
+SESSION_STATE_INTERVAL = 300.0
+SHUTDOWN_TIMEOUT       = 30.0
+INDEX_DEADLINE         = 1000
+PROBE_MAX_SIZE         = 4 * 1024 * 1024
+REMOVAL_WAIT_TIMEOUT   = 10.0
+PREFETCH_TTL           = 30.0
+PREFETCH_MAX_TTL       = 300.0
+PREFETCH_MAX_RANGES    = 64
+
 ################################################################################
 class DownloaderMonitor(cherrypy.process.plugins.Monitor):
     ############################################################################
@@ -17,23 +42,62 @@ class DownloaderMonitor(cherrypy.process.plugins.Monitor):
         self.session         = None
         self.connections     = []
         self.monitor_running = False
-        self.torrent_handles = []
-
-        self.expected_alert_types    = []
-        self.expected_alert_received = False
+        self.torrents        = registry.TorrentRegistry()
+        self.piece_notifier  = pieces.PieceNotifier()
+        self.piece_cache     = pieces.PieceCache(self.torrent_config['piece_cache_size'] * 1024 * 1024) if self.torrent_config['piece_cache_size'] > 0 else None
+        self.status_cache    = status.StatusCache()
+        self.torrent_store   = store.TorrentStore(self.torrent_config['state_dir'])
+
+        self.streaming_scheduler = scheduler.StreamingScheduler(self.bus)
+        self.removal_queue       = removal.RemovalQueue(self.bus)
+        self.bandwidth_scheduler = bandwidth.BandwidthScheduler(self.bus, self.torrent_config['max_download_rate'])
+
+        self.content_cache = None
+        self.cache_pending = set()
+        if self.torrent_config['cache_size'] > 0:
+            self.content_cache = cache.ContentCache(self.torrent_store, self.torrent_config['cache_size'] * 1024 * 1024, self.torrent_config['cache_policy'])
+
+        self.resume_data_pending   = set()
+        self.resume_data_saved     = threading.Event()
+        self.resume_data_timestamp = time.time()
+
+        self.startup                 = {}
+        self.start_timestamp         = time.time()
+        self.session_state_timestamp = time.time()
+
+        self.alert_dispatcher = alerts.AlertDispatcher(self.bus)
+        self.alert_dispatcher.register(libtorrent.piece_finished_alert, self._on_piece_finished, True)
+        self.alert_dispatcher.register(libtorrent.state_update_alert, self._on_state_update, True)
+        self.alert_dispatcher.register(libtorrent.save_resume_data_alert, self._on_save_resume_data, True)
+        self.alert_dispatcher.register(libtorrent.save_resume_data_failed_alert, self._on_save_resume_data_failed)
+        self.alert_dispatcher.register(libtorrent.torrent_removed_alert, self._on_torrent_removed)
+        self.alert_dispatcher.register(libtorrent.torrent_deleted_alert, self._on_torrent_deleted)
+        self.alert_dispatcher.register(libtorrent.torrent_delete_failed_alert, self._on_torrent_deleted)
+        self.alert_dispatcher.register(libtorrent.state_changed_alert, self._on_state_changed)
+        self.alert_dispatcher.register(libtorrent.torrent_checked_alert, self._on_torrent_checked)
+        self.alert_dispatcher.register(libtorrent.metadata_received_alert, self._on_metadata_received)
+        self.alert_dispatcher.register(libtorrent.read_piece_alert, self._on_read_piece, True)
+        for alert_type in (libtorrent.cache_flushed_alert, libtorrent.external_ip_alert, libtorrent.hash_failed_alert, libtorrent.metadata_failed_alert, libtorrent.tracker_error_alert):
+            self.alert_dispatcher.ignore(alert_type)
 
     ############################################################################
     def start(self):
+        self.start_timestamp = time.time()
         cherrypy.process.plugins.Monitor.start(self)
 
         self.bus.log('[Downloader] Starting session')
+        self.removal_queue.start()
         self.session = libtorrent.session()
-        self.session.set_alert_mask(libtorrent.alert.category_t.error_notification | libtorrent.alert.category_t.status_notification | libtorrent.alert.category_t.storage_notification)
+        self.session.set_alert_mask(libtorrent.alert.category_t.error_notification | libtorrent.alert.category_t.status_notification | libtorrent.alert.category_t.storage_notification | libtorrent.alert.category_t.progress_notification)
+
+        # With the routing table of the last run the DHT answers lookups right away instead of bootstrapping from scratch
+        state_loaded = self._load_session_state()
         self.session.start_dht()
         self.session.start_lsd()
         self.session.start_upnp()
         self.session.start_natpmp()
         self.session.listen_on(self.torrent_config['port'], self.torrent_config['port'])
+        self.alert_dispatcher.start(self.session)
 
         # Session settings
         session_settings = self.session.settings()
@@ -59,67 +123,155 @@ class DownloaderMonitor(cherrypy.process.plugins.Monitor):
         encryption_settings.prefer_rc4 = True
         self.session.set_pe_settings(encryption_settings)
 
+        # Without kept files there is nothing to resume from
+        if self.torrent_config['keep_files']:
+            self._resume_torrents()
+
+        self.startup = { 'seconds': time.time() - self.start_timestamp, 'state_loaded': state_loaded, 'dht_ready_seconds': None }
+        self.session_state_timestamp = time.time()
+        metrics.SESSION_STARTUP.set(self.startup['seconds'])
+        self.bus.log('[Downloader] Session started in {0:.2f}s, {1}'.format(self.startup['seconds'], 'saved state loaded' if state_loaded else 'no saved state'))
+        self._update_dht_status()
+
     ############################################################################
     def stop(self):
         if not self.monitor_running:
             return
 
         self.bus.log('[Downloader] Stopping session')
+        deadline = time.time() + SHUTDOWN_TIMEOUT
 
-        torrent_handles_to_remove = list(self.torrent_handles)
-        for torrent_handle in torrent_handles_to_remove:
-            self.remove_torrent(torrent_handle, True)
+        if self.torrent_config['keep_files'] or self.content_cache:
+            self._save_resume_data(self.torrents.get_torrent_handles())
+            if not self.resume_data_saved.wait(min(RESUME_DATA_TIMEOUT, deadline - time.time())):
+                self.bus.log('[Downloader] Saving resume data took too long, skipping.')
+
+        # All torrents are removed at once, the alert dispatcher keeps running until they are gone or the deadline passed
+        for torrent_handle in self.torrents.get_torrent_handles():
+            if self.content_cache:
+                self._cache_torrent(torrent_handle)
+            else:
+                self.remove_torrent(torrent_handle, False)
+        self._evict_cached_torrents()
+        if not self.removal_queue.wait(max(0, deadline - time.time())):
+            self.bus.log('[Downloader] Removing torrents took too long, skipping.')
+        self.removal_queue.stop()
+        self.alert_dispatcher.stop()
 
         self.session.stop_natpmp()
         self.session.stop_upnp()
         self.session.stop_lsd()
+        self._save_session_state()
         self.session.stop_dht()
 
         self.monitor_running = False
         cherrypy.process.plugins.Monitor.stop(self)
 
     ############################################################################
-    def add_torrent(self, uri, download_dir):
-        add_torrent_params                 = {}
-        add_torrent_params['url']          = uri
-        add_torrent_params['save_path']    = download_dir
-        add_torrent_params['storage_mode'] = libtorrent.storage_mode_t.storage_mode_sparse
-        add_torrent_params['auto_managed'] = False
+    def add_torrent(self, uri, download_dir, file_selector=None):
+        add_torrent_params              = {}
+        add_torrent_params['url']       = uri
+        add_torrent_params['save_path'] = download_dir
+
+        # libtorrent would delete the files of the new download along with those of the removed one
+        info_hash    = utils.info_hash_from_uri(uri)
+        if info_hash and not self.removal_queue.wait_for_torrent(info_hash, REMOVAL_WAIT_TIMEOUT):
+            raise ValueError('Torrent {0} is still being deleted'.format(info_hash))
+
+        # Cached content is served from where it was downloaded, without checking the files again
+        cached_entry = self.content_cache.get_cached(info_hash) if self.content_cache and info_hash else None
+        if cached_entry:
+            add_torrent_params['save_path'] = cached_entry['save_path']
+            resume_data = self.torrent_store.load_resume_data(info_hash)
+            if resume_data:
+                add_torrent_params['resume_data'] = resume_data
+
+        # Skip the metadata exchange for torrents seen before
+        if info_hash and self.torrent_store.has_metadata(info_hash):
+            try:
+                add_torrent_params['ti'] = libtorrent.torrent_info(libtorrent.bdecode(self.torrent_store.load_metadata(info_hash)))
+                del add_torrent_params['url']
+            except RuntimeError:
+                self.bus.log('[Downloader] Invalid cached metadata for torrent {0}'.format(info_hash))
+
+        torrent_handle = self._add_torrent(add_torrent_params, file_selector)
+        if 'ti' in add_torrent_params:
+            for tracker in utils.trackers_from_uri(uri):
+                torrent_handle.add_tracker({ 'url': tracker })
+        if self.content_cache:
+            self.content_cache.touch(str(torrent_handle.info_hash()))
+        return { 'name': torrent_handle.name(), 'info_hash': str(torrent_handle.info_hash()) }
 
-        torrent_handle = self.session.add_torrent(add_torrent_params)
-        torrent_handle.set_sequential_download(True)
-        torrent_handle.resume()
-        self.bus.connection_monitor.add_torrent(str(torrent_handle.info_hash()))    
+    ############################################################################
+    def select_file(self, info_hash, file_selector):
+        entry = self.torrents.get(info_hash)
+        if not entry:
+            raise RuntimeError
+
+        if entry.select_file(file_selector):
+            self.bus.log('[Downloader] Switching torrent {0} to {1}'.format(info_hash, entry.video_file.path))
+            self.streaming_scheduler.reset_torrent(info_hash)
+            for ready_event in entry.ready_events.itervalues():
+                ready_event.clear()
+            self._update_ready_events(entry)
+            self._probe_container(entry)
 
-        if torrent_handle not in self.torrent_handles:
-            self.torrent_handles.append(torrent_handle)
+    ############################################################################
+    def add_prefetch_hints(self, info_hash, byte_ranges, ttl=PREFETCH_TTL):
+        entry = self.torrents.get(info_hash)
+        if not entry:
+            raise RuntimeError
 
-        return { 'name': torrent_handle.name(), 'info_hash': str(torrent_handle.info_hash()) }
+        ttl = min(float(ttl), PREFETCH_MAX_TTL)
+        if ttl <= 0:
+            raise ValueError('Invalid prefetch ttl {0}'.format(ttl))
+        if len(byte_ranges) > PREFETCH_MAX_RANGES:
+            raise ValueError('Too many byte ranges, at most {0} per request'.format(PREFETCH_MAX_RANGES))
 
-    ############################################################################
-    def remove_torrent(self, torrent_handle, wait_for_alert=False):
-        self.bus.connection_monitor.remove_torrent(str(torrent_handle.info_hash()))
-        if torrent_handle in self.torrent_handles:
-            self.torrent_handles.remove(torrent_handle)
+        # Offsets are only known once the video file is, hints sent before are dropped
+        video_file = entry.video_file
+        if not video_file:
+            return { 'info_hash': info_hash, 'hints': 0, 'ttl': ttl }
 
-        remove_torrent_flags = libtorrent.options_t.delete_files if not self.torrent_config['keep_files'] else 0
-        self.session.remove_torrent(torrent_handle, remove_torrent_flags)
+        for offset, length in byte_ranges:
+            if offset < 0 or length <= 0 or offset >= video_file.size:
+                raise ValueError('Invalid byte range {0}:{1}'.format(offset, length))
 
-        if wait_for_alert:
-            self.expected_alert_received = False
-            self.expected_alert_types    = ['torrent_removed_alert'] if self.torrent_config['keep_files'] else ['torrent_deleted_alert', 'torrent_delete_failed_alert']
-            
-            start_time = time.time()
-            while not self.expected_alert_received:
-                if (time.time() - start_time) > 30.0:
-                    self.bus.log('[Downloader] Removing torrent took too long, skipping.')
-                    break
-                time.sleep(0.1)
+        self.streaming_scheduler.add_hints(entry.torrent_handle, video_file, [(offset, min(length, video_file.size - offset)) for offset, length in byte_ranges], ttl)
+        return { 'info_hash': info_hash, 'hints': len(byte_ranges), 'ttl': ttl }
+
+    ############################################################################
+    def remove_torrent(self, torrent_handle, forget=True, delete_files=None):
+        info_hash = str(torrent_handle.info_hash())
+
+        if forget:
+            self.torrent_store.remove_resume_data(info_hash)
+            self.torrent_store.remove_metadata(info_hash)
+            if self.content_cache:
+                self.content_cache.discard(info_hash)
+        self._resume_data_done(info_hash)
+        self.cache_pending.discard(info_hash)
+
+        self.bus.connection_monitor.remove_torrent(info_hash)
+        self.torrents.remove(info_hash)
+        self.status_cache.remove_torrent(info_hash)
+        metrics.BYTES_SERVED.remove(info_hash)
+
+        # Returns right away, completion is tracked through the alert dispatcher
+        if delete_files is None:
+            delete_files = not self.torrent_config['keep_files']
+        save_path, file_paths = self._get_torrent_files(torrent_handle) if delete_files else (None, [])
+        self.removal_queue.remove(self.session, torrent_handle, save_path, file_paths)
+        self.streaming_scheduler.remove_torrent(info_hash)
+        self.bandwidth_scheduler.remove_torrent(info_hash)
+        self.piece_notifier.notify_torrent(info_hash)
+        if self.piece_cache:
+            self.piece_cache.remove_torrent(info_hash)
 
     ############################################################################
     def remove_paused_torrents(self):
         torrent_handles_to_remove = []
-        for torrent_handle in self.torrent_handles:
+        for torrent_handle in self.torrents.get_torrent_handles():
             if torrent_handle.status().paused:
                 torrent_handles_to_remove.append(torrent_handle)
 
@@ -127,98 +279,41 @@ class DownloaderMonitor(cherrypy.process.plugins.Monitor):
             self.remove_torrent(torrent_handle)
 
     ############################################################################
-    def get_status(self):
-        result = {}
-
-        if self.session:
-            result['session'] = self.torrent_config
-            
-            result['session']['connection_sets'] = []
-            for info_hash, connection_set in self.bus.connection_monitor.torrent_connections.iteritems():
-                connection_set_status = { 'info_hash': info_hash, 'timestamp': connection_set['timestamp'], 'connections':[] }
-                
-                for connection in connection_set['set']:
-                    connection_status = { 'info_hash': info_hash, 'connection': connection }
-                    connection_set_status['connections'].append(connection_status)
-
-                result['session']['connection_sets'].append(connection_set_status)
-
-            result['session']['torrents'] = []
-            for torrent_handle in self.torrent_handles:
-                torrent_valid  = torrent_handle.has_metadata()
-                torrent_status = torrent_handle.status() if torrent_valid else None
-                
-                try:
-                    torrent = {}
-                    torrent['paused']        = torrent_status.paused
-                    torrent['state']         = str(torrent_status.state)
-                    torrent['state_index']   = int(torrent_status.state)
-                    torrent['progress']      = math.trunc(torrent_status.progress * 100.0) / 100.0
-                    torrent['download_rate'] = torrent_status.download_rate / 1024
-                    torrent['upload_rate']   = torrent_status.upload_rate / 1024
-                    torrent['num_seeds']     = torrent_status.num_seeds
-                    torrent['total_seeds']   = torrent_status.num_complete
-                    torrent['num_peers']     = torrent_status.num_peers
-                    torrent['total_peers']   = torrent_status.num_incomplete
-                    torrent['info_hash']     = str(torrent_handle.info_hash())
-
-                    video_file = self._get_video_file_from_torrent(torrent_handle)
-                    if video_file:
-                        torrent['video_file']                          = {}
-                        torrent['video_file']['path']                  = video_file.path
-                        torrent['video_file']['size']                  = video_file.size
-                        torrent['video_file']['start_piece_index']     = utils.piece_from_offset(torrent_handle, video_file.offset)
-                        torrent['video_file']['end_piece_index']       = utils.piece_from_offset(torrent_handle, video_file.offset + video_file.size)
-                        torrent['video_file']['total_pieces']          = utils.get_video_file_total_pieces(torrent_handle, video_file)
-                        torrent['video_file']['preload_buffer_pieces'] = utils.get_preload_buffer_piece_count(torrent_handle, video_file)
-                        torrent['video_file']['is_ready_fast']         = self.is_video_file_ready(torrent_handle, True, False)
-                        torrent['video_file']['is_ready_slow']         = self.is_video_file_ready(torrent_handle, False, False)
-                        torrent['video_file']['complete_pieces']       = utils.get_video_file_complete_pieces(torrent_handle, video_file)
-
-                        piece_map = ''
-                        for piece_index in range(torrent['video_file']['start_piece_index'], torrent['video_file']['end_piece_index'] + 1):
-                            if torrent_handle.have_piece(piece_index):
-                                piece_map = piece_map + '*'
-                            elif torrent_handle.piece_priority(piece_index) == 0:
-                                piece_map = piece_map + '0'
-                            elif torrent_handle.piece_priority(piece_index) == 7:
-                                piece_map = piece_map + '7'
-                            else:
-                                piece_map = piece_map + '.'
-                        torrent['video_file']['piece_map'] = piece_map
-                except:
-                    pass
-
-                result['session']['torrents'].append(torrent)
-
-        return result
+    def get_status_json(self):
+        return self.status_cache.get_json()
+
+    ############################################################################
+    def get_status_delta(self, since):
+        return self.status_cache.get_delta(since)
 
     ###########################################################################
     def is_video_file_ready_from_info_hash(self, info_hash, is_fast, log_enabled=True):
-        for torrent_handle in self.torrent_handles:
-            if str(torrent_handle.info_hash()) == info_hash:
-                return self.is_video_file_ready(torrent_handle, is_fast, log_enabled)
-        raise RuntimeError
+        entry = self.torrents.get(info_hash)
+        if not entry:
+            raise RuntimeError
+        return self._is_video_file_ready(entry, is_fast, log_enabled)
 
     ###########################################################################
     def is_video_file_ready(self, torrent_handle, is_fast, log_enabled=True):
-        if torrent_handle:
-            status     = torrent_handle.status()
-            video_file = self._get_video_file_from_torrent(torrent_handle)
+        return self._is_video_file_ready(self.torrents.get_entry(torrent_handle) if torrent_handle else None, is_fast, log_enabled)
 
-            if int(status.state) >= 3 and video_file:
-                complete_pieces = utils.get_video_file_complete_pieces(torrent_handle, video_file)
-                total_pieces    = utils.get_video_file_total_pieces(torrent_handle, video_file)
-                needed_pieces   = utils.get_preload_buffer_piece_count(torrent_handle, video_file)
+    ###########################################################################
+    def _is_video_file_ready(self, entry, is_fast, log_enabled):
+        if entry:
+            # State and rate as of the last status update, this runs on every piece
+            if entry.state is not None and int(entry.state) >= 3 and entry.update_metadata() and entry.video_file:
+                complete_pieces = entry.get_complete_pieces()
+                total_pieces    = entry.get_total_pieces()
+                needed_pieces   = entry.preload_model.get_needed_pieces(entry.download_rate)
 
                 if is_fast or complete_pieces >= needed_pieces:
                     return True
                 else:
                     if log_enabled:
-                        self.bus.log('[Downloader] Not enough pieces yet: {0}/{1} (total: {2}) @ {3} kB/s'.format(complete_pieces, needed_pieces, total_pieces, status.download_rate / 1024))
+                        self.bus.log('[Downloader] Not enough pieces yet: {0}/{1} (total: {2}) @ {3} kB/s'.format(complete_pieces, needed_pieces, total_pieces, entry.download_rate / 1024))
             else:
                 if log_enabled:
-                    self.bus.log('[Downloader] Not ready yet: {0}'.format(str(status.state)))
+                    self.bus.log('[Downloader] Not ready yet: {0}'.format(str(entry.state)))
         else:
             if log_enabled:
                 self.bus.log('[Downloader] Not ready yet')
@@ -226,17 +321,44 @@ class DownloaderMonitor(cherrypy.process.plugins.Monitor):
         return False
 
     ###########################################################################
-    def get_video_file(self, info_hash):
-        for torrent_handle in self.torrent_handles:
-            if str(torrent_handle.info_hash()) == info_hash:
-                video_file = self._get_video_file_from_torrent(torrent_handle)
-                if video_file:
-                    if torrent_handle.status().paused:
-                        torrent_handle.resume()
-                    return filewrapper.FileWrapper(self.bus, torrent_handle, video_file)
-                else:
-                    return None
-        raise RuntimeError
+    def wait_for_video_file_ready(self, info_hash, is_fast, timeout):
+        entry = self.torrents.get(info_hash)
+        if not entry:
+            raise RuntimeError
+        return entry.ready_events[is_fast].wait(timeout)
+
+    ###########################################################################
+    def get_video_file(self, info_hash, readahead=True, is_client_connected=None):
+        entry = self.torrents.get(info_hash)
+        if not entry:
+            raise RuntimeError
+
+        if not entry.update_metadata() or not entry.video_file:
+            return None
+
+        if entry.torrent_handle.status().paused:
+            entry.torrent_handle.resume()
+        return filewrapper.FileWrapper(self.bus, entry.torrent_handle, entry.video_file, readahead, is_client_connected)
+
+    ############################################################################
+    def configure_bandwidth(self, parameters):
+        config = self.bandwidth_scheduler.configure(parameters)
+
+        # The global limit stays enforced by the session, the scheduler only shares it out
+        if 'max_download_rate' in parameters:
+            self.torrent_config['max_download_rate'] = config['max_download_rate']
+            session_settings = self.session.settings()
+            session_settings.download_rate_limit = config['max_download_rate'] * 1024
+            self.session.set_settings(session_settings)
+            self.bus.log('[Downloader] Maximum download rate set to {0} kB/s'.format(config['max_download_rate']))
+
+        return self.bandwidth_scheduler.get_status()
+
+    ############################################################################
+    def get_piece_bitmap(self, torrent_handle):
+        # Handles that are not (or no longer) tracked get a throwaway empty bitmap
+        entry = self.torrents.get_entry(torrent_handle)
+        return entry.piece_bitmap if entry else pieces.PieceBitmap()
 
     ############################################################################
     def _background_task(self):
@@ -248,56 +370,457 @@ class DownloaderMonitor(cherrypy.process.plugins.Monitor):
         while self.monitor_running:
             torrent_handles_to_remove = []            
 
-            for torrent_handle in self.torrent_handles:
-                if not self.bus.connection_monitor.has_video_connections(str(torrent_handle.info_hash())):
-                    timestamp = self.bus.connection_monitor.get_last_video_connection_timestamp(str(torrent_handle.info_hash()))
+            for entry in self.torrents.get_entries():
+                if not self.bus.connection_monitor.has_video_connections(entry.info_hash):
+                    timestamp = self.bus.connection_monitor.get_last_video_connection_timestamp(entry.info_hash)
                     if (time.time() - timestamp) > 600.0:
-                        torrent_handles_to_remove.append(torrent_handle)
+                        torrent_handles_to_remove.append(entry.torrent_handle)
                     elif (time.time() - timestamp) > 30.0:
-                        if not torrent_handle.status().paused:
-                            torrent_handle.pause()
+                        if not entry.torrent_handle.status().paused:
+                            entry.torrent_handle.pause()
 
             for torrent_handle in torrent_handles_to_remove:
+                if self.content_cache:
+                    self._start_caching(torrent_handle)
+                else:
+                    self.remove_torrent(torrent_handle)
+            self._evict_cached_torrents()
+
+            if self.torrent_config['keep_files'] and (time.time() - self.resume_data_timestamp) > RESUME_DATA_INTERVAL:
+                self.resume_data_timestamp = time.time()
+                self._save_resume_data([torrent_handle for torrent_handle in self.torrents.get_torrent_handles() if torrent_handle.need_save_resume_data()])
+
+            if (time.time() - self.session_state_timestamp) > SESSION_STATE_INTERVAL:
+                self._save_session_state()
+
+            self._update_dht_status()
+            self.streaming_scheduler.update()
+            self.bandwidth_scheduler.update(self.torrents.get_entries())
+            self._publish_status()
+            self.session.post_torrent_updates()
+            time.sleep(self.frequency)
+
+    ############################################################################
+    def _on_piece_finished(self, alert):
+        entry = self.torrents.get_entry(alert.handle)
+        if entry:
+            entry.piece_bitmap.set_piece(alert.piece_index)
+            self.piece_notifier.notify_piece(entry.info_hash, alert.piece_index)
+            self._update_ready_events(entry)
+            if alert.piece_index == entry.start_piece_index:
+                self._probe_container(entry)
+            elif alert.piece_index == entry.probe_piece_index and entry.preload_model and entry.preload_model.is_probing():
+                self._read_probe_piece(entry)
+
+            # Several viewers are about to read this piece, have libtorrent hand it over from its own cache
+            if self.piece_cache and self.streaming_scheduler.get_reader_count(entry.info_hash) > 1:
+                alert.handle.read_piece(alert.piece_index)
+
+    ############################################################################
+    def _on_read_piece(self, alert):
+        entry = self.torrents.get_entry(alert.handle)
+        if not entry:
+            return
+
+        if alert.piece == entry.probe_piece_index and entry.preload_model and entry.preload_model.is_probing():
+            self._probe_piece(entry, alert)
+
+        if self.piece_cache and alert.size > 0:
+            self.piece_cache.put(entry.info_hash, alert.piece, alert.buffer)
+
+    ############################################################################
+    def _on_state_update(self, alert):
+        for torrent_status in alert.status:
+            entry = self.torrents.get_entry(torrent_status.handle)
+            if entry:
+                self._update_torrent_status(entry, torrent_status)
+                # The preload buffer follows the download rate
+                self._update_ready_events(entry)
+
+    ############################################################################
+    def _on_save_resume_data(self, alert):
+        info_hash = str(alert.handle.info_hash())
+        if info_hash in self.torrents:
+            self._store_resume_data(alert.handle, libtorrent.bencode(alert.resume_data))
+        self._finish_resume_data(alert.handle)
+
+    ############################################################################
+    def _on_save_resume_data_failed(self, alert):
+        self._finish_resume_data(alert.handle)
+
+    ############################################################################
+    def _finish_resume_data(self, torrent_handle):
+        info_hash = str(torrent_handle.info_hash())
+        self._resume_data_done(info_hash)
+        if info_hash in self.cache_pending:
+            self._cache_torrent(torrent_handle)
+
+    ############################################################################
+    def _on_torrent_removed(self, alert):
+        # The handle is no longer valid, only the info hash carried by the alert is
+        self.removal_queue.removed(str(alert.info_hash))
+
+    ############################################################################
+    def _on_torrent_deleted(self, alert):
+        self.removal_queue.storage_released(str(alert.info_hash))
+
+    ############################################################################
+    def _on_state_changed(self, alert):
+        entry = self.torrents.get_entry(alert.handle)
+        if entry:
+            entry.state = alert.state
+            self._update_ready_events(entry)
+
+    ############################################################################
+    def _on_torrent_checked(self, alert):
+        entry = self.torrents.get_entry(alert.handle)
+        if entry:
+            entry.update_metadata()
+            self._reset_piece_bitmap(entry)
+            self._update_ready_events(entry)
+            self._probe_container(entry)
+
+    ############################################################################
+    def _on_metadata_received(self, alert):
+        entry = self.torrents.get_entry(alert.handle)
+        if not entry:
+            return
+
+        self._on_torrent_checked(alert)
+        metrics.TIME_TO_METADATA.observe(time.time() - entry.add_timestamp)
+
+        self._store_metadata(alert.handle)
+        if not entry.video_file:
+            self.bus.log('[Downloader] No video file found, removing torrent')
+            self.remove_torrent(alert.handle)
+
+    ############################################################################
+    def _add_torrent(self, add_torrent_params, file_selector=None):
+        add_torrent_params['storage_mode'] = libtorrent.storage_mode_t.storage_mode_sparse
+        add_torrent_params['auto_managed'] = False
+
+        torrent_handle = self.session.add_torrent(add_torrent_params)
+        torrent_handle.set_sequential_download(True)
+        torrent_handle.resume()
+        self.bus.connection_monitor.add_torrent(str(torrent_handle.info_hash()))
+
+        entry = self.torrents.get_entry(torrent_handle)
+        if not entry:
+            entry = self.torrents.add(torrent_handle, file_selector)
+            entry.update_metadata()
+            self._reset_piece_bitmap(entry)
+        elif file_selector is not None:
+            self.select_file(entry.info_hash, file_selector)
+
+        self._update_torrent_status(entry, torrent_handle.status())
+        self._update_ready_events(entry)
+        self._probe_container(entry)
+
+        return torrent_handle
+
+    ############################################################################
+    def _resume_torrents(self):
+        for info_hash in self.torrent_store.get_resumable_info_hashes():
+            # Cached torrents stay out of the session until requested again
+            if self.content_cache and self.content_cache.get_cached(info_hash):
+                continue
+
+            resume_data = self.torrent_store.load_resume_data(info_hash)
+
+            try:
+                add_torrent_params                = {}
+                add_torrent_params['ti']          = libtorrent.torrent_info(libtorrent.bdecode(self.torrent_store.load_metadata(info_hash)))
+                add_torrent_params['resume_data'] = resume_data
+                add_torrent_params['save_path']   = libtorrent.bdecode(resume_data)['save_path']
+
+                self._add_torrent(add_torrent_params)
+                self.bus.log('[Downloader] Resumed torrent {0}'.format(info_hash))
+            except (KeyError, RuntimeError, TypeError):
+                self.bus.log('[Downloader] Invalid resume data for torrent {0}, discarding'.format(info_hash))
+                self.torrent_store.remove_resume_data(info_hash)
+
+    ############################################################################
+    def _load_session_state(self):
+        data = self.torrent_store.load_session_state()
+        if not data:
+            return False
+
+        state = libtorrent.bdecode(data)
+        if not isinstance(state, dict):
+            self.bus.log('[Downloader] Invalid session state, discarding')
+            return False
+
+        self.session.load_state(state)
+        return True
+
+    ############################################################################
+    def _save_session_state(self):
+        self.session_state_timestamp = time.time()
+
+        # A routing table still bootstrapping is worth less than the one saved before
+        if self.session.status().dht_nodes > 0:
+            self.torrent_store.save_session_state(libtorrent.bencode(self.session.save_state()))
+
+    ############################################################################
+    def _update_dht_status(self):
+        dht_nodes = self.session.status().dht_nodes
+        metrics.DHT_NODES.set(dht_nodes)
+
+        if dht_nodes > 0 and self.startup and self.startup['dht_ready_seconds'] is None:
+            self.startup['dht_ready_seconds'] = time.time() - self.start_timestamp
+            metrics.DHT_READY.set(self.startup['dht_ready_seconds'])
+            self.bus.log('[Downloader] DHT ready after {0:.2f}s with {1} nodes'.format(self.startup['dht_ready_seconds'], dht_nodes))
+
+    ############################################################################
+    def _save_resume_data(self, torrent_handles):
+        self.resume_data_saved.clear()
+
+        # All pending before the first request, the alert dispatcher may answer it right away
+        torrent_handles = [torrent_handle for torrent_handle in torrent_handles if torrent_handle.has_metadata()]
+        self.resume_data_pending.update(str(torrent_handle.info_hash()) for torrent_handle in torrent_handles)
+        for torrent_handle in torrent_handles:
+            torrent_handle.save_resume_data()
+
+        if not self.resume_data_pending:
+            self.resume_data_saved.set()
+
+    ############################################################################
+    def _start_caching(self, torrent_handle):
+        info_hash = str(torrent_handle.info_hash())
+        if info_hash in self.cache_pending:
+            return
+
+        try:
+            if not torrent_handle.has_metadata():
                 self.remove_torrent(torrent_handle)
+                return
 
-            self._alert_pump()
+            # The torrent leaves the session once its resume data is saved, see the alert dispatcher
+            self.cache_pending.add(info_hash)
+            torrent_handle.save_resume_data()
+        except RuntimeError:
+            self.cache_pending.discard(info_hash)
 
     ############################################################################
-    def _alert_pump(self):
-        while True:
-            self.session.wait_for_alert(1000)
-            alert = self.session.pop_alert()
-            if alert:
-                if alert.what() in ('cache_flushed_alert', 'external_ip_alert', 'hash_failed_alert', 'metadata_failed_alert', 'tracker_error_alert'):
-                    continue
+    def _cache_torrent(self, torrent_handle):
+        info_hash = str(torrent_handle.info_hash())
+        self.cache_pending.discard(info_hash)
+        if info_hash not in self.torrents:
+            return
 
-                self.bus.log('[Downloader][{0}] {1}'.format(alert.what(), alert.message()))
+        save_path, file_paths = self._get_torrent_files(torrent_handle)
+        if not file_paths:
+            # Nothing on disk worth keeping without metadata
+            self.remove_torrent(torrent_handle)
+            return
 
-                if isinstance(alert, libtorrent.metadata_received_alert):
-                    video_file = self._get_video_file_from_torrent(alert.handle)
+        self.content_cache.store(info_hash, save_path, file_paths, self.torrents.get(info_hash).total_done)
+        self.remove_torrent(torrent_handle, False, False)
+        self.bus.log('[Downloader] Cached torrent {0}'.format(info_hash))
 
-                    if not video_file:
-                        self.bus.log('[Downloader] No video file found, removing torrent')
-                        self.remove_torrent(torrent_handle)
+    ############################################################################
+    def _evict_cached_torrents(self):
+        if not self.content_cache:
+            return
 
-                elif alert.what() in self.expected_alert_types:
-                    self.expected_alert_received = True
-                    self.expected_alert_types    = []
-                    break
+        for info_hash, cached_entry in self.content_cache.evict(self._get_active_size()):
+            self.bus.log('[Downloader] Evicting torrent {0} from the cache'.format(info_hash))
+            self.torrent_store.remove_resume_data(info_hash)
+            self.torrent_store.remove_metadata(info_hash)
+            self.removal_queue.delete_files(info_hash, cached_entry['save_path'], cached_entry['file_paths'])
 
-            if not self.expected_alert_types:
-                break
+    ############################################################################
+    def _get_active_size(self):
+        return sum(entry.total_done for entry in self.torrents.get_entries())
 
     ############################################################################
-    def _get_video_file_from_torrent(self, torrent_handle):
-        video_file = None
-        
+    def _get_torrent_files(self, torrent_handle):
         try:
-            for file in torrent_handle.get_torrent_info().files():
-                if file.path.endswith('.mkv') or file.path.endswith('.mp4') or file.path.endswith('.avi'):
-                    if not video_file or video_file.size < file.size:
-                        video_file = file
+            if not torrent_handle.has_metadata():
+                return None, []
+
+            # Weird bad character on MacOSX
+            save_path = torrent_handle.save_path()
+            save_path = save_path if save_path[-1] in string.printable else save_path[:-1]
+            return save_path, [file.path for file in torrent_handle.get_torrent_info().files()]
         except RuntimeError:
+            return None, []
+
+    ############################################################################
+    def _store_metadata(self, torrent_handle):
+        info_hash = str(torrent_handle.info_hash())
+
+        if not self.torrent_store.has_metadata(info_hash):
+            try:
+                self.torrent_store.save_metadata(info_hash, libtorrent.bencode(libtorrent.create_torrent(torrent_handle.get_torrent_info()).generate()))
+            except RuntimeError:
+                # Torrent removed in the meantime
+                pass
+
+    ############################################################################
+    def _store_resume_data(self, torrent_handle, resume_data):
+        self._store_metadata(torrent_handle)
+        self.torrent_store.save_resume_data(str(torrent_handle.info_hash()), resume_data)
+
+    ############################################################################
+    def _resume_data_done(self, info_hash):
+        self.resume_data_pending.discard(info_hash)
+        if not self.resume_data_pending:
+            self.resume_data_saved.set()
+
+    ############################################################################
+    def _update_torrent_status(self, entry, torrent_status):
+        torrent_handle   = entry.torrent_handle
+        entry.total_done    = torrent_status.total_done
+        entry.download_rate = torrent_status.download_rate
+        entry.state         = torrent_status.state
+
+        torrent = {}
+        torrent['paused']        = torrent_status.paused
+        torrent['state']         = str(torrent_status.state)
+        torrent['state_index']   = int(torrent_status.state)
+        torrent['progress']      = math.trunc(torrent_status.progress * 100.0) / 100.0
+        torrent['download_rate'] = torrent_status.download_rate / 1024
+        torrent['upload_rate']   = torrent_status.upload_rate / 1024
+        torrent['num_seeds']     = torrent_status.num_seeds
+        torrent['total_seeds']   = torrent_status.num_complete
+        torrent['num_peers']     = torrent_status.num_peers
+        torrent['total_peers']   = torrent_status.num_incomplete
+        torrent['info_hash']     = entry.info_hash
+
+        try:
+            video_file = entry.video_file if torrent_status.has_metadata and entry.update_metadata() else None
+            if video_file:
+                torrent['files']                               = entry.get_files_status()
+                torrent['video_file']                          = {}
+                torrent['video_file']['index']                 = entry.file_index
+                torrent['video_file']['path']                  = video_file.path
+                torrent['video_file']['size']                  = video_file.size
+                torrent['video_file']['start_piece_index']     = entry.start_piece_index
+                torrent['video_file']['end_piece_index']       = entry.end_piece_index
+                torrent['video_file']['total_pieces']          = entry.get_total_pieces()
+                torrent['video_file']['preload_buffer_pieces'] = entry.preload_model.get_needed_pieces(torrent_status.download_rate)
+                torrent['video_file']['preload']               = entry.preload_model.get_status()
+                torrent['video_file']['index_ranges']          = entry.index_ranges
+                torrent['video_file']['is_ready_fast']         = entry.ready_events[True].is_set()
+                torrent['video_file']['is_ready_slow']         = entry.ready_events[False].is_set()
+                torrent['video_file']['complete_pieces']       = entry.get_complete_pieces()
+                torrent['video_file']['piece_map']             = entry.piece_bitmap.render(entry.start_piece_index, entry.end_piece_index, torrent_handle.piece_priorities())
+        except RuntimeError:
+            # Torrent removed in the meantime
+            return
+
+        self.status_cache.update_torrent(torrent['info_hash'], torrent)
+
+    ############################################################################
+    def _publish_status(self):
+        session = dict(self.torrent_config)
+
+        session['connection_sets'] = []
+        for info_hash, connection_set in self.bus.connection_monitor.get_connection_sets().iteritems():
+            connection_set_status = { 'info_hash': info_hash, 'timestamp': connection_set['timestamp'], 'connections':[] }
+
+            for connection in connection_set['set']:
+                connection_status = { 'info_hash': info_hash, 'connection': connection }
+                connection_set_status['connections'].append(connection_status)
+
+            session['connection_sets'].append(connection_set_status)
+
+        if self.content_cache:
+            session['cache'] = self.content_cache.get_status(self._get_active_size())
+
+        if self.piece_cache:
+            session['piece_cache'] = self.piece_cache.get_status()
+
+        session['bandwidth'] = self.bandwidth_scheduler.get_status()
+        session['prefetch']  = self.streaming_scheduler.get_hint_status()
+        session['startup']   = dict(self.startup)
+        session['dht_nodes'] = self.session.status().dht_nodes
+
+        self.status_cache.publish(session)
+
+    ############################################################################
+    def _reset_piece_bitmap(self, entry):
+        try:
+            if entry.torrent_handle.has_metadata():
+                entry.piece_bitmap.reset(entry.torrent_handle.status().pieces)
+        except RuntimeError:
+            # Torrent removed in the meantime
             pass
 
-        return video_file
+    ############################################################################
+    def _probe_container(self, entry):
+        # The duration is read once from the header at the start of the video file, see _on_read_piece
+        if entry.preload_model and entry.piece_bitmap.have_piece(entry.start_piece_index) and entry.preload_model.start_probe():
+            entry.probe_chunks      = []
+            entry.probe_size        = 0
+            entry.probe_needed_size = 0
+            entry.probe_piece_index = entry.start_piece_index
+            self._read_probe_piece(entry)
+
+    ############################################################################
+    def _probe_piece(self, entry, alert):
+        if alert.size > 0:
+            chunk = alert.buffer[max(0, entry.video_file.offset - alert.piece * entry.piece_length):]
+            entry.probe_chunks.append(chunk)
+            entry.probe_size = entry.probe_size + len(chunk)
+
+        # Pieces are only joined and parsed again once the part of the header known to be missing is there
+        header = None
+        if entry.probe_chunks and entry.probe_size >= entry.probe_needed_size:
+            header                  = ''.join(entry.probe_chunks)
+            entry.probe_chunks      = [header]
+            entry.probe_needed_size = container.get_header_size(header)
+
+            # Players read the index right after the head, it is found from the first piece most of the time
+            if alert.piece == entry.start_piece_index:
+                self._prefetch_index(entry, container.find_index_ranges(header, entry.video_file.size))
+
+        if alert.size > 0 and entry.probe_size < entry.probe_needed_size <= PROBE_MAX_SIZE and alert.piece < entry.end_piece_index:
+            # The header goes on past this piece, e.g. a large moov box, the pieces right after are needed for playback anyway
+            entry.probe_piece_index = alert.piece + 1
+            self._read_probe_piece(entry)
+            return
+
+        header             = header if header is not None else ''.join(entry.probe_chunks)
+        entry.probe_chunks = []
+        duration           = entry.preload_model.finish_probe(header or None)
+        self.bus.log('[Downloader] Video duration: {0}'.format('{0:.0f}s'.format(duration) if duration else 'unknown'))
+        self._update_ready_events(entry)
+        if alert.piece != entry.start_piece_index and header:
+            self._prefetch_index(entry, container.find_index_ranges(header, entry.video_file.size))
+
+    ############################################################################
+    def _read_probe_piece(self, entry):
+        try:
+            if entry.piece_bitmap.have_piece(entry.probe_piece_index):
+                entry.torrent_handle.read_piece(entry.probe_piece_index)
+            else:
+                # Read once downloaded, see _on_piece_finished
+                entry.torrent_handle.set_piece_deadline(entry.probe_piece_index, INDEX_DEADLINE)
+        except RuntimeError:
+            entry.probe_chunks = []
+            entry.preload_model.finish_probe(None)
+
+    ############################################################################
+    def _prefetch_index(self, entry, index_ranges):
+        # Players read the index right after the head, it must not wait for the sequential download to reach it
+        entry.index_ranges = index_ranges
+        for offset, size in index_ranges:
+            self.bus.log('[Downloader] Prefetching video index at {0} ({1} bytes)'.format(offset, size))
+            start_piece_index = (entry.video_file.offset + offset) / entry.piece_length
+            end_piece_index   = (entry.video_file.offset + offset + size - 1) / entry.piece_length
+            for piece_index in range(start_piece_index, end_piece_index + 1):
+                if not entry.piece_bitmap.have_piece(piece_index):
+                    entry.torrent_handle.set_piece_deadline(piece_index, INDEX_DEADLINE)
+
+    ############################################################################
+    def _update_ready_events(self, entry):
+        try:
+            for is_fast, ready_event in entry.ready_events.iteritems():
+                if not ready_event.is_set() and self._is_video_file_ready(entry, is_fast, False):
+                    ready_event.set()
+                    metrics.TIME_TO_READY.observe(time.time() - entry.add_timestamp, 'fast' if is_fast else 'buffered')
+        except RuntimeError:
+            # Torrent removed in the meantime
+            pass
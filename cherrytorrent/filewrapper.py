@@ -1,18 +1,31 @@
 ################################################################################
 import io
+import metrics
+import mmap
 import os
+import pieces
 import string
+import threading
 import time
-import utils
+
+################################################################################
+PIECE_WAIT_TIMEOUT = 120.0
+PIECE_WAIT_SLICE   = 1.0
+READAHEAD_PIECES   = 8
 
 ################################################################################
 class FileWrapper(io.RawIOBase):
     ############################################################################
-    def __init__(self, bus, torrent_handle, torrent_file):
-        self.bus            = bus
-        self.torrent_handle = torrent_handle
-        self.piece_length   = self.torrent_handle.get_torrent_info().piece_length()
-        self.torrent_file   = torrent_file
+    def __init__(self, bus, torrent_handle, torrent_file, readahead=True, is_client_connected=None):
+        self.bus                 = bus
+        self.torrent_handle      = torrent_handle
+        self.piece_length        = self.torrent_handle.get_torrent_info().piece_length()
+        self.torrent_file        = torrent_file
+        self.info_hash           = str(self.torrent_handle.info_hash())
+        self.waiter              = pieces.PieceWaiter(self.bus.downloader_monitor.piece_notifier, self.torrent_handle)
+        self.scheduler           = self.bus.downloader_monitor.streaming_scheduler
+        self.piece_cache         = self.bus.downloader_monitor.piece_cache
+        self.is_client_connected = is_client_connected
 
         # Weird bad character on MacOSX
         save_path = self.torrent_handle.save_path()
@@ -21,59 +34,310 @@ class FileWrapper(io.RawIOBase):
         self.path = os.path.join(save_path, torrent_file.path)
         self.size = torrent_file.size
 
-        while not os.path.isfile(self.path):
-            time.sleep(0.1)
+        self.file      = None
+        self.map       = None
+        self.open_lock = threading.Lock()
+        self.position  = 0
+
+        self.seek_timestamp = None
 
-        self.file = open(self.path, 'rb')
-        self.virtual_read = False
+        self.scheduler.add_reader(self)
+        metrics.ACTIVE_READERS.inc()
+
+        self.readahead = Readahead(self) if readahead and Readahead.is_supported() else None
+        if self.readahead:
+            self.readahead.start()
 
     ############################################################################
-    def seek(self, offset, whence=io.SEEK_SET):
+    def seek(self, offset, whence=io.SEEK_SET, wait=True):
+        self.seek_timestamp = time.time()
+
         if whence == io.SEEK_SET:
             new_position = offset
         elif whence == io.SEEK_CUR:
-            new_position = self.file.tell() + offset
+            new_position = self.position + offset
         elif whence == io.SEEK_END:
             new_position = self.size + offset
 
-        piece_index = utils.piece_from_offset(self.torrent_handle, self.torrent_file.offset + new_position)
+        piece_index = self.piece_from_offset(self.torrent_file.offset + new_position)
         self.bus.log('[FileWrapper] Seeking to piece {0}'.format(piece_index))
-        self._wait_for_piece(piece_index)
-        return self.file.seek(offset, whence)
-        
+        self.scheduler.update_playhead(self, new_position)
+        if wait:
+            self._wait_for_piece(piece_index)
+        self._set_position(new_position)
+        return self.position
+
+    ############################################################################
+    def tell(self):
+        return self.position
+
+    ############################################################################
+    def readable(self):
+        return True
+
     ############################################################################
     def read(self, size=-1):
-        if self.virtual_read:
-           self.virtual_read = False
-           return ''
+        view = self.read_view(size)
+        return view.tobytes() if isinstance(view, memoryview) else bytes(view)
 
+    ############################################################################
+    def readinto(self, buffer):
+        view = self.read_view(len(buffer))
+        buffer[:len(view)] = view
+        return len(view)
+
+    ############################################################################
+    def read_view(self, size=-1):
         if size == -1:
-            size = self.size - self.file.tell()
-        
-        result = ''
-        while size > 0:
-            part_read_size = min(size, self.piece_length)
-            piece_index    = utils.piece_from_offset(self.torrent_handle, self.torrent_file.offset + self.file.tell() + part_read_size)
+            size = self.size - self.position
+        size = max(0, min(size, self.size - self.position))
+        if size == 0:
+            return b''
+
+        self.scheduler.update_playhead(self, self.position)
+        start_piece_index = self.piece_from_offset(self.torrent_file.offset + self.position)
+        end_piece_index   = self.piece_from_offset(self.torrent_file.offset + self.position + size - 1)
+        for piece_index in range(start_piece_index, end_piece_index + 1):
             self._wait_for_piece(piece_index)
-            result = result + self.file.read(part_read_size)
-            size   = size - part_read_size
 
-        return result            
+        return self._view(size)
+
+    ############################################################################
+    def piece_from_offset(self, offset):
+        return offset / self.piece_length
+
+    ############################################################################
+    def completed_bytes(self, size):
+        size = max(0, min(size, self.size - self.position))
+        if size == 0:
+            return 0
+
+        piece_bitmap      = self.bus.downloader_monitor.get_piece_bitmap(self.torrent_handle)
+        start_piece_index = self.piece_from_offset(self.torrent_file.offset + self.position)
+        end_piece_index   = self.piece_from_offset(self.torrent_file.offset + self.position + size - 1)
+        complete_pieces   = piece_bitmap.contiguous_pieces(start_piece_index, end_piece_index)
+        if complete_pieces == 0:
+            return 0
+
+        completed_end = (start_piece_index + complete_pieces) * self.piece_length - self.torrent_file.offset
+        return min(size, completed_end - self.position)
+
+    ############################################################################
+    def read_completed(self, size):
+        # Only valid for ranges reported by completed_bytes(), no piece is waited for
+        self.scheduler.update_playhead(self, self.position)
+        return self._view(size)
 
     ############################################################################
     def close(self):
-        return self.file.close()
+        if self.waiter.cancelled:
+            return
+
+        self.waiter.cancel()
+        metrics.ACTIVE_READERS.dec()
+        if self.readahead:
+            self.readahead.stop()
+        self.scheduler.remove_reader(self)
+
+        with self.open_lock:
+            if self.map:
+                try:
+                    self.map.close()
+                except BufferError:
+                    # A view is still being sent, the mapping goes away with it
+                    pass
+                self.map = None
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    ############################################################################
+    def advise(self, piece_index):
+        with self.open_lock:
+            if not self.file:
+                return
+
+            start = max(0, piece_index * self.piece_length - self.torrent_file.offset)
+            end   = min(self.size, (piece_index + 1) * self.piece_length - self.torrent_file.offset)
+            if end <= start:
+                return
+
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self.file.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+            elif self.map and hasattr(self.map, 'madvise') and start < len(self.map):
+                page_start = start - start % mmap.PAGESIZE
+                self.map.madvise(mmap.MADV_WILLNEED, page_start, min(end, len(self.map)) - page_start)
+
+    ############################################################################
+    def _set_position(self, position):
+        if self.readahead and self.piece_from_offset(self.torrent_file.offset + position) != self.piece_from_offset(self.torrent_file.offset + self.position):
+            self.readahead.wake()
+        self.position = position
+
+    ############################################################################
+    def _view(self, size):
+        view = self._cached_view(size) if self.piece_cache else None
+        if view is None:
+            view = self._disk_view(self.position, size)
+
+        self._set_position(self.position + len(view))
+
+        metrics.BYTES_SERVED.inc(len(view), self.info_hash)
+        if self.seek_timestamp is not None and len(view) > 0:
+            metrics.SEEK_FIRST_BYTE.observe(time.time() - self.seek_timestamp)
+            self.seek_timestamp = None
+
+        return view
+
+    ############################################################################
+    def _cached_view(self, size):
+        offset      = self.torrent_file.offset + self.position
+        piece_index = self.piece_from_offset(offset)
+
+        data = self.piece_cache.get(self.info_hash, piece_index)
+        if data is None:
+            # A lone reader is better served straight from the mapping
+            if self.scheduler.get_reader_count(self.info_hash) < 2:
+                return None
+            data = self._read_piece(piece_index)
+            if data is None:
+                return None
+            self.piece_cache.put(self.info_hash, piece_index, data)
+
+        # Never past the end of the piece, the caller reads again for the rest
+        start = offset - piece_index * self.piece_length
+        return memoryview(data)[start:start + min(size, len(data) - start)]
+
+    ############################################################################
+    def _read_piece(self, piece_index):
+        # Only pieces lying entirely inside this file can be cached from it, the caller already waited for them
+        start = piece_index * self.piece_length - self.torrent_file.offset
+        if start < 0 or start + self.piece_length > self.size:
+            return None
+
+        view = self._disk_view(start, self.piece_length)
+        if len(view) != self.piece_length:
+            return None
+        return view.tobytes() if isinstance(view, memoryview) else bytes(view)
+
+    ############################################################################
+    def _disk_view(self, position, size):
+        self._open()
+
+        if not self.map or len(self.map) < position + size:
+            self._map()
+
+        if self.map and len(self.map) >= position + size:
+            try:
+                return memoryview(self.map)[position:position + size]
+            except TypeError:
+                # Python 2 mmap objects only expose the old buffer interface
+                return buffer(self.map, position, size)
+
+        # Sparse file not extended to its full size yet
+        self.file.seek(position)
+        return self.file.read(size)
+
+    ############################################################################
+    def _open(self):
+        with self.open_lock:
+            if not self.file:
+                # libtorrent may still hold the first piece in its write cache, give it a moment to reach the disk
+                wait_timestamp = time.time()
+                while not os.path.isfile(self.path):
+                    if self.waiter.cancelled:
+                        raise IOError('Reader closed while waiting for {0}'.format(self.path))
+                    if self.is_client_connected and not self.is_client_connected():
+                        raise IOError('Client went away while waiting for {0}'.format(self.path))
+                    if time.time() - wait_timestamp >= PIECE_WAIT_TIMEOUT:
+                        raise IOError('Timed out waiting for {0}'.format(self.path))
+                    time.sleep(0.1)
+                self.file = open(self.path, 'rb')
+
+    ############################################################################
+    def _map(self):
+        with self.open_lock:
+            file_size = os.fstat(self.file.fileno()).st_size
+            if file_size == 0 or (self.map and len(self.map) >= file_size):
+                return
+
+            if self.map:
+                try:
+                    self.map.close()
+                except BufferError:
+                    pass
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
     ############################################################################
     def _wait_for_piece(self, piece_index):
         if not self.torrent_handle.have_piece(piece_index):
-            end_piece_index = utils.piece_from_offset(self.torrent_handle, self.torrent_file.offset + self.torrent_file.size)
-            if (end_piece_index - piece_index) <= utils.get_preload_buffer_piece_count(self.torrent_handle, self.torrent_file) * 2:
-               self.bus.log('[FileWrapper] Virtual read for piece {0}'.format(piece_index))
-               self.virtual_read = True
-               return
-
             self.bus.log('[FileWrapper] Waiting for piece {0}'.format(piece_index))
-            while not self.torrent_handle.have_piece(piece_index):
-                time.sleep(0.1)
+            wait_timestamp = time.time()
+            try:
+                # Waits in slices so that a client that went away does not hold the reader until the timeout
+                piece_available = False
+                while not piece_available and not self.waiter.cancelled and time.time() - wait_timestamp < PIECE_WAIT_TIMEOUT:
+                    piece_available = self.waiter.wait(piece_index, min(PIECE_WAIT_SLICE, PIECE_WAIT_TIMEOUT - (time.time() - wait_timestamp)))
+                    if not piece_available and self.is_client_connected and not self.is_client_connected():
+                        self.close()
+                        raise IOError('Client went away while waiting for piece {0}'.format(piece_index))
+            except RuntimeError:
+                raise IOError('Torrent removed while waiting for piece {0}'.format(piece_index))
+            if not piece_available:
+                if self.waiter.cancelled:
+                    raise IOError('Reader closed while waiting for piece {0}'.format(piece_index))
+                raise IOError('Timed out waiting for piece {0}'.format(piece_index))
+            metrics.PIECE_WAIT.observe(time.time() - wait_timestamp)
             self.bus.log('[FileWrapper] Piece {0} downloaded'.format(piece_index))
+
+################################################################################
+class Readahead(threading.Thread):
+    ############################################################################
+    @staticmethod
+    def is_supported():
+        return hasattr(os, 'posix_fadvise') or hasattr(mmap.mmap, 'madvise')
+
+    ############################################################################
+    def __init__(self, file_wrapper):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.file_wrapper = file_wrapper
+        self.waiter       = pieces.PieceWaiter(file_wrapper.bus.downloader_monitor.piece_notifier, file_wrapper.torrent_handle)
+        self.moved        = threading.Event()
+
+    ############################################################################
+    def wake(self):
+        self.moved.set()
+        self.waiter.interrupt()
+
+    ############################################################################
+    def stop(self):
+        self.waiter.cancel()
+        self.moved.set()
+
+    ############################################################################
+    def run(self):
+        file_wrapper    = self.file_wrapper
+        end_piece_index = file_wrapper.piece_from_offset(file_wrapper.torrent_file.offset + file_wrapper.torrent_file.size - 1)
+        next_piece      = -1
+
+        try:
+            while not self.waiter.cancelled:
+                self.moved.clear()
+
+                playhead_piece = file_wrapper.piece_from_offset(file_wrapper.torrent_file.offset + file_wrapper.position)
+                if next_piece < playhead_piece or next_piece > playhead_piece + READAHEAD_PIECES:
+                    next_piece = playhead_piece
+
+                if next_piece > min(end_piece_index, playhead_piece + READAHEAD_PIECES):
+                    # Far enough ahead, wait for the reader to catch up
+                    self.moved.wait()
+                    continue
+
+                if self.waiter.wait(next_piece, PIECE_WAIT_TIMEOUT):
+                    file_wrapper.advise(next_piece)
+                    next_piece = next_piece + 1
+        except (EnvironmentError, RuntimeError, ValueError):
+            # Torrent removed or file closed underneath us, readahead is best effort
+            pass
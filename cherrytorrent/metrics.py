@@ -0,0 +1,142 @@
+################################################################################
+import threading
+
+################################################################################
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+################################################################################
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+################################################################################
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+################################################################################
+class Metric:
+    ############################################################################
+    def __init__(self, name, help, label_names=()):
+        self.name        = name
+        self.help        = help
+        self.label_names = tuple(label_names)
+        self.lock        = threading.Lock()
+        self.values      = {}
+
+    ############################################################################
+    def remove(self, *label_values):
+        with self.lock:
+            self.values.pop(tuple(label_values), None)
+
+    ############################################################################
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        with self.lock:
+            for label_values, value in sorted(self.values.iteritems()):
+                lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+################################################################################
+class Counter(Metric):
+    type = 'counter'
+
+    ############################################################################
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+################################################################################
+class Gauge(Metric):
+    type = 'gauge'
+
+    ############################################################################
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    ############################################################################
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    ############################################################################
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+################################################################################
+class Histogram(Metric):
+    type = 'histogram'
+
+    ############################################################################
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    ############################################################################
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = { 'counts': [0] * len(self.buckets), 'sum': 0.0 }
+
+            series = self.values[label_values]
+            for bucket_index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    series['counts'][bucket_index] = series['counts'][bucket_index] + 1
+                    break
+            series['sum'] = series['sum'] + value
+
+    ############################################################################
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        with self.lock:
+            for label_values, series in sorted(self.values.iteritems()):
+                cumulative_count = 0
+                for bucket, count in zip(self.buckets, series['counts']):
+                    cumulative_count = cumulative_count + count
+                    lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(self.label_names, label_values, ('le', _format_value(bucket))), cumulative_count))
+                lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(series['sum'])))
+                lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), cumulative_count))
+        return lines
+
+################################################################################
+class Registry:
+    ############################################################################
+    def __init__(self):
+        self.metrics = []
+
+    ############################################################################
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    ############################################################################
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+################################################################################
+REGISTRY = Registry()
+
+TIME_TO_METADATA = REGISTRY.register(Histogram('cherrytorrent_time_to_metadata_seconds', 'Time from adding a torrent to receiving its metadata'))
+TIME_TO_READY    = REGISTRY.register(Histogram('cherrytorrent_time_to_ready_seconds', 'Time from adding a torrent to its video file being ready', ('mode',)))
+PIECE_WAIT       = REGISTRY.register(Histogram('cherrytorrent_piece_wait_seconds', 'Time a reader spent blocked waiting for a piece'))
+SEEK_FIRST_BYTE  = REGISTRY.register(Histogram('cherrytorrent_seek_first_byte_seconds', 'Time from a seek to the first byte read after it'))
+BYTES_SERVED     = REGISTRY.register(Counter('cherrytorrent_bytes_served_total', 'Bytes read by HTTP clients', ('info_hash',)))
+ALERT_PUMP_LAG   = REGISTRY.register(Histogram('cherrytorrent_alert_pump_lag_seconds', 'Time between two drains of the libtorrent alert queue'))
+ALERT_QUEUE      = REGISTRY.register(Gauge('cherrytorrent_alert_queue_depth', 'Alerts processed by the last drain of the alert queue'))
+ACTIVE_READERS   = REGISTRY.register(Gauge('cherrytorrent_active_readers', 'Video files currently open by HTTP clients'))
+SESSION_STARTUP  = REGISTRY.register(Gauge('cherrytorrent_session_startup_seconds', 'Time taken to start the libtorrent session, saved state and resumed torrents included'))
+DHT_READY        = REGISTRY.register(Gauge('cherrytorrent_dht_ready_seconds', 'Time from starting the session to the DHT knowing its first nodes'))
+DHT_NODES        = REGISTRY.register(Gauge('cherrytorrent_dht_nodes', 'Nodes in the DHT routing table'))
+
+PIECE_CACHE_HITS   = REGISTRY.register(Counter('cherrytorrent_piece_cache_hits_total', 'Reads served from the in-memory piece cache'))
+PIECE_CACHE_MISSES = REGISTRY.register(Counter('cherrytorrent_piece_cache_misses_total', 'Reads that missed the in-memory piece cache'))
+PIECE_CACHE_SIZE   = REGISTRY.register(Gauge('cherrytorrent_piece_cache_bytes', 'Bytes held by the in-memory piece cache'))
@@ -0,0 +1,218 @@
+################################################################################
+import collections
+import metrics
+import threading
+import time
+
+################################################################################
+class PieceNotifier:
+    ############################################################################
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.waiters = {}
+
+    ############################################################################
+    def register(self, info_hash, piece_index, event):
+        with self.lock:
+            self.waiters.setdefault((info_hash, piece_index), set()).add(event)
+
+    ############################################################################
+    def unregister(self, info_hash, piece_index, event):
+        with self.lock:
+            events = self.waiters.get((info_hash, piece_index))
+            if events:
+                events.discard(event)
+                if not events:
+                    del self.waiters[(info_hash, piece_index)]
+
+    ############################################################################
+    def notify_piece(self, info_hash, piece_index):
+        with self.lock:
+            events = self.waiters.pop((info_hash, piece_index), None)
+
+        if events:
+            for event in events:
+                event.set()
+
+    ############################################################################
+    def notify_torrent(self, info_hash):
+        with self.lock:
+            keys   = [key for key in self.waiters if key[0] == info_hash]
+            events = [event for key in keys for event in self.waiters.pop(key)]
+
+        for event in events:
+            event.set()
+
+################################################################################
+class PieceWaiter:
+    ############################################################################
+    def __init__(self, notifier, torrent_handle):
+        self.notifier       = notifier
+        self.torrent_handle = torrent_handle
+        self.info_hash      = str(torrent_handle.info_hash())
+        self.event          = threading.Event()
+        self.cancelled      = False
+        self.interrupted    = False
+
+    ############################################################################
+    def wait(self, piece_index, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while not self.torrent_handle.have_piece(piece_index):
+            if self.cancelled or self.interrupted:
+                self.interrupted = False
+                return False
+
+            # Register before checking again so that a notification sent in between is not lost
+            self.event.clear()
+            self.notifier.register(self.info_hash, piece_index, self.event)
+            try:
+                if self.torrent_handle.have_piece(piece_index) or self.cancelled or self.interrupted:
+                    continue
+
+                if deadline is None:
+                    self.event.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.event.wait(remaining)
+            finally:
+                self.notifier.unregister(self.info_hash, piece_index, self.event)
+
+        return True
+
+    ############################################################################
+    def interrupt(self):
+        self.interrupted = True
+        self.event.set()
+
+    ############################################################################
+    def cancel(self):
+        self.cancelled = True
+        self.event.set()
+
+################################################################################
+PIECE_MAP_CHARS = '0......7'
+
+################################################################################
+class PieceBitmap:
+    ############################################################################
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.pieces  = bytearray()
+        self.cursors = {}
+
+    ############################################################################
+    def reset(self, pieces):
+        new_pieces = bytearray(1 if piece else 0 for piece in pieces)
+
+        with self.lock:
+            # Keep pieces reported by alerts that may be more recent than the given status
+            if len(new_pieces) == len(self.pieces):
+                new_pieces = bytearray(new | old for new, old in zip(new_pieces, self.pieces))
+            self.pieces  = new_pieces
+            self.cursors = {}
+
+    ############################################################################
+    def set_piece(self, piece_index):
+        with self.lock:
+            if piece_index < len(self.pieces):
+                self.pieces[piece_index] = 1
+
+    ############################################################################
+    def have_piece(self, piece_index):
+        return piece_index < len(self.pieces) and self.pieces[piece_index] == 1
+
+    ############################################################################
+    def contiguous_pieces(self, start_piece_index, end_piece_index):
+        with self.lock:
+            end_piece_index = min(end_piece_index, len(self.pieces) - 1)
+            if end_piece_index < start_piece_index:
+                return 0
+
+            # Pieces are never lost, so the first missing piece only ever moves forward
+            cursor = self.cursors.get(start_piece_index, start_piece_index)
+            if cursor <= end_piece_index:
+                missing_piece_index = self.pieces.find(b'\x00', cursor, end_piece_index + 1)
+                cursor              = missing_piece_index if missing_piece_index != -1 else end_piece_index + 1
+                self.cursors[start_piece_index] = cursor
+
+            return min(cursor, end_piece_index + 1) - start_piece_index
+
+    ############################################################################
+    def render(self, start_piece_index, end_piece_index, piece_priorities):
+        prefix_count = self.contiguous_pieces(start_piece_index, end_piece_index)
+        tail_start   = start_piece_index + prefix_count
+
+        with self.lock:
+            tail_pieces = self.pieces[tail_start:end_piece_index + 1]
+
+        tail_priorities = piece_priorities[tail_start:end_piece_index + 1]
+        tail            = ''.join('*' if have else PIECE_MAP_CHARS[priority] for have, priority in zip(tail_pieces, tail_priorities))
+        return '*' * prefix_count + tail
+
+################################################################################
+class PieceCache:
+    ############################################################################
+    def __init__(self, max_size):
+        self.lock     = threading.Lock()
+        self.max_size = max_size
+        self.size     = 0
+        self.pieces   = collections.OrderedDict()
+        self.hits     = 0
+        self.misses   = 0
+
+    ############################################################################
+    def get(self, info_hash, piece_index):
+        with self.lock:
+            data = self.pieces.pop((info_hash, piece_index), None)
+            if data is None:
+                self.misses = self.misses + 1
+            else:
+                # Move to the most recently used end
+                self.pieces[(info_hash, piece_index)] = data
+                self.hits = self.hits + 1
+
+        if data is None:
+            metrics.PIECE_CACHE_MISSES.inc()
+        else:
+            metrics.PIECE_CACHE_HITS.inc()
+        return data
+
+    ############################################################################
+    def put(self, info_hash, piece_index, data):
+        if len(data) > self.max_size:
+            return
+
+        with self.lock:
+            previous_data = self.pieces.pop((info_hash, piece_index), None)
+            if previous_data is not None:
+                self.size = self.size - len(previous_data)
+
+            self.pieces[(info_hash, piece_index)] = data
+            self.size = self.size + len(data)
+            while self.size > self.max_size:
+                key, evicted_data = self.pieces.popitem(last=False)
+                self.size = self.size - len(evicted_data)
+            size = self.size
+
+        metrics.PIECE_CACHE_SIZE.set(size)
+
+    ############################################################################
+    def get_status(self):
+        with self.lock:
+            return { 'max_size': self.max_size,
+                     'size':     self.size,
+                     'pieces':   len(self.pieces),
+                     'hits':     self.hits,
+                     'misses':   self.misses }
+
+    ############################################################################
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            for key in [key for key in self.pieces if key[0] == info_hash]:
+                self.size = self.size - len(self.pieces.pop(key))
+            size = self.size
+
+        metrics.PIECE_CACHE_SIZE.set(size)
@@ -0,0 +1,77 @@
+################################################################################
+import container
+import math
+import threading
+import utils
+
+################################################################################
+MIN_BUFFER_DURATION = 4.0
+RATE_SAFETY_FACTOR  = 0.8
+
+################################################################################
+class PreloadModel:
+    ############################################################################
+    def __init__(self, file_size, piece_length, total_pieces):
+        self.lock         = threading.Lock()
+        self.file_size    = file_size
+        self.piece_length = piece_length
+        self.total_pieces = total_pieces
+        self.ratio_pieces = min(total_pieces, int(math.ceil(total_pieces * utils.PRELOAD_RATIO)))
+        self.duration     = None
+        self.probing      = False
+        self.probed       = False
+
+        self.download_rate = 0
+        self.needed_pieces = self.ratio_pieces
+
+    ############################################################################
+    def start_probe(self):
+        with self.lock:
+            if self.probing or self.probed:
+                return False
+            self.probing = True
+            return True
+
+    ############################################################################
+    def is_probing(self):
+        with self.lock:
+            return self.probing
+
+    ############################################################################
+    def finish_probe(self, header):
+        duration = container.parse_duration(header) if header else None
+
+        with self.lock:
+            self.duration = duration
+            self.probing  = False
+            self.probed   = True
+        return duration
+
+    ############################################################################
+    def get_bitrate(self):
+        with self.lock:
+            return self.file_size / self.duration if self.duration else None
+
+    ############################################################################
+    def get_needed_pieces(self, download_rate):
+        with self.lock:
+            needed_pieces = self.ratio_pieces
+            if self.duration:
+                # Whatever playback consumes faster than the swarm delivers must be there before it starts
+                bitrate       = self.file_size / self.duration
+                needed_size   = self.file_size * max(0.0, 1.0 - download_rate * RATE_SAFETY_FACTOR / bitrate)
+                needed_size   = max(needed_size, bitrate * MIN_BUFFER_DURATION)
+                needed_pieces = max(1, min(self.total_pieces, int(math.ceil(needed_size / self.piece_length))))
+
+            self.download_rate = download_rate
+            self.needed_pieces = needed_pieces
+            return needed_pieces
+
+    ############################################################################
+    def get_status(self):
+        with self.lock:
+            return { 'source':        'bitrate' if self.duration else 'ratio',
+                     'duration':      self.duration,
+                     'bitrate':       self.file_size / self.duration if self.duration else None,
+                     'download_rate': self.download_rate,
+                     'needed_pieces': self.needed_pieces }
@@ -0,0 +1,198 @@
+################################################################################
+import os
+import pieces
+import preload
+import threading
+import time
+
+################################################################################
+VIDEO_FILE_EXTENSIONS  = ('.mkv', '.mp4', '.avi')
+SELECTED_FILE_PRIORITY = 1
+
+################################################################################
+class TorrentEntry:
+    ############################################################################
+    def __init__(self, torrent_handle, file_selector=None):
+        self.lock           = threading.Lock()
+        self.torrent_handle = torrent_handle
+        self.info_hash      = str(torrent_handle.info_hash())
+        self.add_timestamp  = time.time()
+        self.piece_bitmap   = pieces.PieceBitmap()
+        self.ready_events   = { True: threading.Event(), False: threading.Event() }
+        self.total_done     = 0
+        self.download_rate  = 0
+        self.state          = None
+        self.file_selector  = file_selector
+
+        # Filled in once the metadata is known, then again whenever another file is selected
+        self.has_metadata      = False
+        self.files             = []
+        self.file_index        = None
+        self.video_file        = None
+        self.piece_length      = None
+        self.start_piece_index = None
+        self.end_piece_index   = None
+        self.preload_model     = None
+        self.index_ranges      = []
+
+        # Header pieces read so far while probing the container, see DownloaderMonitor._on_read_piece
+        self.probe_chunks      = []
+        self.probe_size        = 0
+        self.probe_needed_size = 0
+        self.probe_piece_index = None
+
+    ############################################################################
+    def update_metadata(self):
+        with self.lock:
+            if self.has_metadata:
+                return True
+
+            try:
+                if not self.torrent_handle.has_metadata():
+                    return False
+                torrent_info = self.torrent_handle.get_torrent_info()
+                files        = torrent_info.files()
+            except RuntimeError:
+                # Torrent removed in the meantime
+                return False
+
+            self.piece_length = torrent_info.piece_length()
+            self.files        = list(files)
+
+            file_index = None
+            if self.file_selector is not None:
+                try:
+                    file_index = self._find_file(self.file_selector)
+                except ValueError:
+                    # Selected before the metadata was known, the default will do
+                    self.file_selector = None
+            if file_index is None:
+                file_index = self._find_largest_video_file()
+
+            self._set_video_file(file_index)
+            self.has_metadata = True
+            return True
+
+    ############################################################################
+    def select_file(self, file_selector):
+        # True when another file got selected, the selection is kept for later without metadata
+        with self.lock:
+            if not self.has_metadata:
+                self.file_selector = file_selector
+                return False
+
+            file_index         = self._find_file(file_selector)
+            self.file_selector = file_selector
+            if file_index == self.file_index:
+                return False
+
+            self._set_video_file(file_index)
+            return True
+
+    ############################################################################
+    def get_files_status(self):
+        with self.lock:
+            return [{ 'index': file_index, 'path': file.path, 'size': file.size, 'selected': file_index == self.file_index } for file_index, file in enumerate(self.files)]
+
+    ############################################################################
+    def get_total_pieces(self):
+        return max(1, self.end_piece_index - self.start_piece_index)
+
+    ############################################################################
+    def get_complete_pieces(self):
+        return self.piece_bitmap.contiguous_pieces(self.start_piece_index, self.end_piece_index)
+
+    ############################################################################
+    def _find_file(self, file_selector):
+        # Either the index of the file in the torrent, or its path or name
+        if str(file_selector).isdigit():
+            file_index = int(file_selector)
+            if file_index >= len(self.files):
+                raise ValueError('No file {0} in torrent {1}'.format(file_selector, self.info_hash))
+            return file_index
+
+        for file_index, file in enumerate(self.files):
+            if file.path == file_selector or os.path.basename(file.path) == file_selector:
+                return file_index
+        raise ValueError('No file {0} in torrent {1}'.format(file_selector, self.info_hash))
+
+    ############################################################################
+    def _find_largest_video_file(self):
+        largest_file_index = None
+        for file_index, file in enumerate(self.files):
+            if file.path.endswith(VIDEO_FILE_EXTENSIONS):
+                if largest_file_index is None or self.files[largest_file_index].size < file.size:
+                    largest_file_index = file_index
+        return largest_file_index
+
+    ############################################################################
+    def _set_video_file(self, file_index):
+        video_file = self.files[file_index] if file_index is not None else None
+
+        if video_file:
+            self.start_piece_index = video_file.offset / self.piece_length
+            self.end_piece_index   = (video_file.offset + video_file.size) / self.piece_length
+            self.preload_model     = preload.PreloadModel(video_file.size, self.piece_length, self.get_total_pieces())
+
+            # Everything else in the torrent would only take bandwidth and disk from the selected file
+            try:
+                self.torrent_handle.prioritize_files([SELECTED_FILE_PRIORITY if index == file_index else 0 for index in range(len(self.files))])
+            except RuntimeError:
+                # Torrent removed in the meantime
+                pass
+
+        self.file_index   = file_index
+        self.video_file   = video_file
+        self.index_ranges = []
+
+################################################################################
+class TorrentRegistry:
+    ############################################################################
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.entries = {}
+
+    ############################################################################
+    def add(self, torrent_handle, file_selector=None):
+        info_hash = str(torrent_handle.info_hash())
+
+        with self.lock:
+            entry = self.entries.get(info_hash)
+            if not entry:
+                entry = TorrentEntry(torrent_handle, file_selector)
+                self.entries[info_hash] = entry
+            return entry
+
+    ############################################################################
+    def remove(self, info_hash):
+        with self.lock:
+            return self.entries.pop(info_hash, None)
+
+    ############################################################################
+    def get(self, info_hash):
+        with self.lock:
+            return self.entries.get(info_hash)
+
+    ############################################################################
+    def get_entry(self, torrent_handle):
+        return self.get(str(torrent_handle.info_hash()))
+
+    ############################################################################
+    def get_entries(self):
+        with self.lock:
+            return self.entries.values()
+
+    ############################################################################
+    def get_torrent_handles(self):
+        with self.lock:
+            return [entry.torrent_handle for entry in self.entries.itervalues()]
+
+    ############################################################################
+    def __contains__(self, info_hash):
+        with self.lock:
+            return info_hash in self.entries
+
+    ############################################################################
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
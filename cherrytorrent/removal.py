@@ -0,0 +1,136 @@
+################################################################################
+import errno
+import libtorrent
+import os
+import Queue
+import threading
+import time
+
+################################################################################
+DELETION_WORKERS = 4
+
+################################################################################
+class RemovalQueue:
+    ############################################################################
+    def __init__(self, bus, worker_count=DELETION_WORKERS):
+        self.bus          = bus
+        self.worker_count = worker_count
+        self.condition    = threading.Condition()
+        self.pending      = {}
+        self.deleting     = 0
+        self.deletions    = Queue.Queue()
+        self.workers      = []
+
+    ############################################################################
+    def start(self):
+        for worker_index in range(self.worker_count):
+            worker = threading.Thread(target=self._delete_files, name='RemovalWorker-{0}'.format(worker_index))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    ############################################################################
+    def stop(self):
+        for worker in self.workers:
+            self.deletions.put(None)
+        self.workers = []
+
+    ############################################################################
+    def remove(self, session, torrent_handle, save_path, file_paths):
+        info_hash = str(torrent_handle.info_hash())
+        with self.condition:
+            self.pending[info_hash] = (save_path, file_paths)
+
+        # The disk thread may still hold the files and have writes queued when the torrent is removed,
+        # with delete_files libtorrent only reports the deletion once its storage is released
+        try:
+            session.remove_torrent(torrent_handle, libtorrent.options_t.delete_files if file_paths else 0)
+        except RuntimeError:
+            self.storage_released(info_hash)
+
+    ############################################################################
+    def removed(self, info_hash):
+        with self.condition:
+            if info_hash not in self.pending:
+                return
+
+            # Torrents with files are done once libtorrent deleted them, see storage_released
+            save_path, file_paths = self.pending[info_hash]
+            if not file_paths:
+                del self.pending[info_hash]
+                self.condition.notify_all()
+
+    ############################################################################
+    def storage_released(self, info_hash):
+        with self.condition:
+            if info_hash not in self.pending:
+                return
+
+            # Whatever libtorrent could not delete goes now, along with the directories it left behind
+            save_path, file_paths = self.pending.pop(info_hash)
+            if file_paths:
+                self.delete_files(info_hash, save_path, file_paths)
+            self.condition.notify_all()
+
+    ############################################################################
+    def delete_files(self, info_hash, save_path, file_paths):
+        with self.condition:
+            self.deleting = self.deleting + 1
+            self.deletions.put((info_hash, save_path, file_paths))
+
+    ############################################################################
+    def wait_for_torrent(self, info_hash, timeout):
+        # libtorrent deletes the files of a torrent removed with them, a new download must not start before
+        deadline = time.time() + timeout
+
+        with self.condition:
+            while info_hash in self.pending and self.pending[info_hash][1]:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    ############################################################################
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+
+        with self.condition:
+            while self.pending or self.deleting > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    ############################################################################
+    def _delete_files(self):
+        while True:
+            deletion = self.deletions.get()
+            if deletion is None:
+                return
+
+            info_hash, save_path, file_paths = deletion
+            try:
+                directories = set()
+                for file_path in file_paths:
+                    path = os.path.join(save_path, file_path)
+                    try:
+                        os.remove(path)
+                    except OSError as error:
+                        if error.errno != errno.ENOENT:
+                            self.bus.log('[Removal] Could not delete {0}: {1}'.format(path, error))
+                    directories.add(os.path.dirname(file_path))
+
+                # Prune the directories the torrent created, deepest first, as long as they are empty
+                for directory in sorted(directories, key=len, reverse=True):
+                    while directory:
+                        try:
+                            os.rmdir(os.path.join(save_path, directory))
+                        except OSError:
+                            break
+                        directory = os.path.dirname(directory)
+            finally:
+                with self.condition:
+                    self.deleting = self.deleting - 1
+                    self.condition.notify_all()
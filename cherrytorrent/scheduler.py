@@ -0,0 +1,265 @@
+################################################################################
+import math
+import threading
+import time
+
+################################################################################
+DEFAULT_BITRATE   = 512 * 1024
+WINDOW_DURATION   = 20.0
+MIN_WINDOW_PIECES = 4
+NORMAL_PRIORITY   = 1
+DEADLINE_PRIORITY = 7
+LOWERED_PIECES    = 32
+HINT_DEADLINE     = 1000
+HINT_MAX_PIECES   = 8
+
+################################################################################
+class StreamingScheduler:
+    ############################################################################
+    def __init__(self, bus):
+        self.bus      = bus
+        self.lock     = threading.Lock()
+        self.torrents = {}
+
+        self.hint_stats = { 'added': 0, 'hits': 0, 'ready_hits': 0, 'expired': 0 }
+
+    ############################################################################
+    def add_reader(self, reader):
+        with self.lock:
+            schedule = self._get_schedule(reader.torrent_handle, reader.torrent_file)
+            schedule['readers'][reader] = schedule['start_piece_index']
+
+    ############################################################################
+    def add_hints(self, torrent_handle, torrent_file, ranges, ttl):
+        # Byte ranges of the file a client announced it will read soon, only their first pieces are worth fetching early
+        expiration = time.time() + ttl
+
+        with self.lock:
+            schedule = self._get_schedule(torrent_handle, torrent_file)
+            hints    = dict(((hint['start_piece_index'], hint['end_piece_index']), hint) for hint in schedule['hints'])
+
+            for offset, length in ranges:
+                start_piece_index = (torrent_file.offset + offset) / schedule['piece_length']
+                end_piece_index   = min((torrent_file.offset + offset + length - 1) / schedule['piece_length'], start_piece_index + HINT_MAX_PIECES - 1, schedule['end_piece_index'])
+
+                # Hinting the same range again, e.g. while scrubbing back and forth, only extends it
+                hint = hints.get((start_piece_index, end_piece_index))
+                if hint:
+                    hint['expiration'] = max(hint['expiration'], expiration)
+                    continue
+
+                hint = { 'start_piece_index': start_piece_index, 'end_piece_index': end_piece_index, 'expiration': expiration, 'hit': False }
+                hints[(start_piece_index, end_piece_index)] = hint
+                schedule['hints'].append(hint)
+                self.hint_stats['added'] = self.hint_stats['added'] + 1
+
+            self._apply(schedule)
+
+    ############################################################################
+    def remove_reader(self, reader):
+        info_hash = str(reader.torrent_handle.info_hash())
+
+        with self.lock:
+            schedule = self.torrents.get(info_hash)
+            if schedule and reader in schedule['readers']:
+                del schedule['readers'][reader]
+                if schedule['readers'] or schedule['hints']:
+                    self._apply(schedule)
+                else:
+                    self._release(schedule)
+                    del self.torrents[info_hash]
+
+    ############################################################################
+    def update_playhead(self, reader, offset):
+        info_hash   = str(reader.torrent_handle.info_hash())
+        piece_index = reader.piece_from_offset(reader.torrent_file.offset + offset)
+
+        with self.lock:
+            schedule = self.torrents.get(info_hash)
+            if schedule and reader in schedule['readers'] and schedule['readers'][reader] != piece_index:
+                schedule['readers'][reader] = piece_index
+                self._record_hint_hits(schedule, piece_index)
+                self._apply(schedule)
+
+    ############################################################################
+    def get_playheads(self, info_hash):
+        with self.lock:
+            schedule = self.torrents.get(info_hash)
+            return schedule['readers'].values() if schedule else []
+
+    ############################################################################
+    def get_reader_count(self, info_hash):
+        with self.lock:
+            schedule = self.torrents.get(info_hash)
+            return len(schedule['readers']) if schedule else 0
+
+    ############################################################################
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            self.torrents.pop(info_hash, None)
+
+    ############################################################################
+    def reset_torrent(self, info_hash):
+        # Another file got selected, readers of the previous one no longer steer the download
+        with self.lock:
+            schedule = self.torrents.pop(info_hash, None)
+            if schedule:
+                try:
+                    for piece_index in schedule['deadlines']:
+                        schedule['torrent_handle'].reset_piece_deadline(piece_index)
+                except RuntimeError:
+                    pass
+
+    ############################################################################
+    def get_hint_status(self):
+        with self.lock:
+            hint_status = dict(self.hint_stats)
+            hint_status['active'] = sum(len(schedule['hints']) for schedule in self.torrents.itervalues())
+
+        # Hints that played a part, against the ones that ran out without anybody reading them
+        concluded_hints = hint_status['hits'] + hint_status['expired']
+        hint_status['hit_rate']       = float(hint_status['hits']) / concluded_hints if concluded_hints else None
+        hint_status['ready_hit_rate'] = float(hint_status['ready_hits']) / hint_status['hits'] if hint_status['hits'] else None
+        return hint_status
+
+    ############################################################################
+    def update(self):
+        with self.lock:
+            for info_hash, schedule in self.torrents.items():
+                self._expire_hints(schedule)
+                try:
+                    if schedule['readers'] or schedule['hints']:
+                        self._apply(schedule)
+                    else:
+                        self._release(schedule)
+                        del self.torrents[info_hash]
+                except RuntimeError:
+                    pass
+
+    ############################################################################
+    def get_bitrate(self, schedule):
+        # Estimated from the container duration once known
+        entry   = self.bus.downloader_monitor.torrents.get(schedule['info_hash'])
+        bitrate = entry.preload_model.get_bitrate() if entry and entry.preload_model else None
+        return int(bitrate) if bitrate else DEFAULT_BITRATE
+
+    ############################################################################
+    def get_download_rate(self, schedule):
+        # As of the last state update, asking the torrent handle would wait on the network thread while holding the lock
+        entry = self.bus.downloader_monitor.torrents.get(schedule['info_hash'])
+        return entry.download_rate if entry else 0
+
+    ############################################################################
+    def _apply(self, schedule):
+        torrent_handle = schedule['torrent_handle']
+        piece_bitmap   = self.bus.downloader_monitor.get_piece_bitmap(torrent_handle)
+        piece_length   = schedule['piece_length']
+
+        # The window covers WINDOW_DURATION seconds of playback, or more when the swarm is faster than the bitrate
+        bitrate       = max(1, self.get_bitrate(schedule))
+        download_rate = self.get_download_rate(schedule)
+        window_pieces = max(MIN_WINDOW_PIECES, int(math.ceil(max(bitrate, download_rate) * WINDOW_DURATION / piece_length)))
+
+        deadlines = {}
+        for playhead in schedule['readers'].itervalues():
+            for piece_offset in range(window_pieces):
+                piece_index = playhead + piece_offset
+                if piece_index > schedule['end_piece_index']:
+                    break
+                if piece_bitmap.have_piece(piece_index):
+                    continue
+
+                deadline = int(piece_offset * piece_length * 1000 / bitrate)
+                if piece_index not in deadlines or deadline < deadlines[piece_index]:
+                    deadlines[piece_index] = deadline
+
+        # Hinted ranges come right after what the playheads need now
+        for hint in schedule['hints']:
+            for piece_index in range(hint['start_piece_index'], hint['end_piece_index'] + 1):
+                if piece_bitmap.have_piece(piece_index):
+                    continue
+
+                deadline = HINT_DEADLINE + int((piece_index - hint['start_piece_index']) * piece_length * 1000 / bitrate)
+                if piece_index not in deadlines or deadline < deadlines[piece_index]:
+                    deadlines[piece_index] = deadline
+
+        for piece_index in schedule['deadlines'].difference(deadlines):
+            torrent_handle.reset_piece_deadline(piece_index)
+        for piece_index, deadline in deadlines.iteritems():
+            torrent_handle.set_piece_deadline(piece_index, deadline)
+        schedule['deadlines'] = set(deadlines)
+
+        # Nobody needs what was just played by the earliest playhead anymore
+        if schedule['readers']:
+            self._lower_pieces_before(schedule, min(schedule['readers'].itervalues()))
+
+    ############################################################################
+    def _get_schedule(self, torrent_handle, torrent_file):
+        info_hash = str(torrent_handle.info_hash())
+
+        if info_hash not in self.torrents:
+            torrent_info      = torrent_handle.get_torrent_info()
+            start_piece_index = torrent_file.offset / torrent_info.piece_length()
+            end_piece_index   = min((torrent_file.offset + torrent_file.size) / torrent_info.piece_length(), torrent_info.num_pieces() - 1)
+            piece_count       = torrent_info.num_pieces()
+
+            self.torrents[info_hash] = { 'info_hash':         info_hash,
+                                         'torrent_handle':    torrent_handle,
+                                         'torrent_file':      torrent_file,
+                                         'piece_length':      torrent_info.piece_length(),
+                                         'piece_count':       piece_count,
+                                         'start_piece_index': start_piece_index,
+                                         'end_piece_index':   end_piece_index,
+                                         'readers':           {},
+                                         'hints':             [],
+                                         'deadlines':         set(),
+                                         'lowered':           (start_piece_index, start_piece_index) }
+
+        return self.torrents[info_hash]
+
+    ############################################################################
+    def _record_hint_hits(self, schedule, piece_index):
+        # A reader reached a hinted range, the hint paid off when the piece was already there
+        for hint in schedule['hints']:
+            if not hint['hit'] and hint['start_piece_index'] <= piece_index <= hint['end_piece_index']:
+                hint['hit'] = True
+                self.hint_stats['hits'] = self.hint_stats['hits'] + 1
+                if self.bus.downloader_monitor.get_piece_bitmap(schedule['torrent_handle']).have_piece(piece_index):
+                    self.hint_stats['ready_hits'] = self.hint_stats['ready_hits'] + 1
+
+    ############################################################################
+    def _expire_hints(self, schedule):
+        now = time.time()
+        for hint in schedule['hints']:
+            if hint['expiration'] <= now and not hint['hit']:
+                self.hint_stats['expired'] = self.hint_stats['expired'] + 1
+        schedule['hints'] = [hint for hint in schedule['hints'] if hint['expiration'] > now]
+
+    ############################################################################
+    def _release(self, schedule):
+        torrent_handle = schedule['torrent_handle']
+        deadlines, schedule['deadlines'] = schedule['deadlines'], set()
+        try:
+            for piece_index in deadlines:
+                torrent_handle.reset_piece_deadline(piece_index)
+            self._lower_pieces_before(schedule, schedule['start_piece_index'])
+        except RuntimeError:
+            pass
+
+    ############################################################################
+    def _lower_pieces_before(self, schedule, piece_index):
+        # A bounded window right behind the playhead, however far it moved, set in a single call
+        lowered = (max(schedule['start_piece_index'], piece_index - LOWERED_PIECES), piece_index)
+        if lowered == schedule['lowered']:
+            return
+
+        # The other files of the torrent are not wanted, see TorrentEntry.select_file
+        start_piece_index, end_piece_index = schedule['start_piece_index'], schedule['end_piece_index']
+        priorities = [0] * schedule['piece_count']
+        priorities[start_piece_index:end_piece_index + 1] = [NORMAL_PRIORITY] * (end_piece_index + 1 - start_piece_index)
+        priorities[lowered[0]:lowered[1]]                 = [0] * (lowered[1] - lowered[0])
+        for priority_piece_index in schedule['deadlines']:
+            priorities[priority_piece_index] = DEADLINE_PRIORITY
+        schedule['torrent_handle'].prioritize_pieces(priorities)
+
+        schedule['lowered'] = lowered
@@ -3,109 +3,86 @@ import cherrypy
 import downloader
 import json
 import logging
-import mimetypes
+import metrics
 import os
-import platform
 import static
-import subprocess
+import threading
 import time
+import utils
 
 from cherrypy import _cplogging
 
 ################################################################################
-class ConnectionMonitor(cherrypy.process.plugins.Monitor):
+VIDEO_READY_TIMEOUT = 20.0
+READY_MAX_TIMEOUT   = 60.0
+
+################################################################################
+class ConnectionMonitor(cherrypy.process.plugins.SimplePlugin):
     ############################################################################
     def __init__(self, bus, http_config):
-        cherrypy.process.plugins.Monitor.__init__(self, bus, self._background_task, frequency=1)
+        cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
 
         self.http_config         = http_config
-        self.connections         = []
+        self.lock                = threading.Lock()
         self.torrent_connections = {}
 
-    ############################################################################
-    def start(self):
-        cherrypy.process.plugins.Monitor.start(self)
-
-    ############################################################################
-    def stop(self):
-        cherrypy.process.plugins.Monitor.stop(self)
-
     ############################################################################
     def add_torrent(self, info_hash):
-        if info_hash not in self.torrent_connections:
-            self.torrent_connections[info_hash] = { 'timestamp': time.time(), 'set': set() }
-        else:
-            self.torrent_connections[info_hash]['timestamp'] = time.time()
+        with self.lock:
+            self._add_torrent(info_hash)
 
     ############################################################################
     def remove_torrent(self, info_hash):
-        if info_hash in self.torrent_connections:
-            del self.torrent_connections[info_hash]
+        with self.lock:
+            if info_hash in self.torrent_connections:
+                del self.torrent_connections[info_hash]
 
     ############################################################################
     def add_video_connection(self, info_hash):
-        current_connections = self._get_connections()
-        for connection in current_connections:
-            if connection not in self.connections:
-                self.add_torrent(info_hash)
+        remote     = cherrypy.serving.request.remote
+        connection = '{0}:{1}'.format(remote.ip, remote.port)
+        self.add_connection(info_hash, connection)
+
+        # Runs once the response has been fully sent or the client went away
+        cherrypy.serving.request.hooks.attach('on_end_request', self.remove_video_connection, info_hash=info_hash, connection=connection)
+        return connection
 
-                if connection not in self.torrent_connections[info_hash]:
-                    self.torrent_connections[info_hash]['set'].add(connection)
+    ############################################################################
+    def add_connection(self, info_hash, connection):
+        with self.lock:
+            self._add_torrent(info_hash)
+            self.torrent_connections[info_hash]['set'].add(connection)
 
-                self.connections.append(connection)
+    ############################################################################
+    def remove_video_connection(self, info_hash, connection):
+        with self.lock:
+            if info_hash in self.torrent_connections:
+                self.torrent_connections[info_hash]['timestamp'] = time.time()
+                self.torrent_connections[info_hash]['set'].discard(connection)
 
     ############################################################################
     def has_video_connections(self, info_hash):
-        return info_hash in self.torrent_connections and self.torrent_connections[info_hash]['set']
+        with self.lock:
+            return info_hash in self.torrent_connections and len(self.torrent_connections[info_hash]['set']) > 0
 
     ############################################################################
     def get_last_video_connection_timestamp(self, info_hash):
-        if info_hash not in self.torrent_connections:
-            return 0
-        return self.torrent_connections[info_hash]['timestamp']
-
-    ############################################################################
-    def _get_connections(self):
-        connections = []
-
-        if platform.system() == 'Linux':
-            lines = subprocess.check_output(['netstat', '-ant']).split('\n')
-            for line in lines:
-                words = line.split()
-                if len(words) == 6 and words[3].endswith(str(self.http_config['port'])) and words[5] == 'ESTABLISHED':
-                    connections.append(line)
-
-        elif platform.system() == 'Darwin':
-            lines = subprocess.check_output(['lsof', '-nPi4TCP']).split('\n')
-            for line in lines:
-                if ':{0}->'.format(self.http_config['port']) in line and 'ESTABLISHED' in line:
-                    connections.append(line)
-
-        elif platform.system() == 'Windows':
-            lines = subprocess.check_output(['netstat', '-anp', 'TCP']).split('\n')
-            for line in lines:
-                words = line.split()
-                if len(words) == 4 and words[1].endswith(str(self.http_config['port'])) and words[3] == 'ESTABLISHED':
-                    connections.append(line)
-        
-        return connections
+        with self.lock:
+            if info_hash not in self.torrent_connections:
+                return 0
+            return self.torrent_connections[info_hash]['timestamp']
 
     ############################################################################
-    def _background_task(self):
-        current_connections = self._get_connections()
-        
-        connection_sets_to_remove = []
-        for info_hash, connection_set in self.torrent_connections.iteritems():
-            connections_to_remove = []
-
-            for connection in connection_set['set']:
-                if connection not in current_connections:
-                    connections_to_remove.append(connection)
+    def get_connection_sets(self):
+        with self.lock:
+            return dict((info_hash, { 'timestamp': connection_set['timestamp'], 'set': set(connection_set['set']) }) for info_hash, connection_set in self.torrent_connections.iteritems())
 
-            for connection in connections_to_remove:
-                connection_set['timestamp'] = time.time()
-                connection_set['set'].remove(connection)
-                self.connections.remove(connection)
+    ############################################################################
+    def _add_torrent(self, info_hash):
+        if info_hash not in self.torrent_connections:
+            self.torrent_connections[info_hash] = { 'timestamp': time.time(), 'set': set() }
+        else:
+            self.torrent_connections[info_hash]['timestamp'] = time.time()
 
 ################################################################################
 class Server:
@@ -132,44 +109,130 @@ class Server:
             handler.setFormatter(_cplogging.logfmt)
             cherrypy.log.error_log.addHandler(handler)
 
-        cherrypy.quickstart(ServerRoot())
+        if self.http_config.get('mode') == 'asyncio':
+            self._run_asyncio()
+        else:
+            cherrypy.quickstart(ServerRoot())
+
+    ############################################################################
+    def _run_asyncio(self):
+        # Only the engine and its plugins run, connections are served by the event loop
+        # Imported here as asyncio needs the trollius backport on Python 2
+        import aioserver
+
+        cherrypy.server.unsubscribe()
+        cherrypy.engine.signals.subscribe()
+        cherrypy.engine.start()
+        try:
+            aioserver.AsyncHttpServer(cherrypy.engine, self.http_config).serve_forever()
+        finally:
+            if cherrypy.engine.state not in (cherrypy.engine.states.STOPPED, cherrypy.engine.states.EXITING):
+                cherrypy.engine.exit()
 
 ################################################################################
 class ServerRoot:
     ############################################################################
     @cherrypy.expose
     def index(self):
-        return json.dumps(cherrypy.engine.downloader_monitor.get_status())
+        status_json, etag = cherrypy.engine.downloader_monitor.get_status_json()
+
+        cherrypy.response.headers['ETag'] = etag
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return ''
+        return status_json
 
     ############################################################################
     @cherrypy.expose
-    def add(self, uri, download_dir='.'):
-        return json.dumps(cherrypy.engine.downloader_monitor.add_torrent(uri, download_dir))
+    def status(self, since=0):
+        try:
+            since = int(since)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid version {0}'.format(since))
+        return json.dumps(cherrypy.engine.downloader_monitor.get_status_delta(since))
 
     ############################################################################
     @cherrypy.expose
-    def video(self, info_hash):
-        cherrypy.engine.connection_monitor.add_video_connection(info_hash)
+    def add(self, uri, download_dir='.', file=None):
+        try:
+            return json.dumps(cherrypy.engine.downloader_monitor.add_torrent(uri, download_dir, file))
+        except ValueError as error:
+            raise cherrypy.HTTPError(400, str(error))
+
+    ############################################################################
+    @cherrypy.expose
+    def video(self, info_hash, file=None):
+        if file is not None:
+            try:
+                cherrypy.engine.downloader_monitor.select_file(info_hash, file)
+            except ValueError as error:
+                raise cherrypy.HTTPError(400, str(error))
+            except RuntimeError:
+                raise cherrypy.HTTPError(404, 'Unknown torrent')
 
-        if cherrypy.engine.downloader_monitor.is_video_file_ready_from_info_hash(info_hash, True):
-            video_file   = cherrypy.engine.downloader_monitor.get_video_file(info_hash)
-            content_type = mimetypes.types_map.get(os.path.splitext(video_file.path), None)
+        cherrypy.engine.connection_monitor.add_video_connection(info_hash)
 
-            if not content_type:
-                if video_file.path.endswith('.avi'):
-                    content_type = 'video/avi'
-                elif video_file.path.endswith('.mkv'):
-                    content_type = 'video/x-matroska'
-                elif video_file.path.endswith('.mp4'):
-                    content_type = 'video/mp4'
+        try:
+            is_ready = cherrypy.engine.downloader_monitor.wait_for_video_file_ready(info_hash, True, VIDEO_READY_TIMEOUT)
+        except RuntimeError:
+            raise cherrypy.HTTPError(404, 'Unknown torrent')
 
+        if is_ready:
+            video_file   = cherrypy.engine.downloader_monitor.get_video_file(info_hash, is_client_connected=self._get_client_check())
+            content_type = utils.get_video_content_type(video_file.path)
+            cherrypy.serving.request.hooks.attach('on_end_request', video_file.close)
             return static.serve_fileobj(video_file, content_length=video_file.size, content_type=content_type, name=os.path.basename(video_file.path))            
         else:
-            time.sleep(2)
+            cherrypy.engine.downloader_monitor.is_video_file_ready_from_info_hash(info_hash, True)
             raise cherrypy.HTTPRedirect('/video?info_hash={0}'.format(info_hash), 307)
 
+    ############################################################################
+    @cherrypy.expose
+    def ready(self, info_hash, timeout=READY_MAX_TIMEOUT, fast=False):
+        try:
+            timeout = min(float(timeout), READY_MAX_TIMEOUT)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid timeout {0}'.format(timeout))
+
+        is_fast = fast in (True, '1', 'true')
+        try:
+            return json.dumps({ 'info_hash': info_hash, 'ready': cherrypy.engine.downloader_monitor.wait_for_video_file_ready(info_hash, is_fast, timeout) })
+        except RuntimeError:
+            raise cherrypy.HTTPError(404, 'Unknown torrent')
+
+    ############################################################################
+    @cherrypy.expose
+    def prefetch(self, info_hash, offset=None, length=None, ranges=None, ttl=downloader.PREFETCH_TTL):
+        try:
+            return json.dumps(cherrypy.engine.downloader_monitor.add_prefetch_hints(info_hash, utils.parse_byte_ranges(offset, length, ranges), ttl))
+        except ValueError as error:
+            raise cherrypy.HTTPError(400, str(error))
+        except RuntimeError:
+            raise cherrypy.HTTPError(404, 'Unknown torrent')
+
+    ############################################################################
+    @cherrypy.expose
+    def bandwidth(self, **parameters):
+        try:
+            return json.dumps(cherrypy.engine.downloader_monitor.configure_bandwidth(parameters))
+        except ValueError as error:
+            raise cherrypy.HTTPError(400, str(error))
+
+    ############################################################################
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return metrics.REGISTRY.render()
+
     ############################################################################
     @cherrypy.expose
     def shutdown(self):
         cherrypy.engine.exit()
         return 'cherrytorrent stopped'
+
+    ############################################################################
+    def _get_client_check(self):
+        # Readers blocked on a missing piece check the client socket, on_end_request only runs once the body is done
+        connection = getattr(threading.current_thread(), 'conn', None)
+        sock       = getattr(connection, 'socket', None)
+        return (lambda: utils.is_socket_connected(sock)) if sock else None
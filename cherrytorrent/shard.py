@@ -0,0 +1,417 @@
+################################################################################
+import bandwidth
+import bisect
+import cherrypy
+import hashlib
+import httplib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import utils
+
+################################################################################
+VIRTUAL_NODES          = 64
+WORKER_CHECK_INTERVAL  = 5
+WORKER_START_TIMEOUT   = 30.0
+WORKER_STOP_TIMEOUT    = 30.0
+WORKER_REQUEST_TIMEOUT = 10.0
+READY_MAX_TIMEOUT      = 60.0
+
+# Session wide limits, each worker enforces its share
+SPLIT_BANDWIDTH_PARAMETERS = ('max_download_rate', 'connections_limit')
+
+# Workers are plain single process servers started from the package parent directory
+PACKAGE_DIR   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_SCRIPT = 'import json, sys; sys.path.insert(0, sys.argv[1]); from cherrytorrent import server; server.Server(*json.loads(sys.argv[2])).run()'
+
+################################################################################
+class HashRing:
+    ############################################################################
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        # Each node owns several points of the ring so that keys spread evenly
+        self.ring = sorted((self._hash('{0}-{1}'.format(node, index)), node) for node in nodes for index in range(virtual_nodes))
+        self.keys = [key for key, node in self.ring]
+
+    ############################################################################
+    def get_node(self, key):
+        return self.ring[bisect.bisect(self.keys, self._hash(key)) % len(self.ring)][1]
+
+    ############################################################################
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+################################################################################
+class ShardWorker:
+    ############################################################################
+    def __init__(self, bus, index, http_config, torrent_config):
+        self.bus            = bus
+        self.index          = index
+        self.http_config    = http_config
+        self.torrent_config = torrent_config
+        self.process        = None
+        self.restarts       = 0
+
+    ############################################################################
+    def get_port(self):
+        return self.http_config['port']
+
+    ############################################################################
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    ############################################################################
+    def start(self):
+        self.bus.log('[Shard] Starting worker {0} on port {1}'.format(self.index, self.get_port()))
+        self.process = subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, PACKAGE_DIR, json.dumps([self.http_config, self.torrent_config])])
+
+    ############################################################################
+    def wait_until_listening(self, timeout):
+        end_time = time.time() + timeout
+        while self.is_alive() and time.time() < end_time:
+            try:
+                socket.create_connection(('127.0.0.1', self.get_port()), 1.0).close()
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        return False
+
+    ############################################################################
+    def stop(self, timeout):
+        if not self.is_alive():
+            return
+
+        try:
+            self.request('/shutdown')
+        except (socket.error, httplib.HTTPException):
+            pass
+
+        end_time = time.time() + timeout
+        while self.is_alive() and time.time() < end_time:
+            time.sleep(0.1)
+
+        if self.is_alive():
+            self.bus.log('[Shard] Worker {0} did not stop in time, terminating it'.format(self.index))
+            self.process.terminate()
+            self.process.wait()
+
+    ############################################################################
+    def request(self, path, parameters=None, timeout=WORKER_REQUEST_TIMEOUT):
+        url = path + ('?' + urllib.urlencode(parameters) if parameters else '')
+
+        connection = httplib.HTTPConnection('127.0.0.1', self.get_port(), timeout=timeout)
+        try:
+            connection.request('GET', url)
+            response = connection.getresponse()
+            return response.status, response.getheader('ETag'), response.read()
+        finally:
+            connection.close()
+
+################################################################################
+class ShardManager(cherrypy.process.plugins.Monitor):
+    ############################################################################
+    def __init__(self, bus, http_config, torrent_config, shard_count):
+        cherrypy.process.plugins.Monitor.__init__(self, bus, self._check_workers, frequency=WORKER_CHECK_INTERVAL)
+
+        self.lock     = threading.Lock()
+        self.routes   = {}
+        self.ring     = HashRing(range(shard_count))
+        self.stopping = False
+
+        # Quotas are split evenly, each worker gets its own ports and state directory
+        self.workers = []
+        for index in range(shard_count):
+            worker_http_config    = dict(http_config, port=http_config['port'] + 1 + index)
+            worker_torrent_config = dict(torrent_config)
+            worker_torrent_config['port']      = torrent_config['port'] + index
+            worker_torrent_config['state_dir'] = os.path.join(torrent_config['state_dir'], 'shard-{0}'.format(index))
+            for name in ('max_download_rate', 'max_upload_rate', 'cache_size', 'piece_cache_size'):
+                if worker_torrent_config.get(name, 0) > 0:
+                    worker_torrent_config[name] = max(1, worker_torrent_config[name] / shard_count)
+            self.workers.append(ShardWorker(bus, index, worker_http_config, worker_torrent_config))
+
+    ############################################################################
+    def start(self):
+        self.stopping = False
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            if not worker.wait_until_listening(WORKER_START_TIMEOUT):
+                self.bus.log('[Shard] Worker {0} is not listening on port {1}'.format(worker.index, worker.get_port()))
+        cherrypy.process.plugins.Monitor.start(self)
+    start.priority = 70
+
+    ############################################################################
+    def stop(self):
+        self.stopping = True
+        cherrypy.process.plugins.Monitor.stop(self)
+
+        # Workers save their resume data while stopping, done side by side
+        threads = [threading.Thread(target=worker.stop, args=(WORKER_STOP_TIMEOUT,)) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.bus.log('[Shard] All workers stopped')
+
+    ############################################################################
+    def get_workers(self):
+        return list(self.workers)
+
+    ############################################################################
+    def get_worker(self, key):
+        with self.lock:
+            index = self.routes.get(key)
+        return self.workers[index if index is not None else self.ring.get_node(key)]
+
+    ############################################################################
+    def add_route(self, info_hash, worker):
+        # Torrents added from a .torrent URL are only known by their info hash once added
+        if self.ring.get_node(info_hash) != worker.index:
+            with self.lock:
+                self.routes[info_hash] = worker.index
+
+    ############################################################################
+    def get_status(self):
+        with self.lock:
+            routes = dict(self.routes)
+        return { 'shards': [{ 'index': worker.index, 'port': worker.get_port(), 'alive': worker.is_alive(), 'restarts': worker.restarts } for worker in self.workers],
+                 'routes': routes }
+
+    ############################################################################
+    def _check_workers(self):
+        for worker in self.workers:
+            if not self.stopping and not worker.is_alive():
+                self.bus.log('[Shard] Worker {0} exited with code {1}, restarting it'.format(worker.index, worker.process.returncode if worker.process else None))
+                worker.restarts = worker.restarts + 1
+                worker.start()
+
+################################################################################
+class ShardServer:
+    ############################################################################
+    def __init__(self, http_config, torrent_config, shard_count):
+        self.http_config    = http_config
+        self.torrent_config = torrent_config
+
+        cherrypy.engine.shard_manager = ShardManager(cherrypy.engine, self.http_config, self.torrent_config, shard_count)
+        cherrypy.engine.shard_manager.subscribe()
+
+    ############################################################################
+    def run(self):
+        cherrypy.config.update({'server.socket_host':'0.0.0.0'})
+        cherrypy.config.update({'server.socket_port':self.http_config['port']})
+        cherrypy.quickstart(ShardRoot())
+
+################################################################################
+class ShardRoot:
+    ############################################################################
+    @cherrypy.expose
+    def index(self):
+        session  = cherrypy.engine.shard_manager.get_status()
+        torrents = []
+        versions = []
+
+        for worker, shard_status in zip(cherrypy.engine.shard_manager.get_workers(), session['shards']):
+            worker_status  = self._request_json(worker, '/')
+            worker_session = worker_status.get('session', {})
+            torrents.extend(worker_session.pop('torrents', []))
+            versions.append(str(worker_status.get('version', 0)))
+            shard_status['session'] = worker_session
+
+        # Versions only grow while a worker lives, restarts change the etag too
+        etag = '"{0}"'.format('-'.join(versions + [str(shard['restarts']) for shard in session['shards']]))
+        cherrypy.response.headers['ETag'] = etag
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return ''
+
+        session['torrents'] = torrents
+        return json.dumps({ 'session': session, 'version': '-'.join(versions) })
+
+    ############################################################################
+    @cherrypy.expose
+    def status(self, since=''):
+        # The version is made of one <restarts>.<version> pair per worker, a worker restarted since starts over
+        workers = cherrypy.engine.shard_manager.get_workers()
+        try:
+            worker_versions = [tuple(int(number) for number in pair.split('.')) for pair in since.split('-')] if since else []
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid version {0}'.format(since))
+
+        is_full = len(worker_versions) != len(workers) or any(len(pair) != 2 or pair[0] != worker.restarts for pair, worker in zip(worker_versions, workers))
+        if is_full:
+            worker_versions = [(worker.restarts, 0) for worker in workers]
+
+        deltas = [self._request_json(worker, '/status', { 'since': worker_since }) for worker, (restarts, worker_since) in zip(workers, worker_versions)]
+        if not is_full and any(delta.get('full') for delta in deltas):
+            # A worker no longer knows every removal since then, the client has to start over from all of them
+            is_full = True
+            deltas  = [self._request_json(worker, '/status', { 'since': 0 }) for worker in workers]
+
+        session  = cherrypy.engine.shard_manager.get_status()
+        torrents = []
+        removed  = []
+        versions = []
+        for worker, shard_status, delta in zip(workers, session['shards'], deltas):
+            torrents.extend(delta.get('torrents', []))
+            removed.extend(delta.get('removed', []))
+            versions.append('{0}.{1}'.format(worker.restarts, delta.get('version', 0)))
+            shard_status['session'] = delta.get('session', {})
+
+        return json.dumps({ 'session': session, 'version': '-'.join(versions), 'full': is_full, 'torrents': torrents, 'removed': [] if is_full else removed })
+
+    ############################################################################
+    @cherrypy.expose
+    def add(self, uri, download_dir='.', file=None):
+        info_hash  = utils.info_hash_from_uri(uri)
+        worker     = cherrypy.engine.shard_manager.get_worker(info_hash or uri)
+        parameters = { 'uri': uri, 'download_dir': download_dir }
+        if file is not None:
+            parameters['file'] = file
+
+        status, body = self._forward(worker, '/add', parameters)
+        if status == 200 and not info_hash:
+            cherrypy.engine.shard_manager.add_route(json.loads(body)['info_hash'], worker)
+        return body
+
+    ############################################################################
+    @cherrypy.expose
+    def video(self, info_hash, file=None):
+        # Video bytes go straight from the worker to the player, this process only routes
+        worker     = cherrypy.engine.shard_manager.get_worker(info_hash)
+        parameters = { 'info_hash': info_hash }
+        if file is not None:
+            parameters['file'] = file
+        raise cherrypy.HTTPRedirect('http://{0}:{1}/video?{2}'.format(self._get_host(), worker.get_port(), urllib.urlencode(parameters)), 307)
+
+    ############################################################################
+    @cherrypy.expose
+    def ready(self, info_hash, timeout=READY_MAX_TIMEOUT, fast=False):
+        try:
+            timeout = min(float(timeout), READY_MAX_TIMEOUT)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid timeout {0}'.format(timeout))
+
+        worker       = cherrypy.engine.shard_manager.get_worker(info_hash)
+        status, body = self._forward(worker, '/ready', { 'info_hash': info_hash, 'timeout': timeout, 'fast': fast }, timeout + WORKER_REQUEST_TIMEOUT)
+        return body
+
+    ############################################################################
+    @cherrypy.expose
+    def prefetch(self, info_hash, **parameters):
+        worker       = cherrypy.engine.shard_manager.get_worker(info_hash)
+        status, body = self._forward(worker, '/prefetch', dict(parameters, info_hash=info_hash))
+        return body
+
+    ############################################################################
+    @cherrypy.expose
+    def bandwidth(self, **parameters):
+        # Checked here once, a worker refusing the change would leave the ones before it changed
+        try:
+            changes = bandwidth.parse_parameters(parameters)
+        except ValueError as error:
+            raise cherrypy.HTTPError(400, str(error))
+
+        # Rates and connections are split between the workers like the quotas they were started with
+        workers = cherrypy.engine.shard_manager.get_workers()
+        for name in SPLIT_BANDWIDTH_PARAMETERS:
+            if name in changes:
+                parameters[name] = max(1, changes[name] / len(workers)) if changes[name] > 0 else changes[name]
+
+        shards = []
+        for worker in workers:
+            status, body = self._forward(worker, '/bandwidth', parameters)
+            if status != 200:
+                return body
+            shards.append(json.loads(body))
+
+        config = dict(shards[0]['config'])
+        for name in SPLIT_BANDWIDTH_PARAMETERS:
+            values = [shard['config'][name] for shard in shards]
+            if all(value > 0 for value in values):
+                config[name] = sum(values)
+
+        torrents = {}
+        for shard in shards:
+            torrents.update(shard['torrents'])
+        return json.dumps({ 'config': config, 'torrents': torrents })
+
+    ############################################################################
+    @cherrypy.expose
+    def metrics(self):
+        # Samples of each worker get a shard label, every metric keeps a single HELP and TYPE
+        names   = []
+        headers = {}
+        samples = {}
+        for worker in cherrypy.engine.shard_manager.get_workers():
+            try:
+                status, etag, body = worker.request('/metrics')
+            except (socket.error, httplib.HTTPException):
+                continue
+            if status != 200:
+                continue
+
+            name = None
+            for line in body.splitlines():
+                if line.startswith('#'):
+                    name = line.split(' ', 3)[2]
+                    if name not in headers:
+                        names.append(name)
+                        headers[name] = []
+                        samples[name] = []
+                    if line not in headers[name]:
+                        headers[name].append(line)
+                elif line and name:
+                    samples[name].append(self._add_shard_label(line, worker.index))
+
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return ''.join('\n'.join(headers[name] + samples[name]) + '\n' for name in names)
+
+    ############################################################################
+    @cherrypy.expose
+    def shutdown(self):
+        cherrypy.engine.exit()
+        return 'cherrytorrent stopped'
+
+    ############################################################################
+    def _request_json(self, worker, path, parameters=None):
+        # Workers that are down or restarting are left out rather than failing the whole request
+        try:
+            status, etag, body = worker.request(path, parameters)
+            return json.loads(body) if status == 200 else {}
+        except (socket.error, httplib.HTTPException, ValueError):
+            return {}
+
+    ############################################################################
+    def _add_shard_label(self, line, shard_index):
+        name_end = line.find('{')
+        if name_end < 0:
+            name_end = line.find(' ')
+            return '{0}{{shard="{1}"}}{2}'.format(line[:name_end], shard_index, line[name_end:])
+        return '{0}{{shard="{1}",{2}'.format(line[:name_end], shard_index, line[name_end + 1:])
+
+    ############################################################################
+    def _get_host(self):
+        # The host the player reached us by, without its port, IPv6 addresses keep their brackets
+        host = cherrypy.request.headers.get('Host')
+        if not host:
+            host = cherrypy.request.local.ip
+            return '[{0}]'.format(host) if ':' in host else host
+        if host.endswith(']') or ':' not in host:
+            return host
+        return host.rsplit(':', 1)[0]
+
+    ############################################################################
+    def _forward(self, worker, path, parameters, timeout=WORKER_REQUEST_TIMEOUT):
+        try:
+            status, etag, body = worker.request(path, parameters, timeout)
+        except (socket.error, httplib.HTTPException):
+            raise cherrypy.HTTPError(503, 'Shard {0} unavailable'.format(worker.index))
+
+        if status != 200:
+            cherrypy.response.status = status
+        return status, body
@@ -7,7 +7,10 @@ import os
 
 import cherrypy
 from cherrypy._cpcompat import ntob
-from cherrypy.lib import cptools, httputil, file_generator_limited
+from cherrypy.lib import cptools, httputil
+
+COMPLETED_CHUNK_SIZE = 1024 * 1024
+PENDING_CHUNK_SIZE   = 65536
 
 def serve_fileobj(fileobj, content_type=None, content_length=None, 
                   last_modified=None, disposition=None, name=None, debug=False):
@@ -109,7 +112,7 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
                     "bytes %s-%s/%s" % (start, stop - 1, content_length))
                 response.headers['Content-Length'] = r_len
                 fileobj.seek(start)
-                response.body = file_generator_limited(fileobj, r_len)
+                response.body = file_generator_ranged(fileobj, r_len)
             else:
                 # Return a multipart/byteranges response.
                 response.status = "206 Partial Content"
@@ -144,7 +147,7 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
                                 start, stop - 1, content_length),
                             'ascii')
                         fileobj.seek(start)
-                        gen = file_generator_limited(fileobj, stop - start)
+                        gen = file_generator_ranged(fileobj, stop - start)
                         for chunk in gen:
                             yield chunk
                         yield ntob("\r\n")
@@ -162,5 +165,31 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
     # Set Content-Length and use an iterable (file object)
     #   this way CP won't load the whole file in memory
     response.headers['Content-Length'] = content_length
-    response.body = fileobj
+    response.body = file_generator_ranged(fileobj, content_length)
     return response.body
+
+
+def file_generator_ranged(fileobj, count):
+    """Yield count bytes from the file object, like file_generator_limited.
+
+    Ranges the file object reports as completed are read in large chunks
+    straight from disk. Only the remainder goes through the (possibly
+    blocking) read() of the file object, in small chunks so that playback
+    can start as soon as the next piece arrives.
+    """
+    remaining = count
+    while remaining > 0:
+        completed = 0
+        if hasattr(fileobj, 'completed_bytes'):
+            completed = fileobj.completed_bytes(remaining)
+
+        if completed > 0:
+            chunk = fileobj.read_completed(min(COMPLETED_CHUNK_SIZE, completed))
+        else:
+            chunk = fileobj.read(min(PENDING_CHUNK_SIZE, remaining))
+
+        chunklen = len(chunk)
+        if chunklen == 0:
+            return
+        remaining -= chunklen
+        yield chunk
@@ -0,0 +1,92 @@
+################################################################################
+import json
+import threading
+
+################################################################################
+MAX_REMOVED = 1024
+
+################################################################################
+class StatusCache:
+    ############################################################################
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.version  = 0
+        self.session  = {}
+        self.torrents = {}
+        self.removed  = {}
+        self.pruned   = 0
+        self.json     = json.dumps({})
+        self.etag     = '"0"'
+        self.dirty    = True
+
+    ############################################################################
+    def update_torrent(self, info_hash, torrent):
+        with self.lock:
+            current = self.torrents.get(info_hash)
+            if current and current['status'] == torrent:
+                return
+
+            self.version = self.version + 1
+            self.dirty   = True
+            self.torrents[info_hash] = { 'version': self.version, 'status': torrent }
+            self.removed.pop(info_hash, None)
+
+    ############################################################################
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            if info_hash in self.torrents:
+                self.version = self.version + 1
+                self.dirty   = True
+                del self.torrents[info_hash]
+                self.removed[info_hash] = self.version
+
+                # Only the latest removals are remembered, clients that are further behind get a full snapshot
+                if len(self.removed) > MAX_REMOVED:
+                    oldest_info_hash = min(self.removed, key=self.removed.get)
+                    self.pruned      = max(self.pruned, self.removed.pop(oldest_info_hash))
+
+    ############################################################################
+    def publish(self, session):
+        with self.lock:
+            if session != self.session:
+                self.version = self.version + 1
+                self.dirty   = True
+                self.session = session
+
+            if not self.dirty:
+                return
+
+            torrents = [entry['status'] for entry in self.torrents.itervalues()]
+            version  = self.version
+
+        result                        = {}
+        result['session']             = dict(session)
+        result['session']['torrents'] = torrents
+        result['version']             = version
+        result_json                   = json.dumps(result)
+
+        with self.lock:
+            # A newer snapshot may have been published in the meantime
+            if version == self.version:
+                self.json  = result_json
+                self.etag  = '"{0}"'.format(version)
+                self.dirty = False
+
+    ############################################################################
+    def get_json(self):
+        with self.lock:
+            return self.json, self.etag
+
+    ############################################################################
+    def get_delta(self, since):
+        with self.lock:
+            # A full snapshot replaces whatever the client knew, removals it missed included
+            is_full = since < self.pruned
+
+            result             = {}
+            result['version']  = self.version
+            result['full']     = is_full
+            result['session']  = self.session
+            result['torrents'] = [entry['status'] for entry in self.torrents.itervalues() if is_full or entry['version'] > since]
+            result['removed']  = [] if is_full else [info_hash for info_hash, version in self.removed.iteritems() if version > since]
+            return result
@@ -0,0 +1,99 @@
+################################################################################
+import os
+
+################################################################################
+METADATA_EXTENSION      = '.torrent'
+RESUME_DATA_EXTENSION   = '.fastresume'
+CACHE_INDEX_FILE_NAME   = 'cache.json'
+SESSION_STATE_FILE_NAME = 'session.state'
+
+################################################################################
+class TorrentStore:
+    ############################################################################
+    def __init__(self, path):
+        self.path = path
+
+    ############################################################################
+    def save_metadata(self, info_hash, data):
+        self._write(info_hash + METADATA_EXTENSION, data)
+
+    ############################################################################
+    def load_metadata(self, info_hash):
+        return self._read(info_hash + METADATA_EXTENSION)
+
+    ############################################################################
+    def has_metadata(self, info_hash):
+        return os.path.isfile(os.path.join(self.path, info_hash + METADATA_EXTENSION))
+
+    ############################################################################
+    def remove_metadata(self, info_hash):
+        self._remove(info_hash + METADATA_EXTENSION)
+
+    ############################################################################
+    def save_resume_data(self, info_hash, data):
+        self._write(info_hash + RESUME_DATA_EXTENSION, data)
+
+    ############################################################################
+    def load_resume_data(self, info_hash):
+        return self._read(info_hash + RESUME_DATA_EXTENSION)
+
+    ############################################################################
+    def remove_resume_data(self, info_hash):
+        self._remove(info_hash + RESUME_DATA_EXTENSION)
+
+    ############################################################################
+    def save_cache_index(self, data):
+        self._write(CACHE_INDEX_FILE_NAME, data)
+
+    ############################################################################
+    def load_cache_index(self):
+        return self._read(CACHE_INDEX_FILE_NAME)
+
+    ############################################################################
+    def save_session_state(self, data):
+        self._write(SESSION_STATE_FILE_NAME, data)
+
+    ############################################################################
+    def load_session_state(self):
+        return self._read(SESSION_STATE_FILE_NAME)
+
+    ############################################################################
+    def get_resumable_info_hashes(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        info_hashes = []
+        for file_name in os.listdir(self.path):
+            info_hash, extension = os.path.splitext(file_name)
+            if extension == RESUME_DATA_EXTENSION and self.has_metadata(info_hash):
+                info_hashes.append(info_hash)
+        return info_hashes
+
+    ############################################################################
+    def _read(self, file_name):
+        try:
+            with open(os.path.join(self.path, file_name), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    ############################################################################
+    def _remove(self, file_name):
+        try:
+            os.remove(os.path.join(self.path, file_name))
+        except OSError:
+            pass
+
+    ############################################################################
+    def _write(self, file_name, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # Write to a temporary file first so that a crash never leaves a truncated file behind
+        path      = os.path.join(self.path, file_name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.isfile(path):
+            os.remove(path)
+        os.rename(temp_path, path)
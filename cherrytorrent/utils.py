@@ -1,39 +1,70 @@
 ################################################################################
-import math
+import base64
+import binascii
+import mimetypes
+import os
+import re
+import select
+import socket
+import urlparse
 
 ################################################################################
 PRELOAD_RATIO  = 0.005
+MAGNET_BTIH_RE = re.compile(r'xt=urn:btih:([0-9a-fA-F]{40}|[a-zA-Z2-7]{32})')
+
+VIDEO_CONTENT_TYPES = { '.avi': 'video/avi', '.mkv': 'video/x-matroska', '.mp4': 'video/mp4' }
 
 ################################################################################
-def piece_from_offset(torrent_handle, offset):
-    return offset / torrent_handle.get_torrent_info().piece_length()
+def info_hash_from_uri(uri):
+    match = MAGNET_BTIH_RE.search(uri)
+    if not match:
+        return None
 
-############################################################################
-def get_video_file_total_pieces(torrent_handle, video_file):
-    start_piece_index = piece_from_offset(torrent_handle, video_file.offset)
-    end_piece_index   = piece_from_offset(torrent_handle, video_file.offset + video_file.size)
-    return max(1, end_piece_index - start_piece_index)
+    info_hash = match.group(1)
+    if len(info_hash) == 32:
+        info_hash = binascii.hexlify(base64.b32decode(info_hash.upper()))
+    return info_hash.lower()
 
-############################################################################
-def get_video_file_complete_pieces(torrent_handle, video_file):
-    complete_pieces = 0
+################################################################################
+def trackers_from_uri(uri):
+    if not uri.startswith('magnet:?'):
+        return []
+    return urlparse.parse_qs(uri[len('magnet:?'):]).get('tr', [])
 
-    if not video_file:
-        return 0
+################################################################################
+def parse_byte_ranges(offset=None, length=None, ranges=None):
+    # A single offset and length, or a batch of offset:length pairs separated by commas
+    if ranges is not None:
+        pairs = [byte_range.split(':') for byte_range in ranges.split(',') if byte_range]
+    elif offset is not None:
+        pairs = [(offset, length if length is not None else 1)]
+    else:
+        raise ValueError('Missing byte ranges')
 
-    start_piece_index = piece_from_offset(torrent_handle, video_file.offset)
-    end_piece_index   = piece_from_offset(torrent_handle, video_file.offset + video_file.size)
+    byte_ranges = []
+    for pair in pairs:
+        if len(pair) != 2:
+            raise ValueError('Invalid byte range {0}'.format(':'.join(pair)))
+        byte_ranges.append((int(pair[0]), int(pair[1])))
+    return byte_ranges
 
-    for piece_index in range(start_piece_index, end_piece_index + 1):
-        if torrent_handle.have_piece(piece_index):
-            complete_pieces = complete_pieces + 1
-        else:
-            break
+################################################################################
+def is_socket_connected(sock):
+    # A peer that went away leaves the socket readable with nothing to read
+    try:
+        readable, writable, errored = select.select([sock], [], [], 0)
+        return not readable or len(sock.recv(1, socket.MSG_PEEK)) > 0
+    except ValueError:
+        # SSL sockets do not peek, nothing can be told from here
+        return True
+    except (select.error, socket.error):
+        return False
 
-    return complete_pieces
+################################################################################
+def piece_from_offset(torrent_handle, offset):
+    return offset / torrent_handle.get_torrent_info().piece_length()
 
 ################################################################################
-def get_preload_buffer_piece_count(torrent_handle, video_file):
-    piece_count     = get_video_file_total_pieces(torrent_handle, video_file)
-    high_prio_count = min(piece_count, int(math.ceil(piece_count * PRELOAD_RATIO)))
-    return high_prio_count
+def get_video_content_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    return VIDEO_CONTENT_TYPES.get(extension) or mimetypes.types_map.get(extension)
@@ -0,0 +1,68 @@
+################################################################################
+#   python -m unittest discover -s tests
+################################################################################
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+
+import bandwidth
+
+################################################################################
+class Bus:
+    ############################################################################
+    def log(self, message, level=20, traceback=False):
+        pass
+
+################################################################################
+def demand(viewers, deficit, weight):
+    return { 'viewers': viewers, 'buffer': 0.0, 'bitrate': 0, 'deficit': deficit, 'weight': weight }
+
+################################################################################
+class ParseParametersTest(unittest.TestCase):
+    ############################################################################
+    def test_valid(self):
+        self.assertEqual(bandwidth.parse_parameters({ 'enabled': '0', 'max_download_rate': '100', 'target_buffer': '12.5' }), { 'enabled': False, 'max_download_rate': 100, 'target_buffer': 12.5 })
+
+    ############################################################################
+    def test_invalid(self):
+        for parameters in ({ 'unknown': '1' }, { 'max_download_rate': 'x' }, { 'connections_limit': '-1' }, { 'target_buffer': '0' }):
+            self.assertRaises(ValueError, bandwidth.parse_parameters, parameters)
+
+################################################################################
+class AllocationTest(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.bandwidth_scheduler = bandwidth.BandwidthScheduler(Bus(), 0)
+        self.config              = dict(self.bandwidth_scheduler.config)
+
+    ############################################################################
+    def test_global_limit_shared_by_weight(self):
+        self.config['max_download_rate'] = 1000
+        allocations = self.bandwidth_scheduler._allocate({ 'a': demand(1, 0.0, 3.0), 'b': demand(1, 0.0, 1.0) }, self.config)
+
+        self.assertEqual(allocations['a']['download_limit'], 750 * 1024)
+        self.assertEqual(allocations['b']['download_limit'], 250 * 1024)
+        self.assertEqual(allocations['a']['max_connections'], int(bandwidth.CONNECTIONS_LIMIT * 0.75))
+
+    ############################################################################
+    def test_idle_torrents_held_back_for_starving_viewers(self):
+        allocations = self.bandwidth_scheduler._allocate({ 'a': demand(1, 0.5, 2.0), 'b': demand(0, 0.0, bandwidth.IDLE_WEIGHT) }, self.config)
+
+        self.assertEqual(allocations['a']['download_limit'], bandwidth.UNLIMITED)
+        self.assertEqual(allocations['b']['download_limit'], bandwidth.IDLE_RATE * 1024)
+
+    ############################################################################
+    def test_disabled(self):
+        self.config['enabled']           = False
+        self.config['max_download_rate'] = 1000
+        allocations = self.bandwidth_scheduler._allocate({ 'a': demand(1, 0.5, 2.0), 'b': demand(0, 0.0, bandwidth.IDLE_WEIGHT) }, self.config)
+
+        for allocation in allocations.itervalues():
+            self.assertEqual(allocation['download_limit'], bandwidth.UNLIMITED)
+            self.assertEqual(allocation['max_connections'], bandwidth.UNLIMITED)
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+################################################################################
+# Headers are built by hand, no sample videos needed
+#
+#   python -m unittest discover -s tests
+################################################################################
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+
+import container
+
+################################################################################
+FILE_SIZE = 64 * 1024 * 1024
+
+################################################################################
+def ebml_element(element_id, data):
+    return element_id + '\x01' + struct.pack('>Q', len(data))[1:] + data
+
+################################################################################
+def mkv_header(duration, cues_offset, with_info=True):
+    # EBML header, then a segment of unknown size holding a seek head pointing at the cues, the info and the first cluster
+    ebml           = ebml_element('\x1a\x45\xdf\xa3', ebml_element('\x42\x82', 'matroska'))
+    segment_offset = len(ebml) + 12
+    seek_head      = ebml_element('\x11\x4d\x9b\x74', ebml_element('\x4d\xbb', ebml_element('\x53\xab', '\x1c\x53\xbb\x6b') + ebml_element('\x53\xac', struct.pack('>Q', cues_offset - segment_offset))))
+    info           = ebml_element('\x15\x49\xa9\x66', ebml_element('\x2a\xd7\xb1', struct.pack('>I', 1000000)) + ebml_element('\x44\x89', struct.pack('>d', duration * 1000.0)))
+    return ebml + '\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff' + seek_head + (info if with_info else '') + '\x1f\x43\xb6\x75\x01\xff\xff\xff\xff\xff\xff\xff'
+
+################################################################################
+def mp4_box(box_type, data):
+    return struct.pack('>I4s', 8 + len(data), box_type) + data
+
+################################################################################
+def mp4_moov(duration):
+    mvhd = '\x00\x00\x00\x00' + '\x00' * 8 + struct.pack('>II', 1000, int(duration * 1000)) + '\x00' * 80
+    return mp4_box('moov', mp4_box('mvhd', mvhd))
+
+################################################################################
+def avi_header(duration, movi_size):
+    avih = struct.pack('<5I', 40000, 0, 0, 0, int(duration * 25)) + '\x00' * 36
+    hdrl = 'hdrl' + 'avih' + struct.pack('<I', len(avih)) + avih
+    return 'RIFF' + struct.pack('<I', FILE_SIZE - 8) + 'AVI ' + 'LIST' + struct.pack('<I', len(hdrl)) + hdrl + 'LIST' + struct.pack('<I', movi_size) + 'movi'
+
+################################################################################
+class MkvTest(unittest.TestCase):
+    ############################################################################
+    def test_duration(self):
+        header = mkv_header(120.0, FILE_SIZE - 4096)
+        self.assertAlmostEqual(container.parse_duration(header), 120.0)
+        self.assertLessEqual(container.get_header_size(header), len(header))
+
+    ############################################################################
+    def test_truncated_header(self):
+        header = mkv_header(120.0, FILE_SIZE - 4096)
+        size   = container.get_header_size(header[:40])
+        self.assertIsNone(container.parse_duration(header[:40]))
+        self.assertGreater(size, 40)
+        self.assertAlmostEqual(container.parse_duration(header[:container.get_header_size(header)]), 120.0)
+
+    ############################################################################
+    def test_no_info_before_cluster(self):
+        header = mkv_header(120.0, FILE_SIZE - 4096, with_info=False)
+        self.assertIsNone(container.parse_duration(header))
+        self.assertEqual(container.get_header_size(header), len(header) - 12)
+
+    ############################################################################
+    def test_cues_range(self):
+        header = mkv_header(120.0, FILE_SIZE - 4096)
+        self.assertEqual(container.find_index_ranges(header, FILE_SIZE), [(FILE_SIZE - 4096, 4096)])
+
+################################################################################
+class Mp4Test(unittest.TestCase):
+    ############################################################################
+    def test_moov_first(self):
+        moov   = mp4_moov(90.0)
+        header = mp4_box('ftyp', 'isom\x00\x00\x00\x00isommp41') + moov + struct.pack('>I4s', FILE_SIZE - 24 - len(moov), 'mdat')
+        self.assertAlmostEqual(container.parse_duration(header), 90.0)
+        self.assertEqual(container.get_header_size(header), 24 + len(moov))
+        self.assertEqual(container.find_index_ranges(header, FILE_SIZE), [])
+
+    ############################################################################
+    def test_moov_at_end(self):
+        mdat_size = FILE_SIZE - 24 - 1024
+        header    = mp4_box('ftyp', 'isom\x00\x00\x00\x00isommp41') + struct.pack('>I4s', mdat_size, 'mdat') + '\x00' * 64
+        self.assertIsNone(container.parse_duration(header))
+        self.assertEqual(container.get_header_size(header), 24)
+        self.assertEqual(container.find_index_ranges(header, FILE_SIZE), [(24 + mdat_size, 1024)])
+
+    ############################################################################
+    def test_invalid_box_size(self):
+        header = mp4_box('ftyp', 'isom\x00\x00\x00\x00isommp41') + struct.pack('>I4s', 4, 'free') + '\x00' * 64
+        self.assertIsNone(container.parse_duration(header))
+        self.assertEqual(container.get_header_size(header), 0)
+        self.assertEqual(container.find_index_ranges(header, FILE_SIZE), [])
+
+################################################################################
+class AviTest(unittest.TestCase):
+    ############################################################################
+    def test_duration(self):
+        header = avi_header(60.0, FILE_SIZE - 1024)
+        self.assertAlmostEqual(container.parse_duration(header), 60.0)
+        self.assertLessEqual(container.get_header_size(header), len(header))
+
+    ############################################################################
+    def test_index_after_movi(self):
+        header      = avi_header(60.0, FILE_SIZE - 1024)
+        idx1_offset = len(header) - 4 + FILE_SIZE - 1024
+        self.assertEqual(container.find_index_ranges(header, FILE_SIZE + len(header)), [(idx1_offset, FILE_SIZE + len(header) - idx1_offset)])
+
+################################################################################
+class UnknownTest(unittest.TestCase):
+    ############################################################################
+    def test_unknown_format(self):
+        self.assertIsNone(container.parse_duration('\x00' * 64))
+        self.assertEqual(container.get_header_size('\x00' * 64), 0)
+        self.assertEqual(container.find_index_ranges('\x00' * 64, FILE_SIZE), [])
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()
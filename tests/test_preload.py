@@ -0,0 +1,60 @@
+################################################################################
+#   python -m unittest discover -s tests
+################################################################################
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import preload
+import test_container
+
+################################################################################
+PIECE_LENGTH = 256 * 1024
+TOTAL_PIECES = 1000
+FILE_SIZE    = PIECE_LENGTH * TOTAL_PIECES
+
+################################################################################
+class PreloadModelTest(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.preload_model = preload.PreloadModel(FILE_SIZE, PIECE_LENGTH, TOTAL_PIECES)
+
+    ############################################################################
+    def test_ratio_without_duration(self):
+        self.assertEqual(self.preload_model.get_needed_pieces(0), self.preload_model.ratio_pieces)
+        self.assertEqual(self.preload_model.get_status()['source'], 'ratio')
+        self.assertIsNone(self.preload_model.get_bitrate())
+
+    ############################################################################
+    def test_probe_once(self):
+        self.assertTrue(self.preload_model.start_probe())
+        self.assertTrue(self.preload_model.is_probing())
+        self.assertFalse(self.preload_model.start_probe())
+
+        self.assertIsNone(self.preload_model.finish_probe(None))
+        self.assertFalse(self.preload_model.is_probing())
+        self.assertFalse(self.preload_model.start_probe())
+
+    ############################################################################
+    def test_needed_pieces_follow_download_rate(self):
+        self.preload_model.start_probe()
+        self.assertAlmostEqual(self.preload_model.finish_probe(test_container.mkv_header(1000.0, FILE_SIZE - 4096)), 1000.0)
+
+        # One piece per second of playback: nothing arriving needs the whole file, a swarm outrunning playback the minimum buffer
+        bitrate = self.preload_model.get_bitrate()
+        self.assertEqual(bitrate, PIECE_LENGTH)
+        self.assertEqual(self.preload_model.get_needed_pieces(0), TOTAL_PIECES)
+        self.assertEqual(self.preload_model.get_needed_pieces(bitrate * 2), int(preload.MIN_BUFFER_DURATION))
+
+        # Half the bitrate leaves a bit more than half of the file to preload
+        needed_pieces = self.preload_model.get_needed_pieces(bitrate / 2)
+        self.assertGreater(needed_pieces, TOTAL_PIECES / 2)
+        self.assertLess(needed_pieces, TOTAL_PIECES)
+        self.assertEqual(self.preload_model.get_status()['needed_pieces'], needed_pieces)
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()
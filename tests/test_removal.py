@@ -0,0 +1,119 @@
+################################################################################
+# Runs against the fake libtorrent of the benchmarks, no network or libtorrent needed
+#
+#   python -m unittest discover -s tests
+################################################################################
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+
+import fake_libtorrent
+
+sys.modules['libtorrent'] = fake_libtorrent
+
+import alerts
+import removal
+
+################################################################################
+def wait_until(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+################################################################################
+class Bus:
+    ############################################################################
+    def log(self, message, level=20, traceback=False):
+        pass
+
+################################################################################
+class RecordingRemovalQueue(removal.RemovalQueue):
+    ############################################################################
+    def __init__(self, bus, events):
+        removal.RemovalQueue.__init__(self, bus)
+        self.events = events
+
+    ############################################################################
+    def delete_files(self, info_hash, save_path, file_paths):
+        self.events.append('delete_files')
+        removal.RemovalQueue.delete_files(self, info_hash, save_path, file_paths)
+
+################################################################################
+class RemovalQueueTest(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='cherrytorrent-test-')
+        self.session   = fake_libtorrent.session()
+        self.events    = []
+
+        self.removal_queue = RecordingRemovalQueue(Bus(), self.events)
+        self.removal_queue.start()
+
+        self.alert_dispatcher = alerts.AlertDispatcher(Bus())
+        self.alert_dispatcher.register(fake_libtorrent.torrent_removed_alert, self._on_torrent_removed)
+        self.alert_dispatcher.register(fake_libtorrent.torrent_deleted_alert, self._on_torrent_deleted)
+        self.alert_dispatcher.register(fake_libtorrent.torrent_delete_failed_alert, self._on_torrent_deleted)
+        self.alert_dispatcher.start(self.session)
+
+    ############################################################################
+    def tearDown(self):
+        self.alert_dispatcher.stop()
+        self.removal_queue.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    ############################################################################
+    def _on_torrent_removed(self, alert):
+        self.events.append('torrent_removed_alert')
+        self.removal_queue.removed(str(alert.info_hash))
+
+    ############################################################################
+    def _on_torrent_deleted(self, alert):
+        self.events.append(alert.what())
+        self.removal_queue.storage_released(str(alert.info_hash))
+
+    ############################################################################
+    def test_files_deleted_after_storage_released(self):
+        ti = fake_libtorrent.make_torrent_info('removal', [('video.mkv', 64 * 16 * 1024)], 16 * 1024)
+        fake_libtorrent.register_swarm(ti, piece_rate=20.0)
+
+        torrent_handle = self.session.add_torrent({ 'ti': ti, 'save_path': self.directory })
+        torrent_handle.resume()
+        file_paths     = [file.path for file in ti.files()]
+        path           = os.path.join(self.directory, file_paths[0])
+        self.assertTrue(wait_until(lambda: os.path.isfile(path)))
+
+        # A piece is still being received, libtorrent writes it after the removal
+        self.removal_queue.remove(self.session, torrent_handle, self.directory, file_paths)
+        self.assertTrue(self.removal_queue.wait(10.0))
+
+        # wait also covers the deletion workers, the files are gone by now
+        self.assertEqual(self.events, ['torrent_removed_alert', 'torrent_deleted_alert', 'delete_files'])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    ############################################################################
+    def test_wait_for_torrent_until_storage_released(self):
+        ti = fake_libtorrent.make_torrent_info('pending', [('video.mkv', 64 * 16 * 1024)], 16 * 1024)
+        fake_libtorrent.register_swarm(ti, piece_rate=20.0)
+
+        torrent_handle = self.session.add_torrent({ 'ti': ti, 'save_path': self.directory })
+        info_hash      = str(torrent_handle.info_hash())
+        with self.removal_queue.condition:
+            self.removal_queue.remove(self.session, torrent_handle, self.directory, [file.path for file in ti.files()])
+            self.assertFalse(self.removal_queue.wait_for_torrent(info_hash, 0.0))
+
+        self.assertTrue(self.removal_queue.wait_for_torrent(info_hash, 10.0))
+        self.assertTrue(self.removal_queue.wait(10.0))
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+################################################################################
+#   python -m unittest discover -s tests
+################################################################################
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+
+import shard
+
+################################################################################
+INFO_HASHES = ['{0:040x}'.format(index * 2654435761) for index in range(2000)]
+
+################################################################################
+class HashRingTest(unittest.TestCase):
+    ############################################################################
+    def test_stable(self):
+        self.assertEqual([shard.HashRing(range(4)).get_node(info_hash) for info_hash in INFO_HASHES], [shard.HashRing(range(4)).get_node(info_hash) for info_hash in INFO_HASHES])
+
+    ############################################################################
+    def test_spread(self):
+        counts = dict((node, 0) for node in range(4))
+        ring   = shard.HashRing(range(4))
+        for info_hash in INFO_HASHES:
+            counts[ring.get_node(info_hash)] = counts[ring.get_node(info_hash)] + 1
+
+        for count in counts.itervalues():
+            self.assertGreater(count, len(INFO_HASHES) / 4 / 2)
+
+    ############################################################################
+    def test_added_node_only_takes_keys(self):
+        # Torrents either stay on their worker or move to the new one, never between the others
+        ring     = shard.HashRing(range(4))
+        new_ring = shard.HashRing(range(5))
+        for info_hash in INFO_HASHES:
+            node = new_ring.get_node(info_hash)
+            self.assertIn(node, (ring.get_node(info_hash), 4))
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()
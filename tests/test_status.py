@@ -0,0 +1,70 @@
+################################################################################
+#   python -m unittest discover -s tests
+################################################################################
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cherrytorrent'))
+
+import status
+
+################################################################################
+class StatusCacheTest(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.status_cache = status.StatusCache()
+
+    ############################################################################
+    def test_unchanged_torrent_keeps_version(self):
+        self.status_cache.update_torrent('a', { 'progress': 0.5 })
+        version = self.status_cache.version
+        self.status_cache.update_torrent('a', { 'progress': 0.5 })
+        self.assertEqual(self.status_cache.version, version)
+
+    ############################################################################
+    def test_delta(self):
+        self.status_cache.update_torrent('a', { 'info_hash': 'a', 'progress': 0.1 })
+        self.status_cache.update_torrent('b', { 'info_hash': 'b', 'progress': 0.1 })
+        since = self.status_cache.version
+
+        self.status_cache.update_torrent('a', { 'info_hash': 'a', 'progress': 0.2 })
+        self.status_cache.remove_torrent('b')
+
+        delta = self.status_cache.get_delta(since)
+        self.assertFalse(delta['full'])
+        self.assertEqual(delta['torrents'], [{ 'info_hash': 'a', 'progress': 0.2 }])
+        self.assertEqual(delta['removed'], ['b'])
+        self.assertEqual(self.status_cache.get_delta(delta['version'])['torrents'], [])
+
+    ############################################################################
+    def test_full_delta_once_removals_pruned(self):
+        for index in range(status.MAX_REMOVED + 1):
+            self.status_cache.update_torrent(str(index), { 'info_hash': str(index) })
+            self.status_cache.remove_torrent(str(index))
+        self.status_cache.update_torrent('a', { 'info_hash': 'a' })
+
+        delta = self.status_cache.get_delta(0)
+        self.assertTrue(delta['full'])
+        self.assertEqual(delta['removed'], [])
+        self.assertEqual(delta['torrents'], [{ 'info_hash': 'a' }])
+        self.assertFalse(self.status_cache.get_delta(self.status_cache.pruned)['full'])
+
+    ############################################################################
+    def test_publish(self):
+        self.status_cache.update_torrent('a', { 'info_hash': 'a' })
+        self.status_cache.publish({ 'dht_nodes': 1 })
+
+        result_json, etag = self.status_cache.get_json()
+        result            = json.loads(result_json)
+        self.assertEqual(etag, '"{0}"'.format(result['version']))
+        self.assertEqual(result['session'], { 'dht_nodes': 1, 'torrents': [{ 'info_hash': 'a' }] })
+
+        # Nothing changed, the snapshot stays
+        self.status_cache.publish({ 'dht_nodes': 1 })
+        self.assertEqual(self.status_cache.get_json(), (result_json, etag))
+
+################################################################################
+if __name__ == '__main__':
+    unittest.main()